@@ -1,7 +1,14 @@
 
 #include "generator.h"
+#include "simplex.h"
 
+#include <atomic>
+#include <climits>
 #include <cmath>
+#include <vector>
+
+/* Bumped whenever a Constant changes value, invalidating compiled programs */
+static std::atomic<unsigned long> constant_epoch(0);
 
 struct Generator
 {
@@ -9,6 +16,43 @@ public:
 	virtual ~Generator() {}
 	
 	virtual double generate(double x, double y, double z) = 0;
+	
+	/* Fold this node and its children into a specialised form, where possible */
+	virtual void compile() {}
+	
+	/* Evaluate n points packed as xyz triples. Subclasses override this to
+	 * walk the graph once per batch rather than once per point. */
+	virtual void generate_many(const double *xyz, size_t n, double *out) {
+		for (size_t p = 0; p < n; p++)
+			out[p] = generate(xyz[p*3+0], xyz[p*3+1], xyz[p*3+2]);
+	}
+	
+	/* The value at a point, plus its gradient. Nodes without an analytic form
+	 * fall back to central differences. */
+	virtual double generate_gradient(double x, double y, double z, double *gradient) {
+		const double e = 1e-6;
+		
+		gradient[0] = (generate(x + e, y, z) - generate(x - e, y, z)) / (2.0*e);
+		gradient[1] = (generate(x, y + e, z) - generate(x, y - e, z)) / (2.0*e);
+		gradient[2] = (generate(x, y, z + e) - generate(x, y, z - e)) / (2.0*e);
+		
+		return generate(x, y, z);
+	}
+	
+	virtual void generate_many_gradient(const double *xyz, size_t n, double *out, double *gradients) {
+		for (size_t p = 0; p < n; p++)
+			out[p] = generate_gradient(xyz[p*3+0], xyz[p*3+1], xyz[p*3+2], gradients + p*3);
+	}
+	
+	/* As generate_many and generate_many_gradient, with fractal nodes summing
+	 * at most max_octaves octaves. Nodes without octaves ignore the limit. */
+	virtual void generate_many_truncated(const double *xyz, size_t n, int max_octaves, double *out) {
+		generate_many(xyz, n, out);
+	}
+	
+	virtual void generate_many_gradient_truncated(const double *xyz, size_t n, int max_octaves, double *out, double *gradients) {
+		generate_many_gradient(xyz, n, out, gradients);
+	}
 };
 
 class Constant : public Generator
@@ -18,7 +62,24 @@ public:
 public:
 	Constant(double value) : value(value) {}
 	
+	void set(double value) {
+		if (value != this->value) {
+			this->value = value;
+			constant_epoch++;
+		}
+	}
+	
 	virtual double generate(double x, double y, double z) {return value;}
+	
+	virtual void generate_many(const double *xyz, size_t n, double *out) {
+		for (size_t p = 0; p < n; p++)
+			out[p] = value;
+	}
+	
+	virtual double generate_gradient(double x, double y, double z, double *gradient) {
+		gradient[0] = gradient[1] = gradient[2] = 0.0;
+		return value;
+	}
 };
 
 unsigned char perm[512] = {151,160,137,91,90,15,
@@ -54,136 +115,417 @@ int grad3[16][3] = {{0,1,1},{0,1,-1},{0,-1,1},{0,-1,-1},
                    {1,1,0},{1,-1,0},{-1,1,0},{-1,-1,0}, // 12 cube edges
                    {1,0,-1},{-1,0,-1},{0,-1,1},{0,1,1}}; // 4 more to make 16
 
+static inline int fastfloor(double x) {
+	return (x > 0) ? (int)x : ((int)x - 1);
+}
+
+static inline float dot(int *g, float x, float y, float z) {
+	return g[0]*x + g[1]*y + g[2]*z;
+}
+
+static inline int perm3(int x, int y, int z) {
+	int i = perm[(x + perm[y]) & 0xFF];
+	return perm[(i + perm[z]) & 0xFF];
+}
+
+static inline double simplex_noise(double x, double y, double z) {
+	/* Simple skewing factors for the 3D case */
+	const double F3 = 0.333333333;
+	const double G3 = 0.166666667;
+	
+	double n0, n1, n2, n3; /* Noise contributions from the four corners */
+	
+	/* Skew the input space to determine which simplex cell we're in */
+	double s = (x+y+z)*F3; /* Very nice and simple skew factor for 3D */
+	int i = fastfloor(x + s);
+	int j = fastfloor(y + s);
+	int k = fastfloor(z + s);
+	
+	double t = (double)(i+j+k)*G3; 
+	double X0 = i-t; /* Unskew the cell origin back to (x,y,z) space */
+	double Y0 = j-t;
+	double Z0 = k-t;
+	double x0 = x-X0; /* The x,y,z distances from the cell origin */
+	double y0 = y-Y0;
+	double z0 = z-Z0;
+	
+	/* For the 3D case, the simplex shape is a slightly irregular tetrahedron.
+	 * Determine which simplex we are in.
+	 */
+	int i1, j1, k1; /* Offsets for second corner of simplex in (i,j,k) coords */
+	int i2, j2, k2; /* Offsets for third corner of simplex in (i,j,k) coords */
+	
+	/* This code would benefit from a backport from the GLSL version! */
+	if(x0>=y0) {
+		if(y0>=z0)
+		{ i1=1; j1=0; k1=0; i2=1; j2=1; k2=0; } // X Y Z order
+		else if(x0>=z0) { i1=1; j1=0; k1=0; i2=1; j2=0; k2=1; } // X Z Y order
+		else { i1=0; j1=0; k1=1; i2=1; j2=0; k2=1; } // Z X Y order
+	}
+	else {
+		if(y0<z0) { i1=0; j1=0; k1=1; i2=0; j2=1; k2=1; } // Z Y X order
+		else if(x0<z0) { i1=0; j1=1; k1=0; i2=0; j2=1; k2=1; } // Y Z X order
+		else { i1=0; j1=1; k1=0; i2=1; j2=1; k2=0; } // Y X Z order
+	}
+	
+	/* A step of (1,0,0) in (i,j,k) means a step of (1-c,-c,-c) in (x,y,z),
+	 * a step of (0,1,0) in (i,j,k) means a step of (-c,1-c,-c) in (x,y,z), and
+	 * a step of (0,0,1) in (i,j,k) means a step of (-c,-c,1-c) in (x,y,z), where
+	 * c = 1/6.
+	 */
+	
+	double x1 = x0 - i1 + G3; /* Offsets for second corner in (x,y,z) coords */
+	double y1 = y0 - j1 + G3;
+	double z1 = z0 - k1 + G3;
+	double x2 = x0 - i2 + 2.0*G3; /* Offsets for third corner in (x,y,z) coords */
+	double y2 = y0 - j2 + 2.0*G3;
+	double z2 = z0 - k2 + 2.0*G3;
+	double x3 = x0 - 1.0 + 3.0*G3; /* Offsets for last corner in (x,y,z) coords */
+	double y3 = y0 - 1.0 + 3.0*G3;
+	double z3 = z0 - 1.0 + 3.0*G3;
+	
+	/* Wrap the integer indices at 256, to avoid indexing perm[] out of bounds */
+	int ii = i % 256;
+	int jj = j % 256;
+	int kk = k % 256;
+	
+	if (ii < 0) ii += 256;
+	if (jj < 0) jj += 256;
+	if (kk < 0) kk += 256;
+	
+	int gi0 = perm3(ii, jj, kk) % 12;
+	int gi1 = perm3(ii+i1, jj+j1, kk+k1) % 12;
+	int gi2 = perm3(ii+i2, jj+j2, kk+k2) % 12;
+	int gi3 = perm3(ii+1, jj+1, kk+1) % 12;
+
+	/* Calculate the contribution from the four corners */
+	float t0 = 0.6 - x0*x0 - y0*y0 - z0*z0;
+	if(t0 < 0.0) n0 = 0.0;
+	else {
+		t0 *= t0;
+		n0 = t0 * t0 * dot(grad3[gi0], x0, y0, z0);
+	}
+	
+	float t1 = 0.6 - x1*x1 - y1*y1 - z1*z1;
+	if(t1 < 0.0) n1 = 0.0;
+	else {
+		t1 *= t1;
+		n1 = t1 * t1 * dot(grad3[gi1], x1, y1, z1);
+	}
+	
+	float t2 = 0.6 - x2*x2 - y2*y2 - z2*z2;
+	if(t2 < 0.0) n2 = 0.0;
+	else {
+		t2 *= t2;
+		n2 = t2 * t2 * dot(grad3[gi2], x2, y2, z2);
+	}
+	
+	float t3 = 0.6 - x3*x3 - y3*y3 - z3*z3;
+	if(t3<0.0) n3 = 0.0;
+	else {
+		t3 *= t3;
+		n3 = t3 * t3 * dot(grad3[gi3], x3, y3, z3);
+	}
+	
+	/* Add contributions from each corner to get the final noise value. */
+	/* The result is scaled to stay just inside [-1,1] */
+	return 32.0 * (n0 + n1 + n2 + n3); /* TODO: The scale factor is preliminary! */
+}
+
+/* One corner's contribution, rounded exactly as in simplex_noise, accumulating
+ * its analytic gradient alongside */
+static inline double simplex_corner(int gi, double x, double y, double z, double *gradient) {
+	double t = 0.6 - x*x - y*y - z*z;
+	float tf = t;
+	
+	if (tf < 0.0)
+		return 0.0;
+	
+	int *g = grad3[gi];
+	double d = g[0]*x + g[1]*y + g[2]*z;
+	double t3 = t*t*t;
+	
+	/* d/dx of t^4 (g.x) is t^4 g - 8 t^3 (g.x) x */
+	gradient[0] += t3*t*g[0] - 8.0*t3*d*x;
+	gradient[1] += t3*t*g[1] - 8.0*t3*d*y;
+	gradient[2] += t3*t*g[2] - 8.0*t3*d*z;
+	
+	tf *= tf;
+	return tf * tf * dot(g, x, y, z);
+}
+
+static inline double simplex_noise_gradient(double x, double y, double z, double *gradient) {
+	/* Simple skewing factors for the 3D case */
+	const double F3 = 0.333333333;
+	const double G3 = 0.166666667;
+	
+	/* Skew the input space to determine which simplex cell we're in */
+	double s = (x+y+z)*F3; /* Very nice and simple skew factor for 3D */
+	int i = fastfloor(x + s);
+	int j = fastfloor(y + s);
+	int k = fastfloor(z + s);
+	
+	double t = (double)(i+j+k)*G3; 
+	double X0 = i-t; /* Unskew the cell origin back to (x,y,z) space */
+	double Y0 = j-t;
+	double Z0 = k-t;
+	double x0 = x-X0; /* The x,y,z distances from the cell origin */
+	double y0 = y-Y0;
+	double z0 = z-Z0;
+	
+	/* For the 3D case, the simplex shape is a slightly irregular tetrahedron.
+	 * Determine which simplex we are in.
+	 */
+	int i1, j1, k1; /* Offsets for second corner of simplex in (i,j,k) coords */
+	int i2, j2, k2; /* Offsets for third corner of simplex in (i,j,k) coords */
+	
+	/* This code would benefit from a backport from the GLSL version! */
+	if(x0>=y0) {
+		if(y0>=z0)
+		{ i1=1; j1=0; k1=0; i2=1; j2=1; k2=0; } // X Y Z order
+		else if(x0>=z0) { i1=1; j1=0; k1=0; i2=1; j2=0; k2=1; } // X Z Y order
+		else { i1=0; j1=0; k1=1; i2=1; j2=0; k2=1; } // Z X Y order
+	}
+	else {
+		if(y0<z0) { i1=0; j1=0; k1=1; i2=0; j2=1; k2=1; } // Z Y X order
+		else if(x0<z0) { i1=0; j1=1; k1=0; i2=0; j2=1; k2=1; } // Y Z X order
+		else { i1=0; j1=1; k1=0; i2=1; j2=1; k2=0; } // Y X Z order
+	}
+	
+	/* A step of (1,0,0) in (i,j,k) means a step of (1-c,-c,-c) in (x,y,z),
+	 * a step of (0,1,0) in (i,j,k) means a step of (-c,1-c,-c) in (x,y,z), and
+	 * a step of (0,0,1) in (i,j,k) means a step of (-c,-c,1-c) in (x,y,z), where
+	 * c = 1/6.
+	 */
+	
+	double x1 = x0 - i1 + G3; /* Offsets for second corner in (x,y,z) coords */
+	double y1 = y0 - j1 + G3;
+	double z1 = z0 - k1 + G3;
+	double x2 = x0 - i2 + 2.0*G3; /* Offsets for third corner in (x,y,z) coords */
+	double y2 = y0 - j2 + 2.0*G3;
+	double z2 = z0 - k2 + 2.0*G3;
+	double x3 = x0 - 1.0 + 3.0*G3; /* Offsets for last corner in (x,y,z) coords */
+	double y3 = y0 - 1.0 + 3.0*G3;
+	double z3 = z0 - 1.0 + 3.0*G3;
+	
+	/* Wrap the integer indices at 256, to avoid indexing perm[] out of bounds */
+	int ii = i % 256;
+	int jj = j % 256;
+	int kk = k % 256;
+	
+	if (ii < 0) ii += 256;
+	if (jj < 0) jj += 256;
+	if (kk < 0) kk += 256;
+	
+	int gi0 = perm3(ii, jj, kk) % 12;
+	int gi1 = perm3(ii+i1, jj+j1, kk+k1) % 12;
+	int gi2 = perm3(ii+i2, jj+j2, kk+k2) % 12;
+	int gi3 = perm3(ii+1, jj+1, kk+1) % 12;
+
+	gradient[0] = gradient[1] = gradient[2] = 0.0;
+	
+	double n0 = simplex_corner(gi0, x0, y0, z0, gradient);
+	double n1 = simplex_corner(gi1, x1, y1, z1, gradient);
+	double n2 = simplex_corner(gi2, x2, y2, z2, gradient);
+	double n3 = simplex_corner(gi3, x3, y3, z3, gradient);
+	
+	gradient[0] *= 32.0;
+	gradient[1] *= 32.0;
+	gradient[2] *= 32.0;
+	
+	return 32.0 * (n0 + n1 + n2 + n3);
+}
+
+static void simplex_many_scalar(const double *xyz, size_t n, double *out) {
+	for (size_t p = 0; p < n; p++)
+		out[p] = simplex_noise(xyz[p*3+0], xyz[p*3+1], xyz[p*3+2]);
+}
+
+/* Only trust a vector kernel that reproduces the scalar one on a spread of inputs */
+static bool simplex_kernel_agrees(simplex_batch_func kernel) {
+	const size_t n = 4099;
+	const double tolerance = 1e-6;
+	
+	std::vector<double> points(n*3), expected(n), actual(n);
+	
+	unsigned int seed = 12345;
+	for (size_t i = 0; i < n*3; i++) {
+		seed = seed*1664525 + 1013904223;
+		points[i] = ((seed >> 8) / (double)(1 << 24) - 0.5) * ((i % 7 == 0) ? 131072.0 : 512.0);
+	}
+	
+	simplex_many_scalar(&points[0], n, &expected[0]);
+	kernel(&points[0], n, &actual[0]);
+	
+	for (size_t i = 0; i < n; i++)
+		if (!(std::abs(expected[i] - actual[i]) <= tolerance))
+			return false;
+	
+	return true;
+}
+
+static int simplex_simd_level = 0;
+
+static simplex_batch_func select_simplex_kernel() {
+	simplex_batch_func avx2 = simplex_avx2_kernel();
+	
+	if (avx2 && simplex_kernel_agrees(avx2)) {
+		simplex_simd_level = 1;
+		return avx2;
+	}
+	
+	return simplex_many_scalar;
+}
+
+static simplex_batch_func simplex_many = select_simplex_kernel();
+
 class Simplex : public Generator
 {
 public:
 	Simplex() {}
 	
 	virtual double generate(double x, double y, double z) {
-		/* Simple skewing factors for the 3D case */
-		const double F3 = 0.333333333;
-		const double G3 = 0.166666667;
-		
-		double n0, n1, n2, n3; /* Noise contributions from the four corners */
-		
-		/* Skew the input space to determine which simplex cell we're in */
-		double s = (x+y+z)*F3; /* Very nice and simple skew factor for 3D */
-		int i = fastfloor(x + s);
-		int j = fastfloor(y + s);
-		int k = fastfloor(z + s);
-		
-		double t = (double)(i+j+k)*G3; 
-		double X0 = i-t; /* Unskew the cell origin back to (x,y,z) space */
-		double Y0 = j-t;
-		double Z0 = k-t;
-		double x0 = x-X0; /* The x,y,z distances from the cell origin */
-		double y0 = y-Y0;
-		double z0 = z-Z0;
-		
-		/* For the 3D case, the simplex shape is a slightly irregular tetrahedron.
-		 * Determine which simplex we are in.
-		 */
-		int i1, j1, k1; /* Offsets for second corner of simplex in (i,j,k) coords */
-		int i2, j2, k2; /* Offsets for third corner of simplex in (i,j,k) coords */
-		
-		/* This code would benefit from a backport from the GLSL version! */
-		if(x0>=y0) {
-			if(y0>=z0)
-			{ i1=1; j1=0; k1=0; i2=1; j2=1; k2=0; } // X Y Z order
-			else if(x0>=z0) { i1=1; j1=0; k1=0; i2=1; j2=0; k2=1; } // X Z Y order
-			else { i1=0; j1=0; k1=1; i2=1; j2=0; k2=1; } // Z X Y order
-		}
-		else {
-			if(y0<z0) { i1=0; j1=0; k1=1; i2=0; j2=1; k2=1; } // Z Y X order
-			else if(x0<z0) { i1=0; j1=1; k1=0; i2=0; j2=1; k2=1; } // Y Z X order
-			else { i1=0; j1=1; k1=0; i2=1; j2=1; k2=0; } // Y X Z order
-		}
-		
-		/* A step of (1,0,0) in (i,j,k) means a step of (1-c,-c,-c) in (x,y,z),
-		 * a step of (0,1,0) in (i,j,k) means a step of (-c,1-c,-c) in (x,y,z), and
-		 * a step of (0,0,1) in (i,j,k) means a step of (-c,-c,1-c) in (x,y,z), where
-		 * c = 1/6.
-		 */
-		
-		double x1 = x0 - i1 + G3; /* Offsets for second corner in (x,y,z) coords */
-		double y1 = y0 - j1 + G3;
-		double z1 = z0 - k1 + G3;
-		double x2 = x0 - i2 + 2.0*G3; /* Offsets for third corner in (x,y,z) coords */
-		double y2 = y0 - j2 + 2.0*G3;
-		double z2 = z0 - k2 + 2.0*G3;
-		double x3 = x0 - 1.0 + 3.0*G3; /* Offsets for last corner in (x,y,z) coords */
-		double y3 = y0 - 1.0 + 3.0*G3;
-		double z3 = z0 - 1.0 + 3.0*G3;
-		
-		/* Wrap the integer indices at 256, to avoid indexing perm[] out of bounds */
-		int ii = i % 256;
-		int jj = j % 256;
-		int kk = k % 256;
-		
-		if (ii < 0) ii += 256;
-		if (jj < 0) jj += 256;
-		if (kk < 0) kk += 256;
-		
-		int gi0 = perm3(ii, jj, kk) % 12;
-		int gi1 = perm3(ii+i1, jj+j1, kk+k1) % 12;
-		int gi2 = perm3(ii+i2, jj+j2, kk+k2) % 12;
-		int gi3 = perm3(ii+1, jj+1, kk+1) % 12;
-
-		/* Calculate the contribution from the four corners */
-		float t0 = 0.6 - x0*x0 - y0*y0 - z0*z0;
-		if(t0 < 0.0) n0 = 0.0;
-		else {
-			t0 *= t0;
-			n0 = t0 * t0 * dot(grad3[gi0], x0, y0, z0);
-		}
-		
-		float t1 = 0.6 - x1*x1 - y1*y1 - z1*z1;
-		if(t1 < 0.0) n1 = 0.0;
-		else {
-			t1 *= t1;
-			n1 = t1 * t1 * dot(grad3[gi1], x1, y1, z1);
-		}
-		
-		float t2 = 0.6 - x2*x2 - y2*y2 - z2*z2;
-		if(t2 < 0.0) n2 = 0.0;
-		else {
-			t2 *= t2;
-			n2 = t2 * t2 * dot(grad3[gi2], x2, y2, z2);
-		}
-		
-		float t3 = 0.6 - x3*x3 - y3*y3 - z3*z3;
-		if(t3<0.0) n3 = 0.0;
-		else {
-			t3 *= t3;
-			n3 = t3 * t3 * dot(grad3[gi3], x3, y3, z3);
-		}
-		
-		/* Add contributions from each corner to get the final noise value. */
-		/* The result is scaled to stay just inside [-1,1] */
-		return 32.0 * (n0 + n1 + n2 + n3); /* TODO: The scale factor is preliminary! */
+		return simplex_noise(x, y, z);
 	}
-private:
-	int fastfloor(double x) {
-		return (x > 0) ? (int)x : ((int)x - 1);
+	
+	virtual void generate_many(const double *xyz, size_t n, double *out) {
+		simplex_many(xyz, n, out);
 	}
-
-	float dot(int *g, float x, float y, float z) {
-	return g[0]*x + g[1]*y + g[2]*z;
+	
+	virtual double generate_gradient(double x, double y, double z, double *gradient) {
+		return simplex_noise_gradient(x, y, z, gradient);
 	}
+};
 
-	int perm3(int x, int y, int z) {
-		int i = perm[(x + perm[y]) & 0xFF];
-		return perm[(i + perm[z]) & 0xFF];
-	}
+/* A RidgedMultifractal over Simplex with all-Constant parameters, flattened
+ * into scalars and a per-octave amplitude table */
+struct RidgedProgram
+{
+	unsigned long epoch;
+	bool valid;
+	
+	double lacunarity, gain, offset, weight;
+	std::vector<double> amplitude;
+	
+	RidgedProgram() : epoch(0), valid(false) {}
 };
 
 class RidgedMultifractal : public Generator
 {
 	Generator *basis, *octaves, *lacunarity, *gain, *offset, *h, *weight, *freq;
+	RidgedProgram program;
 public:
 	RidgedMultifractal(Generator *basis, Generator *octaves, Generator *lacunarity, Generator *gain, Generator *offset, Generator *h, Generator *weight, Generator *freq) : basis(basis), octaves(octaves), lacunarity(lacunarity), gain(gain), offset(offset), h(h), weight(weight), freq(freq) {}
 	
+	virtual void compile() {
+		unsigned long epoch = constant_epoch;
+		
+		if (program.valid && program.epoch == epoch)
+			return;
+		
+		Generator *children[] = {basis, octaves, lacunarity, gain, offset, h, weight, freq};
+		for (int i = 0; i < 8; i++)
+			children[i]->compile();
+		
+		program.valid = false;
+		
+		Constant *params[7];
+		for (int i = 0; i < 7; i++) {
+			params[i] = dynamic_cast<Constant *>(children[i+1]);
+			if (!params[i])
+				return;
+		}
+		
+		if (!dynamic_cast<Simplex *>(basis))
+			return;
+		
+		double octaves = params[0]->value;
+		double freq = params[6]->value;
+		
+		program.lacunarity = params[1]->value;
+		program.gain = params[2]->value;
+		program.offset = params[3]->value;
+		program.weight = params[5]->value;
+		
+		/* the same frequency sequence generate() walks, so results are bit-identical */
+		program.amplitude.clear();
+		for (int i = 0; i < octaves; i++) {
+			program.amplitude.push_back(pow(freq, -params[4]->value));
+			freq *= program.lacunarity;
+		}
+		
+		program.epoch = epoch;
+		program.valid = true;
+	}
+	
+	bool compiled() const {
+		return program.valid && program.epoch == constant_epoch;
+	}
+	
+	double generate_compiled(double x, double y, double z) const {
+		const RidgedProgram &p = program;
+		
+		double weight = p.weight;
+		double value = 0.0;
+		
+		for (size_t i = 0; i < p.amplitude.size(); i++) {
+			double signal = (p.offset - std::abs(simplex_noise(x, y, z)));
+			
+			signal *= signal * weight;
+			
+			weight = signal*p.gain;
+			
+			weight = (weight > 1.0) ? 1.0 : ((weight < 0.0) ? 0.0 : weight);
+			
+			value += signal * p.amplitude[i];
+			
+			x *= p.lacunarity;
+			y *= p.lacunarity;
+			z *= p.lacunarity;
+		}
+		
+		return value - 1.0;
+	}
+	
+	void generate_many_compiled(const double *xyz, size_t n, int max_octaves, double *out) const {
+		const RidgedProgram &p = program;
+		
+		std::vector<double> v(xyz, xyz + n*3), basis(n), weight(n, p.weight);
+		
+		size_t octaves = p.amplitude.size();
+		if ((size_t)max_octaves < octaves)
+			octaves = max_octaves;
+		
+		for (size_t q = 0; q < n; q++)
+			out[q] = 0.0;
+		
+		for (size_t i = 0; i < octaves; i++) {
+			simplex_many(&v[0], n, &basis[0]);
+			
+			for (size_t q = 0; q < n; q++) {
+				double signal = (p.offset - std::abs(basis[q]));
+				
+				signal *= signal * weight[q];
+				
+				weight[q] = signal*p.gain;
+				
+				weight[q] = (weight[q] > 1.0) ? 1.0 : ((weight[q] < 0.0) ? 0.0 : weight[q]);
+				
+				out[q] += signal * p.amplitude[i];
+			}
+			
+			for (size_t q = 0; q < n*3; q++)
+				v[q] *= p.lacunarity;
+		}
+		
+		for (size_t q = 0; q < n; q++)
+			out[q] -= 1.0;
+	}
+	
 	virtual double generate(double x, double y, double z) {
+		if (compiled())
+			return generate_compiled(x, y, z);
+		
 		double octaves = this->octaves->generate(x, y, z);
 		double lacunarity = this->lacunarity->generate(x, y, z);
 		double gain = this->gain->generate(x, y, z);
@@ -215,6 +557,147 @@ public:
 		
 		return value - 1.0;
 	}
+	
+	virtual void generate_many(const double *xyz, size_t n, double *out) {
+		generate_many_truncated(xyz, n, INT_MAX, out);
+	}
+	
+	virtual void generate_many_truncated(const double *xyz, size_t n, int max_octaves, double *out) {
+		if (compiled()) {
+			generate_many_compiled(xyz, n, max_octaves, out);
+			return;
+		}
+		
+		/* Parameters are evaluated once per batch rather than once per point */
+		std::vector<double> octaves(n), lacunarity(n), gain(n), offset(n), h(n), weight(n), freq(n);
+		
+		this->octaves->generate_many(xyz, n, &octaves[0]);
+		this->lacunarity->generate_many(xyz, n, &lacunarity[0]);
+		this->gain->generate_many(xyz, n, &gain[0]);
+		this->offset->generate_many(xyz, n, &offset[0]);
+		this->h->generate_many(xyz, n, &h[0]);
+		this->weight->generate_many(xyz, n, &weight[0]);
+		this->freq->generate_many(xyz, n, &freq[0]);
+		
+		std::vector<double> v(xyz, xyz + n*3), basis(n);
+		
+		double most_octaves = 0.0;
+		
+		for (size_t p = 0; p < n; p++) {
+			out[p] = 0.0;
+			octaves[p] = (octaves[p] > max_octaves) ? max_octaves : octaves[p];
+			most_octaves = (octaves[p] > most_octaves) ? octaves[p] : most_octaves;
+		}
+		
+		for (int i = 0; i < most_octaves; i++) {
+			this->basis->generate_many(&v[0], n, &basis[0]);
+			
+			for (size_t p = 0; p < n; p++) {
+				if (!(i < octaves[p]))
+					continue;
+				
+				double signal = (offset[p] - std::abs(basis[p]));
+				
+				signal *= signal * weight[p];
+				
+				weight[p] = signal*gain[p];
+				
+				weight[p] = (weight[p] > 1.0) ? 1.0 : ((weight[p] < 0.0) ? 0.0 : weight[p]);
+				
+				out[p] += signal * pow(freq[p], -h[p]);
+				
+				freq[p] *= lacunarity[p];
+				
+				v[p*3+0] *= lacunarity[p];
+				v[p*3+1] *= lacunarity[p];
+				v[p*3+2] *= lacunarity[p];
+			}
+		}
+		
+		for (size_t p = 0; p < n; p++)
+			out[p] -= 1.0;
+	}
+	
+	/* Parameters are treated as locally constant, which is exact for Constant nodes */
+	virtual double generate_gradient(double x, double y, double z, double *gradient) {
+		return generate_gradient_truncated(x, y, z, INT_MAX, gradient);
+	}
+	
+	virtual void generate_many_gradient_truncated(const double *xyz, size_t n, int max_octaves, double *out, double *gradients) {
+		for (size_t p = 0; p < n; p++)
+			out[p] = generate_gradient_truncated(xyz[p*3+0], xyz[p*3+1], xyz[p*3+2], max_octaves, gradients + p*3);
+	}
+	
+	double generate_gradient_truncated(double x, double y, double z, int max_octaves, double *gradient) {
+		bool fast = compiled();
+		
+		double octaves, lacunarity, gain, offset, h, weight, freq;
+		
+		if (fast) {
+			octaves = program.amplitude.size();
+			lacunarity = program.lacunarity;
+			gain = program.gain;
+			offset = program.offset;
+			weight = program.weight;
+			h = freq = 0.0;
+		} else {
+			octaves = this->octaves->generate(x, y, z);
+			lacunarity = this->lacunarity->generate(x, y, z);
+			gain = this->gain->generate(x, y, z);
+			offset = this->offset->generate(x, y, z);
+			h = this->h->generate(x, y, z);
+			weight = this->weight->generate(x, y, z);
+			freq = this->freq->generate(x, y, z);
+		}
+		
+		octaves = (octaves > max_octaves) ? max_octaves : octaves;
+		
+		double value = 0.0, scale = 1.0;
+		double dweight[3] = {0.0, 0.0, 0.0};
+		
+		gradient[0] = gradient[1] = gradient[2] = 0.0;
+		
+		for (int i = 0; i < octaves; i++) {
+			double db[3];
+			double b = fast ? simplex_noise_gradient(x, y, z, db) : this->basis->generate_gradient(x, y, z, db);
+			
+			double signal = (offset - std::abs(b));
+			double s0 = signal;
+			
+			signal *= signal * weight;
+			
+			/* d(offset - |b|) = -sign(b) db, and db picks up the octave's frequency */
+			double dsignal[3];
+			for (int k = 0; k < 3; k++) {
+				double ds0 = ((b < 0.0) ? db[k] : -db[k]) * scale;
+				dsignal[k] = 2.0*s0*weight*ds0 + s0*s0*dweight[k];
+			}
+			
+			weight = signal*gain;
+			
+			bool clamped = (weight > 1.0) || (weight < 0.0);
+			
+			weight = (weight > 1.0) ? 1.0 : ((weight < 0.0) ? 0.0 : weight);
+			
+			double amplitude = fast ? program.amplitude[i] : pow(freq, -h);
+			
+			value += signal * amplitude;
+			
+			for (int k = 0; k < 3; k++) {
+				dweight[k] = clamped ? 0.0 : gain*dsignal[k];
+				gradient[k] += dsignal[k] * amplitude;
+			}
+			
+			freq *= lacunarity;
+			scale *= lacunarity;
+			
+			x *= lacunarity;
+			y *= lacunarity;
+			z *= lacunarity;
+		}
+		
+		return value - 1.0;
+	}
 };
 
 extern "C" {
@@ -243,7 +726,12 @@ double noise_generator_constant_value_get(noise_generator *generator)
 }
 void noise_generator_constant_value_set(noise_generator *generator, double value)
 {
-	dynamic_cast<Constant *>(generator)->value = value;
+	dynamic_cast<Constant *>(generator)->set(value);
+}
+
+void noise_generator_compile(noise_generator *generator)
+{
+	generator->compile();
 }
 
 double noise_generate(noise_generator *generator, double x, double y, double z)
@@ -251,4 +739,38 @@ double noise_generate(noise_generator *generator, double x, double y, double z)
 	return generator->generate(x, y, z);
 }
 
+void noise_generate_batch(noise_generator *generator, const double *xyz, size_t n, double *out)
+{
+	if (n > 0)
+		generator->generate_many(xyz, n, out);
+}
+
+void noise_generate_batch_truncated(noise_generator *generator, const double *xyz, size_t n, int max_octaves, double *out)
+{
+	if (n > 0)
+		generator->generate_many_truncated(xyz, n, (max_octaves < 0) ? INT_MAX : max_octaves, out);
+}
+
+double noise_generate_gradient(noise_generator *generator, double x, double y, double z, double gradient[3])
+{
+	return generator->generate_gradient(x, y, z, gradient);
+}
+
+void noise_generate_batch_gradient(noise_generator *generator, const double *xyz, size_t n, double *out, double *gradients)
+{
+	if (n > 0)
+		generator->generate_many_gradient(xyz, n, out, gradients);
+}
+
+void noise_generate_batch_gradient_truncated(noise_generator *generator, const double *xyz, size_t n, int max_octaves, double *out, double *gradients)
+{
+	if (n > 0)
+		generator->generate_many_gradient_truncated(xyz, n, (max_octaves < 0) ? INT_MAX : max_octaves, out, gradients);
+}
+
+int noise_simd_level()
+{
+	return simplex_simd_level;
+}
+
 }
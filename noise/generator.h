@@ -2,6 +2,8 @@
 #ifndef generator_h
 #define generator_h
 
+#include <stddef.h>
+
 #ifdef __cplusplus
 extern "C" {
 #endif
@@ -9,6 +11,10 @@ extern "C" {
 struct Generator;
 typedef struct Generator noise_generator;
 
+/* Evaluating a graph is reentrant: any number of threads may call the
+ * noise_generate* functions on the same generators at once, so long as none
+ * compiles the graph or sets one of its constants meanwhile. */
+
 void noise_generator_destroy(noise_generator *generator);
 
 noise_generator *noise_generator_constant_create(double value);
@@ -18,8 +24,29 @@ noise_generator *noise_generator_ridged_multifractal_create(noise_generator *bas
 double noise_generator_constant_value_get(noise_generator *generator);
 void noise_generator_constant_value_set(noise_generator *generator, double value);
 
+/* Specialises the graph for its current constant values. Changing any constant
+ * afterwards falls back to the generic path until the graph is compiled again.
+ * Must not be called while the graph is being evaluated on another thread. */
+void noise_generator_compile(noise_generator *generator);
+
 double noise_generate(noise_generator *generator, double x, double y, double z);
 
+/* Evaluates n points, packed as consecutive xyz triples, writing one value per point to out */
+void noise_generate_batch(noise_generator *generator, const double *xyz, size_t n, double *out);
+
+/* As noise_generate and noise_generate_batch, also writing the gradient of each value as an xyz triple */
+double noise_generate_gradient(noise_generator *generator, double x, double y, double z, double gradient[3]);
+void noise_generate_batch_gradient(noise_generator *generator, const double *xyz, size_t n, double *out, double *gradients);
+
+/* As noise_generate_batch and noise_generate_batch_gradient, with every fractal
+ * in the graph summing at most max_octaves octaves. A negative max_octaves
+ * leaves the sums untruncated. */
+void noise_generate_batch_truncated(noise_generator *generator, const double *xyz, size_t n, int max_octaves, double *out);
+void noise_generate_batch_gradient_truncated(noise_generator *generator, const double *xyz, size_t n, int max_octaves, double *out, double *gradients);
+
+/* The simplex kernel batches run on: 0 for scalar, 1 for AVX2 */
+int noise_simd_level();
+
 #ifdef __cplusplus
 }
 #endif
@@ -0,0 +1,16 @@
+
+#ifndef simplex_h
+#define simplex_h
+
+#include <stddef.h>
+
+extern unsigned char perm[512];
+extern int grad3[16][3];
+
+/* Evaluates simplex noise at n points, packed as consecutive xyz triples */
+typedef void (*simplex_batch_func)(const double *xyz, size_t n, double *out);
+
+/* The AVX2 kernel, or NULL when the compiler or the CPU can't run it */
+simplex_batch_func simplex_avx2_kernel();
+
+#endif
@@ -0,0 +1,180 @@
+
+#include "simplex.h"
+
+#if defined(__x86_64__) || defined(_M_X64) || defined(__i386__) || defined(_M_IX86)
+
+#include <immintrin.h>
+
+#if defined(_MSC_VER)
+#include <intrin.h>
+#define TARGET_AVX2
+#else
+#define TARGET_AVX2 __attribute__((target("avx2")))
+#endif
+
+/* perm[] widened to 32 bits for gathers, and with the gradient index pre-reduced */
+static int perm32[512];
+static int perm_mod12[512];
+static float grad_x[12], grad_y[12], grad_z[12];
+
+static bool cpu_has_avx2() {
+#if defined(_MSC_VER)
+	int info[4];
+	__cpuid(info, 0);
+	if (info[0] < 7)
+		return false;
+
+	__cpuid(info, 1);
+	bool osxsave = (info[2] & (1 << 27)) != 0;
+	bool avx = (info[2] & (1 << 28)) != 0;
+	if (!osxsave || !avx || (_xgetbv(0) & 6) != 6)
+		return false;
+
+	__cpuidex(info, 7, 0);
+	return (info[1] & (1 << 5)) != 0;
+#else
+	__builtin_cpu_init();
+	return __builtin_cpu_supports("avx2");
+#endif
+}
+
+/* (x > 0) ? (int)x : ((int)x - 1), as in the scalar kernel */
+TARGET_AVX2 static inline __m128i fastfloor4(__m256d x) {
+	__m256d positive = _mm256_cmp_pd(x, _mm256_setzero_pd(), _CMP_GT_OQ);
+	__m256d truncated = _mm256_round_pd(x, _MM_FROUND_TO_ZERO | _MM_FROUND_NO_EXC);
+
+	return _mm256_cvttpd_epi32(_mm256_sub_pd(truncated, _mm256_andnot_pd(positive, _mm256_set1_pd(1.0))));
+}
+
+TARGET_AVX2 static inline __m128i perm3_mod12(__m128i x, __m128i y, __m128i z) {
+	__m128i mask = _mm_set1_epi32(0xFF);
+
+	__m128i i = _mm_i32gather_epi32(perm32, _mm_and_si128(_mm_add_epi32(x, _mm_i32gather_epi32(perm32, y, 4)), mask), 4);
+	return _mm_i32gather_epi32(perm_mod12, _mm_and_si128(_mm_add_epi32(i, _mm_i32gather_epi32(perm32, z, 4)), mask), 4);
+}
+
+/* One corner's contribution, rounding through float exactly where the scalar kernel does */
+TARGET_AVX2 static inline __m256d corner4(__m128i gi, __m256d x, __m256d y, __m256d z) {
+	__m256d d = _mm256_sub_pd(_mm256_sub_pd(_mm256_sub_pd(_mm256_set1_pd(0.6), _mm256_mul_pd(x, x)), _mm256_mul_pd(y, y)), _mm256_mul_pd(z, z));
+	__m128 t = _mm256_cvtpd_ps(d);
+
+	__m128 dot = _mm_add_ps(_mm_add_ps(
+		_mm_mul_ps(_mm_i32gather_ps(grad_x, gi, 4), _mm256_cvtpd_ps(x)),
+		_mm_mul_ps(_mm_i32gather_ps(grad_y, gi, 4), _mm256_cvtpd_ps(y))),
+		_mm_mul_ps(_mm_i32gather_ps(grad_z, gi, 4), _mm256_cvtpd_ps(z)));
+
+	__m128 t2 = _mm_mul_ps(t, t);
+	__m128 n = _mm_mul_ps(_mm_mul_ps(t2, t2), dot);
+
+	n = _mm_andnot_ps(_mm_cmplt_ps(t, _mm_setzero_ps()), n);
+
+	return _mm256_cvtps_pd(n);
+}
+
+TARGET_AVX2 static void simplex_many_avx2(const double *xyz, size_t n, double *out) {
+	const double F3 = 0.333333333;
+	const double G3 = 0.166666667;
+
+	const __m256d one = _mm256_set1_pd(1.0);
+	const __m128i one_i = _mm_set1_epi32(1);
+	const __m128i wrap = _mm_set1_epi32(0xFF);
+
+	size_t p = 0;
+
+	for (; p + 4 <= n; p += 4) {
+		const double *v = xyz + p*3;
+
+		__m256d x = _mm256_set_pd(v[9], v[6], v[3], v[0]);
+		__m256d y = _mm256_set_pd(v[10], v[7], v[4], v[1]);
+		__m256d z = _mm256_set_pd(v[11], v[8], v[5], v[2]);
+
+		/* Skew the input space to determine which simplex cell we're in */
+		__m256d s = _mm256_mul_pd(_mm256_add_pd(_mm256_add_pd(x, y), z), _mm256_set1_pd(F3));
+		__m128i i = fastfloor4(_mm256_add_pd(x, s));
+		__m128i j = fastfloor4(_mm256_add_pd(y, s));
+		__m128i k = fastfloor4(_mm256_add_pd(z, s));
+
+		__m256d t = _mm256_mul_pd(_mm256_cvtepi32_pd(_mm_add_epi32(_mm_add_epi32(i, j), k)), _mm256_set1_pd(G3));
+		__m256d x0 = _mm256_sub_pd(x, _mm256_sub_pd(_mm256_cvtepi32_pd(i), t));
+		__m256d y0 = _mm256_sub_pd(y, _mm256_sub_pd(_mm256_cvtepi32_pd(j), t));
+		__m256d z0 = _mm256_sub_pd(z, _mm256_sub_pd(_mm256_cvtepi32_pd(k), t));
+
+		/* Branchless form of the scalar kernel's ordering selection */
+		__m256d a = _mm256_cmp_pd(x0, y0, _CMP_GE_OQ);
+		__m256d b = _mm256_cmp_pd(y0, z0, _CMP_GE_OQ);
+		__m256d c = _mm256_cmp_pd(x0, z0, _CMP_GE_OQ);
+
+		__m256d i1 = _mm256_and_pd(_mm256_and_pd(a, _mm256_or_pd(b, c)), one);
+		__m256d j1 = _mm256_and_pd(_mm256_andnot_pd(a, b), one);
+		__m256d k1 = _mm256_and_pd(_mm256_andnot_pd(b, _mm256_andnot_pd(_mm256_and_pd(a, c), one)), one);
+		__m256d i2 = _mm256_and_pd(_mm256_or_pd(a, c), one);
+		__m256d j2 = _mm256_and_pd(_mm256_or_pd(b, _mm256_andnot_pd(a, one)), one);
+		__m256d k2 = _mm256_andnot_pd(_mm256_and_pd(b, _mm256_or_pd(a, c)), one);
+
+		__m256d x1 = _mm256_add_pd(_mm256_sub_pd(x0, i1), _mm256_set1_pd(G3));
+		__m256d y1 = _mm256_add_pd(_mm256_sub_pd(y0, j1), _mm256_set1_pd(G3));
+		__m256d z1 = _mm256_add_pd(_mm256_sub_pd(z0, k1), _mm256_set1_pd(G3));
+		__m256d x2 = _mm256_add_pd(_mm256_sub_pd(x0, i2), _mm256_set1_pd(2.0*G3));
+		__m256d y2 = _mm256_add_pd(_mm256_sub_pd(y0, j2), _mm256_set1_pd(2.0*G3));
+		__m256d z2 = _mm256_add_pd(_mm256_sub_pd(z0, k2), _mm256_set1_pd(2.0*G3));
+		__m256d x3 = _mm256_add_pd(_mm256_sub_pd(x0, one), _mm256_set1_pd(3.0*G3));
+		__m256d y3 = _mm256_add_pd(_mm256_sub_pd(y0, one), _mm256_set1_pd(3.0*G3));
+		__m256d z3 = _mm256_add_pd(_mm256_sub_pd(z0, one), _mm256_set1_pd(3.0*G3));
+
+		__m128i ii = _mm_and_si128(i, wrap);
+		__m128i jj = _mm_and_si128(j, wrap);
+		__m128i kk = _mm_and_si128(k, wrap);
+
+		__m128i gi0 = perm3_mod12(ii, jj, kk);
+		__m128i gi1 = perm3_mod12(_mm_add_epi32(ii, _mm256_cvttpd_epi32(i1)), _mm_add_epi32(jj, _mm256_cvttpd_epi32(j1)), _mm_add_epi32(kk, _mm256_cvttpd_epi32(k1)));
+		__m128i gi2 = perm3_mod12(_mm_add_epi32(ii, _mm256_cvttpd_epi32(i2)), _mm_add_epi32(jj, _mm256_cvttpd_epi32(j2)), _mm_add_epi32(kk, _mm256_cvttpd_epi32(k2)));
+		__m128i gi3 = perm3_mod12(_mm_add_epi32(ii, one_i), _mm_add_epi32(jj, one_i), _mm_add_epi32(kk, one_i));
+
+		__m256d sum = _mm256_add_pd(_mm256_add_pd(_mm256_add_pd(
+			corner4(gi0, x0, y0, z0),
+			corner4(gi1, x1, y1, z1)),
+			corner4(gi2, x2, y2, z2)),
+			corner4(gi3, x3, y3, z3));
+
+		_mm256_storeu_pd(out + p, _mm256_mul_pd(_mm256_set1_pd(32.0), sum));
+	}
+
+	if (p < n) {
+		/* Pad the tail out to a full vector rather than carrying a second scalar kernel */
+		double tail_in[12] = {0.0}, tail_out[4];
+
+		for (size_t q = 0; q < (n - p)*3; q++)
+			tail_in[q] = xyz[p*3 + q];
+
+		simplex_many_avx2(tail_in, 4, tail_out);
+
+		for (size_t q = 0; q < n - p; q++)
+			out[p + q] = tail_out[q];
+	}
+}
+
+simplex_batch_func simplex_avx2_kernel() {
+	if (!cpu_has_avx2())
+		return NULL;
+
+	for (int i = 0; i < 512; i++) {
+		perm32[i] = perm[i];
+		perm_mod12[i] = perm[i] % 12;
+	}
+
+	for (int i = 0; i < 12; i++) {
+		grad_x[i] = (float)grad3[i][0];
+		grad_y[i] = (float)grad3[i][1];
+		grad_z[i] = (float)grad3[i][2];
+	}
+
+	return simplex_many_avx2;
+}
+
+#else
+
+simplex_batch_func simplex_avx2_kernel() {
+	return NULL;
+}
+
+#endif
@@ -1,5 +1,7 @@
 
 #include <math.h>
+#include <thread>
+#include <vector>
 
 #include "../noise/generator.h"
 
@@ -42,9 +44,139 @@ void vec_sub(double *v1, double *v2) {
 		v1[i] -= v2[i];
 }
 
+static void generate_height_run(noise_generator *gen, const double *points, size_t n, int max_octaves, double *heights, double *gradients) {
+	if (gradients)
+		noise_generate_batch_gradient_truncated(gen, points, n, max_octaves, heights, gradients);
+	else
+		noise_generate_batch_truncated(gen, points, n, max_octaves, heights);
+}
+
+/* Evaluates the height (and, given gradients, the gradient) at each of n
+ * points, handing contiguous runs of them to up to `threads` threads. Zero or
+ * less uses one thread per core. */
+static void generate_heights(noise_generator *gen, const double *points, size_t n, int max_octaves, int threads, double *heights, double *gradients) {
+	/* not worth a thread for less than a row or two of a tile */
+	const size_t min_run = 64;
+
+	if (threads <= 0)
+		threads = std::thread::hardware_concurrency();
+	if ((size_t)threads > n / min_run)
+		threads = n / min_run;
+
+	if (threads <= 1) {
+		generate_height_run(gen, points, n, max_octaves, heights, gradients);
+		return;
+	}
+
+	size_t chunk = (n + threads - 1) / threads;
+
+	std::vector<std::thread> workers;
+
+	for (size_t start = chunk; start < n; start += chunk) {
+		size_t count = (n - start < chunk) ? n - start : chunk;
+		double *g = gradients ? gradients + start*3 : NULL;
+
+		try {
+			workers.push_back(std::thread(generate_height_run, gen, points + start*3, count, max_octaves, heights + start, g));
+		} catch (...) {
+			/* out of threads, so evaluate this run here */
+			generate_height_run(gen, points + start*3, count, max_octaves, heights + start, g);
+		}
+	}
+
+	/* the calling thread takes the first run */
+	generate_height_run(gen, points, chunk, max_octaves, heights, gradients);
+
+	for (size_t t = 0; t < workers.size(); t++)
+		workers[t].join();
+}
 
-void generate_vertices(double center[3], double v0[3], double v1[3], double v2[3], double v3[3], int size, float *vertices, double radius, double scale, void *params) {
-	double lo[3], hi[3], v[3];
+/* As generate_heights, except that only the points whose height is NaN are
+ * evaluated. The rest, and their gradients, are taken as already known. */
+static void fill_heights(noise_generator *gen, const double *points, size_t n, int max_octaves, int threads, double *heights, double *gradients) {
+	std::vector<size_t> missing;
+
+	for (size_t k = 0; k < n; k++) {
+		if (isnan(heights[k]))
+			missing.push_back(k);
+	}
+
+	if (missing.size() == n) {
+		generate_heights(gen, points, n, max_octaves, threads, heights, gradients);
+		return;
+	}
+
+	size_t m = missing.size();
+
+	if (m == 0)
+		return;
+
+	std::vector<double> packed(m*3), values(m), packed_gradients(gradients ? m*3 : 0);
+
+	for (size_t q = 0; q < m; q++) {
+		for (int c = 0; c < 3; c++)
+			packed[q*3+c] = points[missing[q]*3+c];
+	}
+
+	generate_heights(gen, &packed[0], m, max_octaves, threads, &values[0], gradients ? &packed_gradients[0] : NULL);
+
+	for (size_t q = 0; q < m; q++) {
+		heights[missing[q]] = values[q];
+
+		if (gradients) {
+			for (int c = 0; c < 3; c++)
+				gradients[missing[q]*3+c] = packed_gradients[q*3+c];
+		}
+	}
+}
+
+/* As fill_heights over a size*size grid, but with the outer ring of points
+ * summing edge_octaves rather than max_octaves. Tiles of different levels
+ * sum different numbers of octaves, so they only agree on the vertices along
+ * the edges they share if those are evaluated the same way by all of them. */
+static void fill_tile_heights(noise_generator *gen, const double *points, int size, int max_octaves, int edge_octaves, int threads, double *heights, double *gradients) {
+	size_t n = (size_t)size*size;
+
+	if (edge_octaves != max_octaves) {
+		std::vector<double> ring(n, 0.0), ring_gradients;
+
+		/* everything but the ring reads as known, so only the ring is evaluated */
+		for (int j = 0; j < size; j++) {
+			for (int i = 0; i < size; i++) {
+				if (i == 0 || j == 0 || i == size - 1 || j == size - 1)
+					ring[j*size + i] = heights[j*size + i];
+			}
+		}
+
+		if (gradients)
+			ring_gradients.assign(gradients, gradients + n*3);
+
+		fill_heights(gen, points, n, edge_octaves, threads, &ring[0], gradients ? &ring_gradients[0] : NULL);
+
+		for (int j = 0; j < size; j++) {
+			for (int i = 0; i < size; i++) {
+				size_t k = j*size + i;
+
+				if (!(i == 0 || j == 0 || i == size - 1 || j == size - 1))
+					continue;
+
+				heights[k] = ring[k];
+
+				if (gradients) {
+					for (int c = 0; c < 3; c++)
+						gradients[k*3+c] = ring_gradients[k*3+c];
+				}
+			}
+		}
+	}
+
+	fill_heights(gen, points, n, max_octaves, threads, heights, gradients);
+}
+
+/* The unit sphere directions of a size*size grid over the tile v0..v3, with i
+ * running from v0 towards v3 and j from v0 towards v1 */
+static void tile_points(double v0[3], double v1[3], double v2[3], double v3[3], int size, double *points) {
+	double lo[3], hi[3];
 
 	int size1 = size - 1;
 
@@ -55,25 +187,146 @@ void generate_vertices(double center[3], double v0[3], double v1[3], double v2[3
 		vec_lerp(v1, v2, i/(double)(size1), hi);
 
 		for (j = 0; j < size; j++) {
-			vec_lerp(lo, hi, j/(double)(size1), v);
+			k = (j*size + i) * 3;
 
-			cube_to_sphere(v);
+			vec_lerp(lo, hi, j/(double)(size1), &points[k]);
 
-			double h = noise_generate((noise_generator *)params, v[0], v[1], v[2]);
+			cube_to_sphere(&points[k]);
+		}
+	}
+}
 
-			h = (h < -1.0) ? -1.0 : h;
-			h = (h > 1.0) ? 1.0 : h;
+/* max_octaves caps the octaves summed by fractal generators, and edge_octaves
+ * those summed along the outer ring of vertices; negative leaves them all in.
+ * The heights are evaluated across `threads` threads, or one per core if zero.
+ *
+ * heights, if not NULL, holds the raw noise value for each of the size*size
+ * vertices. Entries other than NaN are used as they are instead of being
+ * evaluated, and on return every entry is filled in. */
+void generate_vertices(double center[3], double v0[3], double v1[3], double v2[3], double v3[3], int size, float *vertices, double radius, double scale, void *params, int max_octaves, int edge_octaves, int threads, double *heights) {
+	double v[3];
 
-			vec_mulf(v, radius + h*scale);
+	int k;
 
-			vec_sub(v, center);
+	std::vector<double> points(size*size*3), local;
 
-			k = (j*size + i) * 3;
+	if (!heights) {
+		local.assign(size*size, NAN);
+		heights = &local[0];
+	}
 
-			vertices[k+0] = v[0];
-			vertices[k+1] = v[1];
-			vertices[k+2] = v[2];
-		}
+	tile_points(v0, v1, v2, v3, size, &points[0]);
+
+	fill_tile_heights((noise_generator *)params, &points[0], size, max_octaves, edge_octaves, threads, heights, NULL);
+
+	for (k = 0; k < size*size; k++) {
+		double h = heights[k];
+
+		h = (h < -1.0) ? -1.0 : h;
+		h = (h > 1.0) ? 1.0 : h;
+
+		v[0] = points[k*3+0];
+		v[1] = points[k*3+1];
+		v[2] = points[k*3+2];
+
+		vec_mulf(v, radius + h*scale);
+
+		vec_sub(v, center);
+
+		vertices[k*3+0] = v[0];
+		vertices[k*3+1] = v[1];
+		vertices[k*3+2] = v[2];
+	}
+}
+
+/* As generate_vertices, but writes six floats per vertex: the position followed
+ * by the surface normal, taken from the analytic gradient of the height field.
+ * gradients holds the noise gradient for each vertex alongside heights, and is
+ * read and filled in the same way. Either both are given or neither. */
+void generate_vertices_with_normals(double center[3], double v0[3], double v1[3], double v2[3], double v3[3], int size, float *vertices, double radius, double scale, void *params, int max_octaves, int edge_octaves, int threads, double *heights, double *gradients) {
+	double v[3];
+
+	int i, k;
+
+	std::vector<double> points(size*size*3), local, local_gradients;
+
+	if (!heights || !gradients) {
+		local.assign(size*size, NAN);
+		local_gradients.resize(size*size*3);
+		heights = &local[0];
+		gradients = &local_gradients[0];
+	}
+
+	tile_points(v0, v1, v2, v3, size, &points[0]);
+
+	fill_tile_heights((noise_generator *)params, &points[0], size, max_octaves, edge_octaves, threads, heights, gradients);
+
+	for (k = 0; k < size*size; k++) {
+		double *d = &points[k*3];
+		double h = heights[k];
+		double g[3] = {gradients[k*3+0], gradients[k*3+1], gradients[k*3+2]};
+
+		/* the clamped plateaus are flat */
+		if (h < -1.0 || h > 1.0)
+			g[0] = g[1] = g[2] = 0.0;
+
+		h = (h < -1.0) ? -1.0 : h;
+		h = (h > 1.0) ? 1.0 : h;
+
+		double r = radius + h*scale;
+
+		/* for a surface r(d)*d, the normal is d minus the tangential part of grad(r) over r */
+		double gd = g[0]*d[0] + g[1]*d[1] + g[2]*d[2];
+		double n[3];
+
+		for (i = 0; i < 3; i++)
+			n[i] = d[i] - (scale/r) * (g[i] - gd*d[i]);
+
+		vec_normalise(n);
+
+		v[0] = d[0];
+		v[1] = d[1];
+		v[2] = d[2];
+
+		vec_mulf(v, r);
+
+		vec_sub(v, center);
+
+		vertices[k*6+0] = v[0];
+		vertices[k*6+1] = v[1];
+		vertices[k*6+2] = v[2];
+		vertices[k*6+3] = n[0];
+		vertices[k*6+4] = n[1];
+		vertices[k*6+5] = n[2];
+	}
+}
+
+/* As generate_vertices, but writes only each vertex's height, clamped to
+ * [-1, 1], leaving the position to be rebuilt from the tile's corners when it
+ * is drawn. With packed set the heights are signed normalised shorts rather
+ * than floats. */
+void generate_vertex_heights(double v0[3], double v1[3], double v2[3], double v3[3], int size, void *vertices, int packed, void *params, int max_octaves, int edge_octaves, int threads, double *heights) {
+	std::vector<double> points(size*size*3), local;
+
+	if (!heights) {
+		local.assign(size*size, NAN);
+		heights = &local[0];
+	}
+
+	tile_points(v0, v1, v2, v3, size, &points[0]);
+
+	fill_tile_heights((noise_generator *)params, &points[0], size, max_octaves, edge_octaves, threads, heights, NULL);
+
+	for (int k = 0; k < size*size; k++) {
+		double h = heights[k];
+
+		h = (h < -1.0) ? -1.0 : h;
+		h = (h > 1.0) ? 1.0 : h;
+
+		if (packed)
+			((short *)vertices)[k] = (short)lround(h*32767.0);
+		else
+			((float *)vertices)[k] = h;
 	}
 }
 
@@ -88,4 +341,35 @@ double query_height(double v[3], double radius, double scale, void *params) {
 	return radius + h*scale;
 }
 
+double query_height_truncated(double v[3], double radius, double scale, void *params, int max_octaves) {
+	double h;
+
+	vec_normalise(v);
+
+	noise_generate_batch_truncated((noise_generator *)params, v, 1, max_octaves, &h);
+
+	h = (h < -1.0) ? -1.0 : h;
+	h = (h > 1.0) ? 1.0 : h;
+
+	return radius + h*scale;
+}
+
+void query_heights(const double *v, size_t n, double radius, double scale, void *params, double *heights) {
+	std::vector<double> points(v, v + n*3);
+
+	for (size_t p = 0; p < n; p++)
+		vec_normalise(&points[p*3]);
+
+	noise_generate_batch((noise_generator *)params, n ? &points[0] : NULL, n, heights);
+
+	for (size_t p = 0; p < n; p++) {
+		double h = heights[p];
+
+		h = (h < -1.0) ? -1.0 : h;
+		h = (h > 1.0) ? 1.0 : h;
+
+		heights[p] = radius + h*scale;
+	}
+}
+
 }
@@ -8,6 +8,11 @@ import math
 
 import time
 import operator
+import heapq
+import itertools
+import weakref
+
+import numpy
 
 from . import utility
 from .utility import lerp, cube_to_sphere
@@ -22,33 +27,208 @@ planet_c = CDLL(os.getcwd() + native_library('/build/planet', 'planet_c'))
 query_height = planet_c.query_height
 query_height.argtypes = [c_double*3, c_double, c_double, c_void_p]
 query_height.restype = c_double
+
+query_height_truncated = planet_c.query_height_truncated
+query_height_truncated.argtypes = [c_double*3, c_double, c_double, c_void_p, c_int]
+query_height_truncated.restype = c_double
 #
 
 
-class Tile:
+class TileStore(object):
+    # Every tile's data, a row per tile in arrays that double in length as
+    # they fill, with Tile handles pointing into them. A released tile's row
+    # is only reused once the last reference to its handle is gone, so that
+    # a build still running for a cancelled tile never reads another's data.
+    def __init__(self, capacity=64):
+        self.capacity = 0
+        self.size = 0
+        self.free = []
+
+        # the live handle for each row, None once released
+        self.handles = []
+
+        # -1 in any of the integer arrays stands for None
+        self.columns = {
+            'center': ((3,), numpy.float64),
+            'corners': ((4, 3), numpy.float64),
+            'radius': ((), numpy.float64),
+            'level': ((), numpy.int16),
+            'lod': ((), numpy.int16),
+            'face': ((), numpy.int8),
+            'quadrant': ((), numpy.int8),
+            'x': ((), numpy.int32),
+            'y': ((), numpy.int32),
+            'parent': ((), numpy.int32),
+            'children': ((4,), numpy.int32),
+            'edges': ((4,), numpy.int32),
+            'visible': ((), numpy.bool_),
+            # in the tree, rather than waiting on a split or released
+            'attached': ((), numpy.bool_),
+        }
+
+        for name, (shape, dtype) in self.columns.items():
+            setattr(self, name, numpy.zeros((0,) + shape, dtype))
+
+        self.grow(capacity)
+
+    def __len__(self):
+        return self.size - len(self.free)
+
+    def grow(self, capacity):
+        for name, (shape, dtype) in self.columns.items():
+            column = numpy.zeros((capacity,) + shape, dtype)
+            column[:self.capacity] = getattr(self, name)
+            setattr(self, name, column)
+
+        self.handles.extend([None]*(capacity - self.capacity))
+        self.capacity = capacity
+
+    def allocate(self, tile):
+        if self.free:
+            index = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self.grow(self.capacity*2)
+
+            index = self.size
+            self.size += 1
+
+        for name in ['face', 'quadrant', 'parent', 'children', 'edges']:
+            getattr(self, name)[index] = -1
+        self.visible[index] = False
+        self.attached[index] = False
+
+        self.handles[index] = tile
+
+        return index
+
+    def release(self, tile):
+        self.handles[tile.index] = None
+        self.attached[tile.index] = False
+
+        weakref.finalize(tile, self.free.append, tile.index)
+
+    def tile(self, index):
+        return None if index < 0 else self.handles[index]
+
+    def bytes(self):
+        return sum(getattr(self, name).nbytes for name in self.columns)
+
+
+class TileLinks(object):
+    # A tile's children or edges, as a list of four tiles or None, read and
+    # written through the store
+    __slots__ = ['store', 'links', 'row']
+
+    def __init__(self, store, links, row):
+        self.store = store
+        self.links = links
+        self.row = row
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, i):
+        return self.store.tile(self.links[self.row, i])
+
+    def __setitem__(self, i, tile):
+        self.links[self.row, i] = -1 if tile is None else tile.index
+
+    def __iter__(self):
+        return iter([self.store.tile(i) for i in self.links[self.row].tolist()])
+
+    def __contains__(self, tile):
+        return tile is not None and tile.index in self.links[self.row].tolist()
+
+    def index(self, tile):
+        return self.links[self.row].tolist().index(tile.index)
+
+
+class Tile(object):
+    # The parent is held by its handle as well as by row, so that its row
+    # isn't reused while a build for one of its children is still running
+    __slots__ = ['store', 'index', 'parent', '__weakref__']
+
     def __init__(self, v1, v2, v3, v4, planet, parent=None):
+        self.store = planet.tiles
+        self.index = self.store.allocate(self)
         self.parent = parent
-        self.corners = [v1, v2, v3, v4]
 
-        self.level = (1 if parent == None else parent.level + 1)
+        store, i = self.store, self.index
+
+        store.parent[i] = -1 if parent == None else parent.index
+        store.corners[i] = [tuple(v1), tuple(v2), tuple(v3), tuple(v4)]
+
+        store.level[i] = (1 if parent == None else parent.level + 1)
+
+        # the cube face and the tile's position on it at this level, with x
+        # running from the face's first corner towards its fourth and y
+        # towards its second; the quadrant is which of its parent's children
+        # this is, once subdivide has placed it
+        store.face[i] = -1 if parent == None else store.face[parent.index]
+        store.x[i] = 0
+        store.y[i] = 0
+
+        center = cube_to_sphere(lerp(v1, v3, 0.5))
+        store.center[i] = tuple(center*planet.get_height(center))
+
+        arc_length = math.pi*planet.radius / math.pow(2.0, store.level[i]+1)
+        store.radius[i] = math.sqrt(2 * arc_length**2)
+
+        store.lod[i] = int(math.log(arc_length*2) / math.log(2))
+
+    def small(name, none=False):
+        # a single number column, with -1 read as None where none is set
+        def getter(self):
+            value = getattr(self.store, name)[self.index].item()
+            return None if none and value < 0 else value
+
+        def setter(self, value):
+            getattr(self.store, name)[self.index] = -1 if value is None else value
 
-        self.center = cube_to_sphere(lerp(v1, v3, 0.5))
-        self.center *= planet.get_height(self.center)
+        return property(getter, setter)
 
-        arc_length = math.pi*planet.radius / math.pow(2.0, self.level+1)
-        self.radius = math.sqrt(2 * arc_length**2)
+    level = small('level')
+    lod = small('lod')
+    radius = small('radius')
+    face = small('face', True)
+    quadrant = small('quadrant', True)
+    x = small('x')
+    y = small('y')
+    visible = small('visible')
 
-        self.lod = int(math.log(arc_length*2) / math.log(2))
+    del small
 
-        self.model = Matrix4.new_translate(*self.center)
+    @property
+    def corners(self):
+        return [Vector3(*c) for c in self.store.corners[self.index].tolist()]
 
-        self.children = [None]*4
-        self.edges = [None]*4
+    @property
+    def center(self):
+        return Vector3(*self.store.center[self.index].tolist())
 
-        self.visible = False
+    @property
+    def model(self):
+        return Matrix4.new_translate(*self.store.center[self.index].tolist())
+
+    @property
+    def children(self):
+        return TileLinks(self.store, self.store.children, self.index)
+
+    @children.setter
+    def children(self, tiles):
+        for i, t in enumerate(tiles):
+            self.store.children[self.index, i] = -1 if t is None else t.index
+
+    @property
+    def edges(self):
+        return TileLinks(self.store, self.store.edges, self.index)
+
+    def address(self):
+        return (self.face, self.level, self.x, self.y)
 
     def is_parent(self):
-        return self.children[0] != None
+        return self.store.children[self.index, 0] >= 0
 
     def is_grandparent(self):
         if not self.is_parent():
@@ -59,6 +239,103 @@ class Tile:
         return False
 
 
+class LODStats(object):
+    def __init__(self):
+        # seconds a frame allowed, and spent, on uploads, splits and merges
+        self.budget = 0.0
+        self.spent = 0.0
+
+        # tiles being split or merged
+        self.pending = 0
+
+        # running averages of the seconds it takes to start a split or a
+        # merge, and to upload one factory's patch for a tile
+        self.split_cost = 0.0002
+        self.merge_cost = 0.0001
+        self.upload_cost = 0.0005
+
+        # seconds it last took to reach the level of detail the camera asked
+        # for, from the frame it first asked for something different
+        self.latency = 0.0
+
+
+class TileQueue(object):
+    # Tiles waiting to cross a split or merge threshold, ordered by how far
+    # the camera has to travel before each one could. margins(tiles) gives
+    # the metres each has to go, negative once crossed. The camera can get
+    # no nearer to or further from a tile than it has moved, so a tile is
+    # only looked at again once the camera's total travel passes the point
+    # it was queued for. A still camera costs nothing however many tiles are
+    # waiting.
+    def __init__(self, margins):
+        self.margins = margins
+
+        self.heap = []
+        self.keys = {}
+        self.order = itertools.count()
+
+        # tiles past the threshold, checked every frame until they go back
+        self.crossed = {}
+
+    def __len__(self):
+        return len(self.keys) + len(self.crossed)
+
+    def add(self, tiles, travel):
+        for tile, m in zip(tiles, self.margins(tiles).tolist()):
+            if m < 0.0:
+                self.crossed[tile] = None
+                continue
+
+            key = travel + m
+            self.keys[tile] = key
+            heapq.heappush(self.heap, (key, next(self.order), tile))
+
+    def remove(self, tile):
+        # the heap entry is left behind, and skipped when it comes up
+        self.keys.pop(tile, None)
+        self.crossed.pop(tile, None)
+
+        if len(self.heap) > 2*len(self.keys) + 64:
+            self.heap = [e for e in self.heap if self.keys.get(e[2]) == e[0]]
+            heapq.heapify(self.heap)
+
+    def update(self, travel):
+        # looks again at the tiles the camera may have brought across, and
+        # returns the ones now past the threshold
+        due = []
+
+        while self.heap and self.heap[0][0] < travel:
+            key, order, tile = heapq.heappop(self.heap)
+
+            if self.keys.get(tile) == key:
+                del self.keys[tile]
+                due.append(tile)
+
+        crossed = list(self.crossed)
+        for tile, m in zip(crossed, self.margins(crossed).tolist()):
+            if m >= 0.0:
+                del self.crossed[tile]
+                due.append(tile)
+
+        self.add(due, travel)
+
+        return self.crossed
+
+    def reset(self, travel):
+        # every margin has changed, as when the field of view does
+        tiles = list(self.keys) + list(self.crossed)
+
+        self.heap = []
+        self.keys = {}
+        self.crossed = {}
+
+        self.add(tiles, travel)
+
+
+def average(mean, value, weight=0.1):
+    return mean + (value - mean)*weight
+
+
 class LODSphere(object):
     def __init__(self, radius, scale, generator):
         self.radius = radius
@@ -68,26 +345,58 @@ class LODSphere(object):
 
         self.gen = generator
 
-        self.parent_list = []
-        self.render_list = []
-
-        v = [
-            Vector3(-1, 1, 1), Vector3(-1, -1,
-                                       1), Vector3(1, -1, 1), Vector3(1, 1, 1),
-            Vector3(1, 1, -1), Vector3(1, -1, -
-                                       1), Vector3(-1, -1, -1), Vector3(-1, 1, -1)
-        ]
-
-        self.root = [
-            Tile(v[3], v[2], v[5], v[4], self),  # right
-            Tile(v[7], v[6], v[1], v[0], self),  # left
-
-            Tile(v[7], v[0], v[3], v[4], self),  # top
-            Tile(v[1], v[6], v[5], v[2], self),  # bottom
-
-            Tile(v[0], v[1], v[2], v[3], self),  # front
-            Tile(v[4], v[5], v[6], v[7], self)  # back
-        ]
+        # every tile's data lives here, whether it's in the tree or not
+        self.tiles = TileStore()
+
+        # both used as ordered sets
+        self.parent_list = {}
+        self.render_list = {}
+
+        # the camera's position and field of view at the last update, and
+        # how far it has moved in all, that the split and merge queues are
+        # measured against
+        self.viewer = None
+        self.fovy = None
+        self.travel = 0.0
+
+        self.split_queue = TileQueue(self.split_margins)
+        self.merge_queue = TileQueue(self.merge_margins)
+
+        # tiles whose children, or whose own patch, are still being built; they
+        # keep their current place in the tree until every factory is ready
+        self.splitting = {}
+        self.merging = set()
+
+        # Seconds per frame spent on uploading finished patches, then on
+        # starting as many splits and merges as fit in what's left. New work
+        # also waits while the patches already in flight would take more than
+        # queue_frames frames' budgets to upload, or while max_pending tiles
+        # are being split or merged.
+        self.budget = 0.004
+        self.queue_frames = 4
+        self.max_pending = 32
+
+        self.stats = LODStats()
+        self.unsettled_since = None
+
+        # After a regenerate, every tile's patches are rebuilt in the
+        # background, nearest visible tiles first, while the stale ones go on
+        # being drawn. Tiles wait in rebuild_queue until one of rebuild_jobs
+        # places is free, then in rebuilding until their factories are done;
+        # both map a tile to the factories it's waiting on. The factories get
+        # rebuild_budget more seconds a frame for uploads while it lasts.
+        self.rebuild_queue = {}
+        self.rebuilding = {}
+        self.rebuild_jobs = os.cpu_count() or 1
+        self.rebuild_budget = 0.004
+
+        v = utility.cube_corners
+
+        self.root = [Tile(*[v[i] for i in face], self) for face in utility.cube_faces]
+
+        for face, t in enumerate(self.root):
+            t.face = face
+            self.tiles.attached[t.index] = True
 
         for t in self.root:
             for i in range(4):
@@ -100,15 +409,79 @@ class LODSphere(object):
                             t.edges[i] = s
 
         for t in self.root:
-            self.render_list.append(t)
+            self.activate(t)
 
         self.factories = []
 
+    def cancel_rebuilds(self):
+        # drops the rebuilds left from an earlier regenerate; splits and merges
+        # carry on, and the factories build again any they generated before
+        # the generator changed
+        for t in list(self.rebuilding) + list(self.rebuild_queue):
+            self.cancel_rebuild(t)
+
     def regenerate(self):
+        self.cancel_rebuilds()
+
+        for f in self.factories:
+            f.invalidate()
+
         for t in self.render_list:
+            self.rebuild_queue[t] = list(self.factories)
+
+        # split tiles only have patches with some factories
+        keepers = [f for f in self.factories if f.parent_patches]
+        if keepers:
+            for t in self.parent_list:
+                for p in [t] + list(self.ancestors(t)):
+                    self.rebuild_queue.setdefault(p, list(keepers))
+
+        # splits and merges carry on, but the patches they have already got
+        # are built again before they finish
+        for children in self.splitting.values():
+            for t in children:
+                for f in self.factories:
+                    if f.is_patch_ready(t):
+                        f.rebuild_patch(t)
+
+        for t in self.merging:
             for f in self.factories:
-                f.destroy_patch(t)
-                f.build_patch(t)
+                if not f.parent_patches and f.is_patch_ready(t):
+                    f.rebuild_patch(t)
+
+    def ancestors(self, tile):
+        while tile.parent is not None:
+            tile = tile.parent
+            yield tile
+
+    def cancel_rebuild(self, tile, factories=None):
+        # forgets tile's rebuilds, for the given factories or all of them
+        for pending in [self.rebuild_queue, self.rebuilding]:
+            waiting = pending.get(tile)
+            if not waiting:
+                continue
+
+            for f in [f for f in waiting if factories is None or f in factories]:
+                waiting.remove(f)
+
+                if pending is self.rebuilding and not f.is_patch_ready(tile):
+                    f.cancel_patch(tile)
+
+            if not waiting:
+                del pending[tile]
+
+    def start_rebuilds(self, viewer):
+        free = self.rebuild_jobs - len(self.rebuilding)
+        if free <= 0 or not self.rebuild_queue:
+            return
+
+        for t in sorted(self.rebuild_queue, key=lambda t: (not t.visible, abs(t.center - viewer)))[:free]:
+            factories = self.rebuild_queue.pop(t)
+
+            for f in factories:
+                f.rebuild_patch(t)
+
+            self.rebuilding[t] = factories
 
     def add_factory(self, factory):
         self.factories.append(factory)
@@ -116,6 +489,10 @@ class LODSphere(object):
         for t in self.render_list:
             factory.build_patch(t)
 
+    def wait(self):
+        for f in self.factories:
+            f.wait()
+
     def remove_factory(self, factory):
         self.factories.remove(factory)
 
@@ -181,19 +558,43 @@ class LODSphere(object):
             return False
 
     def recalculate_visibility(self, transform, camera):
+        # The cone test of check_cone_visibility, over every tile at once. A
+        # tile is only visible if its parent is, so each level is masked by
+        # the one above, coarsest first.
         cam_pos = transform.inverse() * camera.transform * Point3()
         cam_dir = transform.inverse() * camera.transform * Vector3(0, 0, -1)
 
-        def recalculate_tile_visibility(tile, override=True):
-            tile.visible = override and self.check_cone_visibility(
-                camera, cam_pos, cam_dir, tile)
+        store = self.tiles
+        n = store.size
 
-            for c in tile.children:
-                if c != None:
-                    recalculate_tile_visibility(c, tile.visible)
+        depth = 1.0 / math.tan(camera.fovy*0.5)
+        corner = math.sqrt((1.0*camera.aspect)**2 + 1.0**2)
+        fov = math.atan(corner/depth)
 
-        for t in self.root:
-            recalculate_tile_visibility(t)
+        Kcos = math.cos(fov)
+        Ksin = math.sin(fov)
+
+        pos = numpy.array(tuple(cam_pos))
+        view = numpy.array(tuple(cam_dir))
+
+        radius = store.radius[:n]
+
+        U = pos[None, :] - (radius/Ksin)[:, None]*view[None, :]
+        D = store.center[:n] - U
+
+        Dsqr = (D*D).sum(axis=1)
+        e = D.dot(view)
+
+        visible = (e > 0) & (e*e >= Dsqr*Kcos*Kcos) & store.attached[:n]
+
+        levels = store.level[:n]
+        parents = store.parent[:n]
+
+        for level in range(2, int(levels.max()) + 1 if n else 0):
+            rows = numpy.nonzero(visible & (levels == level))[0]
+            visible[rows] &= visible[parents[rows]]
+
+        store.visible[:n] = visible
 
     def walk_visible(self, callback):
         def walk_tile(tile):
@@ -223,37 +624,177 @@ class LODSphere(object):
 
         return visible
 
+    def split_distances(self, tiles):
+        # each tile's distance from the viewer, and how close the viewer gets
+        # before the tile's screen size factor drops below one, read from the
+        # store for all of them at once
+        rows = numpy.array([t.index for t in tiles], numpy.int64)
+
+        d = self.tiles.center[rows] - numpy.array(tuple(self.viewer))
+        distance = numpy.sqrt((d*d).sum(axis=1))
+
+        arc_length = math.pi*self.radius / numpy.power(2.0, self.tiles.level[rows])
+
+        return distance, arc_length / (2.0*math.tan(0.5*self.fovy))
+
+    def split_margins(self, tiles):
+        distance, split = self.split_distances(tiles)
+        return distance - split
+
+    def merge_margins(self, tiles):
+        distance, split = self.split_distances(tiles)
+        return split - distance
+
+    def activate(self, tile):
+        self.render_list[tile] = None
+
+        if tile.level < self.max_lod and self.viewer is not None:
+            self.split_queue.add([tile], self.travel)
+
+    def deactivate(self, tile):
+        del self.render_list[tile]
+        self.split_queue.remove(tile)
+
+    def add_parent(self, tile):
+        self.parent_list[tile] = None
+
+        if self.viewer is not None:
+            self.merge_queue.add([tile], self.travel)
+
+    def remove_parent(self, tile):
+        del self.parent_list[tile]
+        self.merge_queue.remove(tile)
+
+    def move_viewer(self, viewer, fovy):
+        if self.viewer is None:
+            self.viewer = viewer
+            self.fovy = fovy
+
+            self.split_queue.add([t for t in self.render_list if t.level < self.max_lod], self.travel)
+            self.merge_queue.add(list(self.parent_list), self.travel)
+            return
+
+        self.travel += abs(viewer - self.viewer)
+        self.viewer = viewer
+
+        if fovy != self.fovy:
+            self.fovy = fovy
+            self.split_queue.reset(self.travel)
+            self.merge_queue.reset(self.travel)
+
     def update(self, transform, camera):
+        start = time.time()
+
         viewer = transform.inverse() * (camera.transform * Point3())
         fovy = camera.fovy
 
-        current = [t for t in self.render_list]
-        parents = [t for t in self.parent_list]
+        self.move_viewer(viewer, fovy)
 
-        divides = []
-        for t in current:
-            size = 2.0*abs(t.center - viewer)*math.tan(0.5*fovy)
-            factor = size/self.arc_length(t)
+        # drop splits and merges the camera has moved back across before they finished
+        splitting = list(self.splitting)
+        for t, m in zip(splitting, self.split_margins(splitting).tolist()):
+            if m > 0.0:
+                self.cancel_subdivide(t)
 
-            if factor < 1.0 and t.level < self.max_lod:
-                divides.append((factor, t))
+        merging = list(self.merging)
+        for t, m in zip(merging, self.merge_margins(merging).tolist()):
+            if m > 0.0:
+                self.cancel_combine(t)
 
-        for f, t in sorted(divides)[:1]:
-            self.subdivide(t)
+        crossed = list(self.split_queue.update(self.travel))
+        distance, split = self.split_distances(crossed)
+
+        divides = []
+        for t, m in zip(crossed, ((distance - split) / split).tolist()):
+            if t not in self.splitting and t.parent not in self.merging:
+                divides.append((m, t))
+
+        crossed = list(self.merge_queue.update(self.travel))
+        distance, split = self.split_distances(crossed)
 
         combines = []
-        for t in parents:
-            size = 2.0*abs(t.center - viewer)*math.tan(0.5*fovy)
-            factor = size/self.arc_length(t)
+        for t, m in zip(crossed, ((split - distance) / split).tolist()):
+            if t not in self.merging and not any(c in self.splitting for c in t.children):
+                combines.append((m, t))
 
-            if factor > 1.0:
-                combines.append((factor, t))
+        if divides or combines or self.splitting or self.merging:
+            if self.unsettled_since is None:
+                self.unsettled_since = start
+        elif self.unsettled_since is not None:
+            self.stats.latency = start - self.unsettled_since
+            self.unsettled_since = None
 
-        for f, t in sorted(combines)[:4]:
-            self.combine(t)
+        self.start_rebuilds(viewer)
+
+        budget = self.budget + (self.rebuild_budget if self.rebuilding else 0.0)
+
+        uploading = time.time()
+        uploaded = 0
+        for f in self.factories:
+            uploaded += f.update(budget - (time.time() - start))
+
+        if uploaded:
+            self.stats.upload_cost = average(self.stats.upload_cost, (time.time() - uploading) / uploaded)
+
+        for t, factories in list(self.rebuilding.items()):
+            if all(f.is_patch_ready(t) for f in factories):
+                del self.rebuilding[t]
+
+        for t, children in list(self.splitting.items()):
+            if all(f.is_patch_ready(c) for f in self.factories for c in children):
+                del self.splitting[t]
+                self.attach_children(t, children)
+
+        for t in list(self.merging):
+            if all(f.is_patch_ready(t) for f in self.factories):
+                self.merging.remove(t)
+                self.detach_children(t)
+
+        # the most needed splits first, then the most overdue merges, as those
+        # furthest past their thresholds relative to their size
+        work = [(self.subdivide, 4, t) for m, t in sorted(divides, key=lambda d: d[0])]
+        work += [(self.combine, 1, t) for m, t in sorted(combines, key=lambda c: c[0])]
+
+        self.schedule(work, start + budget)
+
+        self.stats.budget = budget
+        self.stats.spent = time.time() - start
+        self.stats.pending = len(self.splitting) + len(self.merging)
+
+    def schedule(self, work, deadline):
+        # Starts (action, patches, tile) work in order until the budget or the
+        # queue runs out. Something is always started while nothing is under
+        # way, so that a slow estimate can't stall the sphere altogether.
+        stats = self.stats
+
+        queued = (4*len(self.splitting) + len(self.merging))*len(self.factories)*stats.upload_cost
+
+        for action, patches, t in work:
+            busy = self.splitting or self.merging
+
+            if len(self.splitting) + len(self.merging) >= self.max_pending:
+                break
+
+            uploads = patches*len(self.factories)*stats.upload_cost
+            if busy and queued + uploads > self.budget*self.queue_frames:
+                break
+
+            cost = stats.split_cost if action == self.subdivide else stats.merge_cost
+            if busy and time.time() + cost > deadline:
+                break
+
+            begun = time.time()
+            action(t)
+
+            if action == self.subdivide:
+                stats.split_cost = average(stats.split_cost, time.time() - begun)
+            else:
+                stats.merge_cost = average(stats.merge_cost, time.time() - begun)
+
+            queued += uploads
 
     def subdivide(self, tile):
-        if tile.is_parent():
+        if tile.is_parent() or tile in self.splitting:
             return
 
         v = [
@@ -266,10 +807,35 @@ class LODSphere(object):
                 tile.corners[1], tile.corners[2], 0.5), tile.corners[2]
         ]
 
-        tile.children[0] = Tile(v[0], v[3], v[4], v[1], self, tile)
-        tile.children[1] = Tile(v[3], v[6], v[7], v[4], self, tile)
-        tile.children[2] = Tile(v[4], v[7], v[8], v[5], self, tile)
-        tile.children[3] = Tile(v[1], v[4], v[5], v[2], self, tile)
+        children = [
+            Tile(v[0], v[3], v[4], v[1], self, tile),
+            Tile(v[3], v[6], v[7], v[4], self, tile),
+            Tile(v[4], v[7], v[8], v[5], self, tile),
+            Tile(v[1], v[4], v[5], v[2], self, tile)
+        ]
+
+        for i, t in enumerate(children):
+            dx, dy = [(0, 0), (0, 1), (1, 1), (1, 0)][i]
+
+            t.quadrant = i
+            t.x = tile.x*2 + dx
+            t.y = tile.y*2 + dy
+
+        for t in children:
+            for f in self.factories:
+                f.request_patch(t)
+
+        self.splitting[tile] = children
+
+    def cancel_subdivide(self, tile):
+        for t in self.splitting.pop(tile):
+            for f in self.factories:
+                f.cancel_patch(t)
+
+            self.tiles.release(t)
+
+    def attach_children(self, tile, children):
+        tile.children = children
 
         for t, i in zip(tile.children, list(range(4))):
             j = (i + 1) % 4
@@ -279,38 +845,43 @@ class LODSphere(object):
             t.edges[j] = tile.children[j]
             t.edges[k] = tile.children[l]
 
+            # corners are built from the store on each read, so fetched once
+            corners = t.corners
+
             if tile.edges[i] != None and tile.edges[i].is_parent():
                 for s in tile.edges[i].children:
+                    other = s.corners
                     for o in range(4):
                         p = (o + 1) % 4
-                        if (s.corners[o] == t.corners[i] and s.corners[p] == t.corners[j]):
+                        if (other[o] == corners[i] and other[p] == corners[j]):
                             t.edges[i] = s
                             s.edges[p] = t
-                        elif (s.corners[o] == t.corners[j] and s.corners[p] == t.corners[i]):
+                        elif (other[o] == corners[j] and other[p] == corners[i]):
                             t.edges[i] = s
                             s.edges[o] = t
 
             if tile.edges[l] != None and tile.edges[l].is_parent():
                 for s in tile.edges[l].children:
+                    other = s.corners
                     for o in range(4):
                         p = (o + 1) % 4
-                        if (s.corners[o] == t.corners[l] and s.corners[p] == t.corners[i]):
+                        if (other[o] == corners[l] and other[p] == corners[i]):
                             t.edges[l] = s
                             s.edges[p] = t
-                        elif (s.corners[o] == t.corners[i] and s.corners[p] == t.corners[l]):
+                        elif (other[o] == corners[i] and other[p] == corners[l]):
                             t.edges[l] = s
                             s.edges[o] = t
 
-            for f in self.factories:
-                f.build_patch(t)
-
-            self.render_list.append(t)
+            self.tiles.attached[t.index] = True
+            self.activate(t)
 
-        self.render_list.remove(tile)
-        self.parent_list.append(tile)
+        self.deactivate(tile)
+        self.add_parent(tile)
 
         if tile.parent != None and tile.parent in self.parent_list:
-            self.parent_list.remove(tile.parent)
+            self.remove_parent(tile.parent)
+
+        self.cancel_rebuild(tile, [f for f in self.factories if not f.parent_patches])
 
         for f in self.factories:
             f.divide_patch(tile)
@@ -321,17 +892,29 @@ class LODSphere(object):
         # self.stats.texture_memory = len(self.render_list) * (self.terrain.tex_size**2) * 4
 
     def combine(self, tile):
-        if not tile.is_parent() or tile.is_grandparent():
+        if not tile.is_parent() or tile.is_grandparent() or tile in self.merging or any(c in self.splitting for c in tile.children):
             return
 
         for f in self.factories:
             f.combine_patch(tile)
 
+        self.merging.add(tile)
+
+    def cancel_combine(self, tile):
+        self.merging.remove(tile)
+
+        for f in self.factories:
+            if f.is_patch_ready(tile):
+                f.divide_patch(tile)
+            else:
+                f.cancel_patch(tile)
+
+    def detach_children(self, tile):
         if tile.parent != None and not tile.parent in self.parent_list:
-            self.parent_list.append(tile.parent)
+            self.add_parent(tile.parent)
 
-        self.parent_list.remove(tile)
-        self.render_list.append(tile)
+        self.remove_parent(tile)
+        self.activate(tile)
 
         for t in tile.children:
             for i in range(4):
@@ -339,10 +922,13 @@ class LODSphere(object):
                     s = t.edges[i].edges.index(t)
                     t.edges[i].edges[s] = None
 
+            self.cancel_rebuild(t)
+
             for f in self.factories:
                 f.destroy_patch(t)
 
-            self.render_list.remove(t)
+            self.deactivate(t)
+            self.tiles.release(t)
 
         tile.children = [None]*4
 
@@ -351,5 +937,12 @@ class LODSphere(object):
         # self.stats.vbo_memory = len(self.render_list) * (self.terrain.tile_size)**2 * 3*4
         # self.stats.texture_memory = len(self.render_list) * (self.terrain.tex_size**2) * 4
 
-    def get_height(self, v):
-        return query_height((c_double*3)(*v), self.radius, self.scale, self.gen.c_generator())
+    def get_height(self, v, tolerance=None):
+        # With a tolerance in metres, only as many octaves are summed as it
+        # takes to stay within it of the full height
+        if tolerance is None:
+            return query_height((c_double*3)(*v), self.radius, self.scale, self.gen.c_generator())
+
+        octaves = self.gen.octaves_for_error(tolerance / self.scale)
+
+        return query_height_truncated((c_double*3)(*v), self.radius, self.scale, self.gen.c_generator(), -1 if octaves is None else octaves)
@@ -71,7 +71,7 @@ camera.model.translate(5528968.0, 2195850.0, 149997561567.0)
 
 sun = Sprite(1391000000.0, 1391000000.0, Texture.load('data/textures/sun.tga'), [1, 1, 1, 1], True, root)
 
-planet = Planet(6378000.0, 8000.0, 120000.0, 33, 256, sun, generator, Constant(0.0), root)
+planet = Planet(6378000.0, 8000.0, 120000.0, 33, 256, sun, generator, Constant(0.0), root, cache_dir='cache')
 planet.model.translate(0, 0, 150000000000.0)
 
 root.update(camera)
@@ -87,8 +87,7 @@ window.push_handlers(frame)
 def make_action(key):
 	def _action(slider):
 		frame.get_element_by_name(key).text = '%s: %.2f' % (key.capitalize(), slider.value)
-		noise_params[key].value = slider.value
-		planet.regenerate()
+		planet.regenerate(noise_params[key], slider.value)
 
 	return _action
 
@@ -117,7 +116,9 @@ inspector = Dialogue(x=1000, y=600, title='Inspector', content=
 				Label('', name='active_display'),
 				Label('', name='visible_display'),
 				Label('', name='vbo_display'),
-				Label('', name='texture_display')
+				Label('', name='texture_display'),
+				Label('', name='texture_pool_display'),
+				Label('', name='lod_display')
 			])
 		),
 		FoldingBox(title='noise', collapsed=True, content=
@@ -266,6 +267,8 @@ def update_stats(dt):
 		frame.get_element_by_name('visible_display').text = 'Visible tiles: %d' % planet.stats.visible_tiles
 		frame.get_element_by_name('vbo_display').text = 'VBO usage: %.1f MB' % (planet.stats.vbo_memory / (1024.0*1024.0))
 		frame.get_element_by_name('texture_display').text = 'Texture usage: %.1f MB' % (planet.stats.texture_memory / (1024.0*1024.0))
+		frame.get_element_by_name('lod_display').text = 'LOD: %.1f/%.1f ms, %d pending, settled in %.2f s' % (planet.stats.lod_time*1000.0, planet.stats.lod_budget*1000.0, planet.stats.lod_pending, planet.stats.lod_latency)
+		frame.get_element_by_name('texture_pool_display').text = 'Texture pool: %.1f MB, %d allocs/s' % (planet.stats.pooled_texture_memory / (1024.0*1024.0), planet.stats.texture_allocations)
 
 def run():
 	glEnable(GL_CULL_FACE)
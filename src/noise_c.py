@@ -1,9 +1,12 @@
 
 import os
+import math
+import numpy
 from pyglet.gl import *
 from ctypes import *
 
 from .texture import Texture
+from .utility import cube_corners, cube_faces
 from .native_library import native_library
 
 # c support library
@@ -39,11 +42,110 @@ constant_value_set = noise_c.noise_generator_constant_value_set
 constant_value_set.argtypes = [POINTER(noise_generator), c_double]
 constant_value_set.restype = None
 
+compile_generator = noise_c.noise_generator_compile
+compile_generator.argtypes = [POINTER(noise_generator)]
+compile_generator.restype = None
+
+generate_batch = noise_c.noise_generate_batch
+generate_batch.argtypes = [POINTER(noise_generator), POINTER(c_double), c_size_t, POINTER(c_double)]
+generate_batch.restype = None
+
+generate_batch_gradient = noise_c.noise_generate_batch_gradient
+generate_batch_gradient.argtypes = [POINTER(noise_generator), POINTER(c_double), c_size_t, POINTER(c_double), POINTER(c_double)]
+generate_batch_gradient.restype = None
+
+
+def _cube_to_sphere(v):
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    x2, y2, z2 = x*x, y*y, z*z
+
+    return numpy.stack([
+        x * numpy.sqrt(1.0 - y2*0.5 - z2*0.5 + y2*z2/3.0),
+        y * numpy.sqrt(1.0 - z2*0.5 - x2*0.5 + z2*x2/3.0),
+        z * numpy.sqrt(1.0 - x2*0.5 - y2*0.5 + x2*y2/3.0)
+    ], axis=-1)
+
 
 class Generator(object):
     def c_generator(self):
         raise NotImplementedError()
 
+    def compile(self):
+        compile_generator(self.c_generator())
+
+    def evaluate_many(self, points):
+        points = list(points)
+        count = len(points)
+
+        xyz = (c_double * (count*3))(*[c for p in points for c in p])
+        values = (c_double * count)()
+
+        generate_batch(self.c_generator(), xyz, count, values)
+
+        return list(values)
+
+    def sample(self, points):
+        # points is an (N, 3) array, passed to the native library without a
+        # copy when it is already contiguous float64. ctypes releases the GIL
+        # for the duration of the call.
+        points = numpy.ascontiguousarray(points, dtype=numpy.float64)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError('expected an (N, 3) array of points, got shape %s' % (points.shape,))
+
+        values = numpy.empty(len(points), dtype=numpy.float64)
+
+        generate_batch(self.c_generator(), points.ctypes.data_as(POINTER(c_double)),
+                       len(points), values.ctypes.data_as(POINTER(c_double)))
+
+        return values
+
+    def sample_gradient(self, points):
+        # As sample, also returning the (N, 3) analytic gradient at each point
+        points = numpy.ascontiguousarray(points, dtype=numpy.float64)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError('expected an (N, 3) array of points, got shape %s' % (points.shape,))
+
+        values = numpy.empty(len(points), dtype=numpy.float64)
+        gradients = numpy.empty((len(points), 3), dtype=numpy.float64)
+
+        generate_batch_gradient(self.c_generator(), points.ctypes.data_as(POINTER(c_double)), len(points),
+                                values.ctypes.data_as(POINTER(c_double)), gradients.ctypes.data_as(POINTER(c_double)))
+
+        return values, gradients
+
+    def sample_sphere_grid(self, face, level, x, y, size):
+        # Samples the size*size vertex grid of the tile at (x, y) on the given
+        # cube face, where the root tile of each face is level 1. x runs from
+        # the face's first corner towards its fourth, y towards its second.
+        # The result is indexed [y, x], in the same order as generate_vertices.
+        corners = numpy.array([tuple(cube_corners[i]) for i in cube_faces[face]], dtype=numpy.float64)
+
+        tiles = 1 << (level - 1)
+        t = numpy.linspace(0.0, 1.0, size)
+        u = ((x + t) / tiles)[numpy.newaxis, :, numpy.newaxis]
+        w = ((y + t) / tiles)[:, numpy.newaxis, numpy.newaxis]
+
+        lo = corners[0] + (corners[3] - corners[0])*u
+        hi = corners[1] + (corners[2] - corners[1])*u
+
+        points = _cube_to_sphere(lo + (hi - lo)*w)
+
+        return self.sample(points.reshape(-1, 3)).reshape(size, size)
+
+    def octaves_for_error(self, error):
+        # The fewest octaves that keep every value within error of the full
+        # graph, or None when there are no octaves to leave out
+        return None
+
+    def cache_key(self):
+        # A string that identifies the graph and its current values across
+        # runs, or None if results from it shouldn't be cached
+        return None
+
+    def constant_value(self):
+        # The value everywhere, for graphs that don't vary, or None
+        return None
+
     def glsl_code(self):
         raise NotImplementedError()
 
@@ -66,13 +168,20 @@ class Constant(Generator):
         return self._value
 
     def _set_value(self, value):
-        self._value = value
-        constant_value_set(self.c_gen, value)
+        if value != self._value:
+            self._value = value
+            constant_value_set(self.c_gen, value)
     value = property(_get_value, _set_value)
 
     def c_generator(self):
         return self.c_gen
 
+    def cache_key(self):
+        return 'constant(%r)' % self._value
+
+    def constant_value(self):
+        return self._value
+
     def glsl_code(self):
         return (
             self._code,
@@ -257,6 +366,9 @@ float %(name)s(vec3 P) {
     def c_generator(self):
         return self.c_gen
 
+    def cache_key(self):
+        return 'simplex'
+
     def glsl_code(self):
         return (
             self._code,
@@ -287,6 +399,51 @@ class RidgedMultifractal(Generator):
     def c_generator(self):
         return self.c_gen
 
+    def cache_key(self):
+        keys = [n.cache_key() for n in self._nodes]
+        if None in keys:
+            return None
+
+        return 'ridged_multifractal(%s)' % ', '.join(keys)
+
+    def truncation_error(self, octaves):
+        # Upper bound on how far the value can move when only the first
+        # `octaves` octaves are summed, or None unless the parameters are
+        # all Constant.
+        #
+        # Octave i adds (offset - |b|)^2 * w_i * (freq * lacunarity^i)^-h,
+        # where |b| <= 1 for the simplex basis, and the weight w_i is clamped
+        # to [0, 1] from the second octave on. Every dropped term is
+        # non-negative, so truncation only ever lowers the value, by at most
+        # the sum of the dropped terms' bounds. For lacunarity^h > 1 that is
+        # under max(offset^2, (offset-1)^2) * (freq*lacunarity^octaves)^-h / (1 - lacunarity^-h).
+        params = self._nodes[1:]
+        if not all(isinstance(p, Constant) for p in params):
+            return None
+
+        count, lacunarity, gain, offset, h, weight, freq = [p.value for p in params]
+
+        signal = max(offset**2, (offset - 1.0)**2)
+
+        error = 0.0
+        for i in range(int(octaves), int(math.ceil(count))):
+            w = max(weight, 0.0) if i == 0 else 1.0
+            error += signal * w * math.pow(freq * math.pow(lacunarity, i), -h)
+
+        return error
+
+    def octaves_for_error(self, error):
+        if not all(isinstance(p, Constant) for p in self._nodes[1:]):
+            return None
+
+        count = int(math.ceil(self._nodes[1].value))
+
+        for octaves in range(count):
+            if self.truncation_error(octaves) <= error:
+                return octaves
+
+        return count
+
     def glsl_code(self):
         glsl = [n.glsl_code() for n in self._nodes]
 
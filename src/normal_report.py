@@ -0,0 +1,212 @@
+import os
+import sys
+import argparse
+from ctypes import *
+
+import numpy
+
+from .native_library import native_library
+
+# c support libraries, bound here rather than through noise_c, which needs a
+# GL context to import
+noise_c = CDLL(os.getcwd() + native_library('/build/noise', 'noise_c'))
+planet_c = CDLL(os.getcwd() + native_library('/build/planet', 'planet_c'))
+
+constant_create = noise_c.noise_generator_constant_create
+constant_create.argtypes = [c_double]
+constant_create.restype = c_void_p
+
+simplex_create = noise_c.noise_generator_simplex_create
+simplex_create.argtypes = []
+simplex_create.restype = c_void_p
+
+ridged_multifractal_create = noise_c.noise_generator_ridged_multifractal_create
+ridged_multifractal_create.argtypes = [c_void_p]*8
+ridged_multifractal_create.restype = c_void_p
+
+compile_generator = noise_c.noise_generator_compile
+compile_generator.argtypes = [c_void_p]
+compile_generator.restype = None
+
+generate_vertices_with_normals = planet_c.generate_vertices_with_normals
+generate_vertices_with_normals.argtypes = [c_double*3, c_double*3, c_double*3, c_double*3, c_double*3, c_uint, POINTER(c_float), c_double,
+                                           c_double, c_void_p, c_int, c_int, c_int, POINTER(c_double), POINTER(c_double)]
+generate_vertices_with_normals.restype = None
+
+# Reports how far each normal map encoding, and each level's normal map
+# resolution, moves the normals away from the exact ones the native library
+# computes from the noise gradient. Runs without a GL context, by quantising
+# on the CPU the way each texture format would.
+
+
+def unorm(bits):
+    top = float((1 << bits) - 1)
+    return lambda x: numpy.round(numpy.clip(x, 0.0, 1.0)*top) / top
+
+
+def half(x):
+    return x.astype(numpy.float16).astype(numpy.float64)
+
+
+def single(x):
+    return x.astype(numpy.float32).astype(numpy.float64)
+
+
+def oct_encode(n):
+    n = n / numpy.abs(n).sum(axis=-1, keepdims=True)
+
+    p = n[..., :2].copy()
+    lower = n[..., 2] < 0.0
+    sign = numpy.where(p >= 0.0, 1.0, -1.0)
+    p[lower] = ((1.0 - numpy.abs(p[..., ::-1])) * sign)[lower]
+
+    return p
+
+
+def oct_decode(p):
+    n = numpy.concatenate([p, 1.0 - numpy.abs(p).sum(axis=-1, keepdims=True)], axis=-1)
+
+    lower = n[..., 2] < 0.0
+    sign = numpy.where(p >= 0.0, 1.0, -1.0)
+    n[lower, :2] = ((1.0 - numpy.abs(p[..., ::-1])) * sign)[lower]
+
+    return n / numpy.linalg.norm(n, axis=-1, keepdims=True)
+
+
+def plain_decode(x):
+    n = x*2.0 - 1.0
+    return n / numpy.linalg.norm(n, axis=-1, keepdims=True)
+
+
+# bytes per texel, then how the normal and the height survive a round trip
+# through the texture; None for a height taken from the vertices instead
+encodings = {
+    'rgba32f': (16, lambda n: plain_decode(single(n*0.5 + 0.5)), single),
+    'rgba16f': (8, lambda n: plain_decode(half(n*0.5 + 0.5)), half),
+    'rgba8': (4, lambda n: plain_decode(unorm(8)(n*0.5 + 0.5)), unorm(8)),
+    'oct10': (4, lambda n: oct_decode(unorm(10)(oct_encode(n)*0.5 + 0.5)*2.0 - 1.0), unorm(10)),
+    'oct16f': (4, lambda n: oct_decode(half(oct_encode(n)*0.5 + 0.5)*2.0 - 1.0), None),
+}
+
+
+def angles(a, b):
+    return numpy.degrees(numpy.arccos(numpy.clip((a*b).sum(axis=-1), -1.0, 1.0)))
+
+
+def upsample(grid, size):
+    # bilinear, with the grid's corners on the result's corners
+    n = grid.shape[0]
+    t = numpy.linspace(0.0, n - 1.0, size)
+
+    i = numpy.minimum(t.astype(int), n - 2)
+    f = t - i
+
+    rows = grid[i]*(1.0 - f)[:, None, None] + grid[i + 1]*f[:, None, None]
+    rows = rows[:, i]*(1.0 - f)[None, :, None] + rows[:, i + 1]*f[None, :, None]
+
+    return rows
+
+
+class Sampler(object):
+    def __init__(self, gen, radius, scale):
+        self.gen = gen
+        self.radius = radius
+        self.scale = scale
+
+    def tile(self, level, x, y, size):
+        # normals and heights in [0, 1] over a size*size grid across tile x, y
+        # of the +z face at level, as the normal map stores them
+        cells = 1 << (level - 1)
+
+        def corner(i, j):
+            return (c_double*3)(-1.0 + 2.0*i/cells, -1.0 + 2.0*j/cells, 1.0)
+
+        vertices = (c_float*(size*size*6))()
+        heights = numpy.full(size*size, numpy.nan)
+        gradients = numpy.zeros(size*size*3)
+
+        generate_vertices_with_normals((c_double*3)(0, 0, 0), corner(x, y), corner(x, y + 1), corner(x + 1, y + 1), corner(x + 1, y), size,
+                                       vertices, self.radius, self.scale, self.gen, -1, -1, 0,
+                                       heights.ctypes.data_as(POINTER(c_double)), gradients.ctypes.data_as(POINTER(c_double)))
+
+        normals = numpy.frombuffer(vertices, numpy.float32).reshape(size, size, 6)[..., 3:].astype(numpy.float64)
+        heights = numpy.clip(heights.reshape(size, size), -1.0, 1.0)*0.5 + 0.5
+
+        return normals, heights
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Normal map error for each encoding and per-level resolution')
+    parser.add_argument('--tex-size', type=int, default=256)
+    parser.add_argument('--tile-size', type=int, default=33)
+    parser.add_argument('--tex-full-level', type=int, default=4)
+    parser.add_argument('--tex-min-size', type=int, default=32)
+    parser.add_argument('--levels', type=int, nargs='*', default=[1, 2, 4, 8, 12])
+    parser.add_argument('--tiles', type=int, default=4, help='tiles sampled per level')
+    options = parser.parse_args(args)
+
+    # the terrain main.py builds: octaves, lacunarity, gain, offset, h, weight, freq
+    gen = ridged_multifractal_create(simplex_create(), *[constant_create(v) for v in [16, 2.0, 2.0, 1.0, 0.5, 1.0, 1.0]])
+    compile_generator(gen)
+
+    radius, scale = 6378000.0, 8000.0
+    sampler = Sampler(gen, radius, scale)
+
+    random = numpy.random.default_rng(0)
+    tiles = []
+    for level in options.levels:
+        cells = 1 << (level - 1)
+        for t in range(options.tiles):
+            tiles.append((level, int(random.integers(cells)), int(random.integers(cells))))
+
+    size = options.tex_size
+    exact = [sampler.tile(level, x, y, size) for level, x, y in tiles]
+
+    print('encoding  bytes  MiB/tile  mean deg  p99 deg  max deg  max height error m')
+
+    for name, (texel, normal_trip, height_trip) in encodings.items():
+        errors = []
+        height_errors = []
+
+        for (level, x, y), (normals, heights) in zip(tiles, exact):
+            errors.append(angles(normals, normal_trip(normals)).ravel())
+
+            if height_trip:
+                stored = height_trip(heights)
+            else:
+                # interpolated across the triangles from the vertex heights
+                coarse = sampler.tile(level, x, y, options.tile_size)[1]
+                stored = upsample(coarse[..., None], size)[..., 0]
+
+            height_errors.append(numpy.abs(stored - heights).max()*2.0*scale)
+
+        errors = numpy.concatenate(errors)
+
+        print('%-8s  %5d  %8.2f  %8.4f  %7.4f  %7.4f  %18.2f' % (name, texel, size*size*texel / 1048576.0, errors.mean(),
+                                                               numpy.percentile(errors, 99), errors.max(), max(height_errors)))
+
+    print()
+    print('level  size  mean deg  p99 deg  max deg   (against a %d map, before encoding)' % size)
+
+    for level in options.levels:
+        reduced = min(size, max(size >> max(0, options.tex_full_level - level), options.tex_min_size))
+
+        errors = []
+        for (tile_level, x, y), (normals, heights) in zip(tiles, exact):
+            if tile_level != level:
+                continue
+
+            coarse = upsample(sampler.tile(level, x, y, reduced)[0], size)
+            coarse /= numpy.linalg.norm(coarse, axis=-1, keepdims=True)
+
+            errors.append(angles(normals, coarse).ravel())
+
+        errors = numpy.concatenate(errors)
+
+        print('%5d  %4d  %8.4f  %7.4f  %7.4f' % (level, reduced, errors.mean(), numpy.percentile(errors, 99), errors.max()))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
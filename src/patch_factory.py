@@ -1,3 +1,9 @@
+import os
+import time
+import threading
+import contextlib
+import concurrent.futures
+from collections import OrderedDict
 
 class PatchFactory(object):
 	def build_patch(self, tile):
@@ -8,6 +14,230 @@ class PatchFactory(object):
 		pass
 	def combine_patch(self, tile):
 		pass
-	
+
+	# A requested patch need not exist until is_patch_ready says so. Factories
+	# that don't build in the background just build it on the spot.
+	def request_patch(self, tile):
+		self.build_patch(tile)
+	def is_patch_ready(self, tile):
+		return True
+	def cancel_patch(self, tile):
+		self.destroy_patch(tile)
+
+	# Builds tile's patch afresh after an invalidate, with the old one left in
+	# place to draw until the new one replaces it
+	def rebuild_patch(self, tile):
+		self.destroy_patch(tile)
+		self.build_patch(tile)
+
+	# Whether tiles keep their patches, and draw them, once they're split
+	parent_patches = False
+
+	# Called once a frame with the seconds it may spend finishing requests;
+	# returns how many patches it finished
+	def update(self, budget):
+		return 0
+	# Blocks until every background build has finished
+	def wait(self):
+		pass
+	# Forgets anything kept from earlier builds, once the generator has changed
+	def invalidate(self):
+		pass
+
 	def render_patches(self, walk_func, shader, transform, camera):
 		pass
+
+class RetiredPatches(object):
+	# Patches whose tiles have been destroyed, kept by tile address in case
+	# the same tile comes back. The least recently retired are deleted once
+	# their total size passes the budget.
+	def __init__(self, budget, size_of):
+		self.budget = budget
+		self.size_of = size_of
+
+		self.patches = OrderedDict()
+		self.bytes = 0
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.patches)
+
+	def retire(self, address, patch):
+		old = self.patches.pop(address, None)
+		if old:
+			self.bytes -= self.size_of(old)
+			old.delete()
+
+		self.patches[address] = patch
+		self.bytes += self.size_of(patch)
+
+		while self.bytes > self.budget and self.patches:
+			address, patch = self.patches.popitem(last=False)
+			self.bytes -= self.size_of(patch)
+			patch.delete()
+			self.evictions += 1
+
+	def revive(self, address):
+		patch = self.patches.pop(address, None)
+
+		if patch:
+			self.bytes -= self.size_of(patch)
+			self.hits += 1
+		else:
+			self.misses += 1
+
+		return patch
+
+	def clear(self):
+		for patch in self.patches.values():
+			patch.delete()
+
+		self.patches.clear()
+		self.bytes = 0
+
+_executor = None
+_rebuild_executor = None
+
+def background_executor():
+	global _executor
+	if _executor is None:
+		_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+	return _executor
+
+# Rebuilds after a regenerate get workers of their own, so that they neither
+# queue up behind the splits and merges already waiting nor hold them up
+def rebuild_executor():
+	global _rebuild_executor
+	if _rebuild_executor is None:
+		_rebuild_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+	return _rebuild_executor
+
+class GeneratorLock(object):
+	# Any number of background builds may evaluate the generators at once, or
+	# the main thread may change them, but not both. Once a change is waiting
+	# no more builds start, so it only waits for those already running.
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.readers = 0
+		self.writing = False
+
+	@contextlib.contextmanager
+	def shared(self):
+		with self.condition:
+			while self.writing:
+				self.condition.wait()
+			self.readers += 1
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.readers -= 1
+				if not self.readers:
+					self.condition.notify_all()
+
+	@contextlib.contextmanager
+	def exclusive(self):
+		with self.condition:
+			while self.writing:
+				self.condition.wait()
+			self.writing = True
+			while self.readers:
+				self.condition.wait()
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.writing = False
+				self.condition.notify_all()
+
+generator_lock = GeneratorLock()
+
+class AsyncPatchFactory(PatchFactory):
+	# Builds each patch in two halves. generate_patch runs on a worker thread
+	# and must not touch GL; its result is handed to upload_patch on the main
+	# thread, from update().
+	def __init__(self):
+		self.requests = {}
+		self.futures = set()
+
+		# counts invalidates; a patch generated before the latest one is
+		# generated again rather than uploaded
+		self.generation = 0
+
+	def generate_patch(self, tile):
+		raise NotImplementedError()
+	def upload_patch(self, tile, data):
+		raise NotImplementedError()
+	# Puts back a patch kept from an earlier build of the same tile, if there
+	# is one, in which case nothing needs generating
+	def revive_patch(self, tile):
+		return False
+
+	def build_patch(self, tile):
+		if not self.revive_patch(tile):
+			self.upload_patch(tile, self.generate_patch(tile))
+
+	def request_patch(self, tile):
+		if not self.revive_patch(tile):
+			self.submit(tile)
+
+	def rebuild_patch(self, tile):
+		# upload_patch replaces the old patch once the new one is ready
+		self.submit(tile, rebuild_executor())
+
+	def invalidate(self):
+		self.generation += 1
+
+	def generate_current(self, tile):
+		with generator_lock.shared():
+			return self.generation, self.generate_patch(tile)
+
+	def submit(self, tile, executor=None):
+		future = (executor or background_executor()).submit(self.generate_current, tile)
+
+		self.futures.add(future)
+		future.add_done_callback(self.futures.discard)
+
+		self.requests[tile] = future
+
+	def is_patch_ready(self, tile):
+		return tile not in self.requests
+
+	def cancel_patch(self, tile):
+		future = self.requests.pop(tile, None)
+
+		if future:
+			future.cancel()
+		else:
+			self.destroy_patch(tile)
+
+	def update(self, budget):
+		# at least one finished patch is uploaded each frame, so a tight budget
+		# slows the pipeline down rather than stalling it
+		start = time.time()
+		uploaded = 0
+
+		for tile, future in list(self.requests.items()):
+			if not future.done():
+				continue
+
+			del self.requests[tile]
+
+			generation, data = future.result()
+			if generation != self.generation:
+				self.rebuild_patch(tile)
+				continue
+
+			self.upload_patch(tile, data)
+			uploaded += 1
+
+			if time.time() - start > budget:
+				break
+
+		return uploaded
+
+	def wait(self):
+		concurrent.futures.wait(list(self.futures))
@@ -22,6 +22,7 @@ from . import utility
 from .planet_shaders import *
 
 from .lod_sphere import LODSphere
+from .patch_factory import generator_lock
 from .terrain_factory import TerrainFactory
 from .tree_factory import TreeFactory
 from .native_library import native_library
@@ -41,9 +42,15 @@ class Stats:
 		self.visible_tiles = 0
 		self.vbo_memory = 0
 		self.texture_memory = 0
+		self.pooled_texture_memory = 0
+		self.texture_allocations = 0
+		self.lod_time = 0.0
+		self.lod_budget = 0.0
+		self.lod_latency = 0.0
+		self.lod_pending = 0
 
 class Planet(Node):
-	def __init__(self, radius, scale, atmosphereHeight, tileSize, texSize, sun, terrain_generator, water_generator, parent=None):
+	def __init__(self, radius, scale, atmosphereHeight, tileSize, texSize, sun, terrain_generator, water_generator, parent=None, cpu_normals=False, cache_dir=None, vertex_format='positions', normal_encoding='rgba32f', tex_full_level=4, rebuild_budget=4.0, lod_budget=4.0):
 		Node.__init__(self, parent)
 
 		self.radius = radius
@@ -52,31 +59,56 @@ class Planet(Node):
 
 		self.sun = sun
 		self.gen = terrain_generator
+		self.water_gen = water_generator
+
+		self.gen.compile()
+		self.water_gen.compile()
 
 		self.terrain = LODSphere(radius, scale, terrain_generator)
 
-		self.terrain_factory = TerrainFactory(tileSize, texSize, terrain_generator, radius, scale)
+		self.terrain_factory = TerrainFactory(tileSize, texSize, terrain_generator, radius, scale, cpu_normals, cache_dir=cache_dir, vertex_format=vertex_format,
+			normal_encoding=normal_encoding, tex_full_level=tex_full_level)
 		self.terrain.add_factory(self.terrain_factory)
 		self.tree_factory = TreeFactory(radius, scale, tileSize, terrain_generator)
 		self.terrain.add_factory(self.tree_factory)
 
 		self.water = LODSphere(radius, 10.0, water_generator)
-		self.water_factory = TerrainFactory(tileSize, texSize/4, water_generator, radius, scale)
+		self.water_factory = TerrainFactory(tileSize, texSize/4, water_generator, radius, scale, cache_dir=cache_dir, vertex_format=vertex_format,
+			normal_encoding=normal_encoding, tex_full_level=tex_full_level)
 		self.water.add_factory(self.water_factory)
 
+		# milliseconds a frame spent on splitting and merging tiles, and on
+		# uploading rebuilt patches after a regenerate
+		for sphere in [self.terrain, self.water]:
+			sphere.budget = lod_budget/1000.0
+			sphere.rebuild_budget = rebuild_budget/1000.0
+
 		self.lut = Texture.load('data/textures/lut-terrain.png')
 		self.detail = Texture.load('data/textures/detail.jpg', GL_LINEAR, GL_REPEAT)
 		self.spruce = Texture.load('data/textures/trees/spruce.png', GL_LINEAR, GL_REPEAT)
 
-		self.atmosphere = Sphere(self.radius + self.atmosphereHeight, 256)
+		self.atmosphere = Sphere(self.radius + self.atmosphereHeight, 256, cache_dir=cache_dir)
 
 		self.draw_atmosphere = True
 
 		self.stats = Stats()
 
-	def regenerate(self):
-		self.terrain.regenerate()
-		self.water.regenerate()
+	def regenerate(self, param=None, value=None):
+		# rebuilds still pending from the last change are dropped first, so
+		# that the constant only waits for the builds evaluating the generators
+		# right now, not for those queued behind them
+		self.terrain.cancel_rebuilds()
+		self.water.cancel_rebuilds()
+
+		with generator_lock.exclusive():
+			if param is not None:
+				param.value = value
+
+			self.gen.compile()
+			self.water_gen.compile()
+
+			self.terrain.regenerate()
+			self.water.regenerate()
 
 	def _update_near_far(self, camera):
 		loc = self.transform.inverse() * camera.transform * Point3()
@@ -105,20 +137,20 @@ class Planet(Node):
 		cam_dir = self.transform.inverse() * camera.transform * Vector3( 0, 0,-1)
 		cam_height = abs(cam_pos)
 
-		if cam_height - self.radius > self.atmosphereHeight:
-			terrain_shader = terrain_shader_space
-			water_shader = water_shader_space
+		space = cam_height - self.radius > self.atmosphereHeight
+
+		if space:
 			atmos_shader = atmos_shader_space
 		else:
-			terrain_shader = terrain_shader_atmos
-			water_shader = water_shader_atmos
 			atmos_shader = atmos_shader_atmos
 
 		self.terrain.recalculate_visibility(self.transform, camera)
 		self.water.recalculate_visibility(self.transform, camera)
 
 		# draw planet
-		for shader, sphere, factory in [(terrain_shader, self.terrain, self.terrain_factory), (water_shader, self.water, self.water_factory)]:
+		for water, sphere, factory in [(False, self.terrain, self.terrain_factory), (True, self.water, self.water_factory)]:
+			shader = planet_shader(space, water, factory.shader_defines())
+
 			shader.bind()
 			shader.uniformi('lut', 1)
 			shader.uniformi('normalMap', 0)
@@ -128,6 +160,7 @@ class Planet(Node):
 			shader.uniform('exposure', [2.0])
 
 			shader.uniform('waterRadius', [self.radius])
+			shader.uniform('terrainScale', [factory.scale])
 			shader.uniform('atmosphereRadius', [self.radius + self.atmosphereHeight])
 			shader.uniform('atmosphereScale', [1.0/self.atmosphereHeight])
 			shader.uniform('invWavelength', [1.0/math.pow(0.650, 4), 1.0/math.pow(0.570, 4), 1.0/math.pow(0.475, 4)])
@@ -154,7 +187,7 @@ class Planet(Node):
 		glEnable(GL_ALPHA_TEST)
 		glAlphaFunc(GL_GEQUAL, 0.5)
 
-		#self.tree_factory.render_patches(self.terrain.walk_visible, tree_shader, self.transform, camera)
+		self.tree_factory.render_patches(self.terrain.walk_visible, tree_shader, self.transform, camera)
 
 		glDisable(GL_ALPHA_TEST)
 
@@ -182,7 +215,7 @@ class Planet(Node):
 			glBlendFunc(GL_ONE, GL_ONE)
 			glFrontFace(GL_CW)
 
-			self.atmosphere.draw()
+			self.atmosphere.draw(cam_height)
 
 			glFrontFace(GL_CCW)
 			glDisable(GL_BLEND)
@@ -195,5 +228,18 @@ class Planet(Node):
 		self.terrain.update(self.transform, camera)
 		self.water.update(self.transform, camera)
 
+		pools = [self.terrain_factory.textures, self.water_factory.textures]
+
+		self.stats.texture_memory = sum(p.live_bytes for p in pools)
+		self.stats.pooled_texture_memory = sum(p.pooled_bytes for p in pools)
+		self.stats.texture_allocations = sum(p.allocations_per_second() for p in pools)
+
+		spheres = [self.terrain.stats, self.water.stats]
+
+		self.stats.lod_time = sum(s.spent for s in spheres)
+		self.stats.lod_budget = sum(s.budget for s in spheres)
+		self.stats.lod_latency = max(s.latency for s in spheres)
+		self.stats.lod_pending = sum(s.pending for s in spheres)
+
 	def get_height(self, v):
 		return query_height((c_double*3)(*v), self.radius, self.scale, self.gen.c_generator())
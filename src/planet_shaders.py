@@ -115,6 +115,29 @@ void main() {
 	gl_Position = ftransform();
 }
 '''
+# Octahedral normal encoding: the normal is projected onto the octahedron
+# |x| + |y| + |z| = 1 and the lower half folded out over the upper, leaving two
+# components. Decoding undoes both steps.
+octahedral_inc = '''
+vec2 oct_encode(vec3 n) {
+	n /= abs(n.x) + abs(n.y) + abs(n.z);
+
+	vec2 p = n.xy;
+	if (n.z < 0.0)
+		p = (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+
+	return p;
+}
+
+vec3 oct_decode(vec2 p) {
+	vec3 n = vec3(p, 1.0 - abs(p.x) - abs(p.y));
+	if (n.z < 0.0)
+		n.xy = (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+
+	return normalize(n);
+}
+'''
+
 build_normal_map_fs = '''
 varying vec3 normal;
 varying vec2 coord;
@@ -167,17 +190,75 @@ void main() {
 
 	vec3 v = n * m;
 
+#ifdef NORMAL_MAP_OCTAHEDRAL
+	gl_FragColor = vec4(oct_encode(v)*0.5 + 0.5, h11, 1.0);
+#else
 	gl_FragColor = vec4(v*0.5 + 0.5, h11);
+#endif
 }
 '''
+
+_normal_map_shaders = {}
+
+def normal_map_shader(defines=()):
+	key = tuple(defines)
+
+	if key not in _normal_map_shaders:
+		fs = ['#define %s\n' % d for d in defines]
+
+		_normal_map_shaders[key] = Shader([build_normal_map_vs], fs + [octahedral_inc, build_normal_map_fs])
+
+	return _normal_map_shaders[key]
+
 if __debug__:
 	print('loading normal map shader')
-build_normal_map_shader = Shader([build_normal_map_vs], [build_normal_map_fs])
+build_normal_map_shader = normal_map_shader()
 
 planet_vs = '''
 varying vec3 direction;
 varying vec4 primary, secondary;
 
+#ifdef VERTEX_NORMALS
+varying vec3 vertex_normal;
+#endif
+
+#if defined(VERTEX_NORMALS) || defined(NORMAL_MAP_NO_HEIGHT)
+varying float vertex_height;
+#endif
+
+uniform float terrainScale;
+
+#ifdef VERTEX_HEIGHTS
+attribute float height;
+
+// the tile's center and corner on the cube, its sides, and its center's
+// distance from the planet's and offset from the base radius
+uniform vec3 tileCenter, tileCorner, tileU, tileW;
+uniform float tileRadius, heightOffset;
+
+vec3 cube_to_sphere(vec3 v) {
+	return v * sqrt(vec3(
+		1.0 - v.y*v.y*0.5 - v.z*v.z*0.5 + v.y*v.y*v.z*v.z/3.0,
+		1.0 - v.z*v.z*0.5 - v.x*v.x*0.5 + v.z*v.z*v.x*v.x/3.0,
+		1.0 - v.x*v.x*0.5 - v.y*v.y*0.5 + v.x*v.x*v.y*v.y/3.0
+	));
+}
+
+// cube_to_sphere(c + d) - cube_to_sphere(c), expanded so that the small
+// difference keeps its precision far from the planet's center
+vec3 cube_to_sphere_offset(vec3 c, vec3 d) {
+	vec3 p = c + d;
+	vec3 p2 = p*p, c2 = c*c;
+	vec3 dd = d*(2.0*c + d);
+
+	vec3 a = 1.0 - 0.5*(p2.yzx + p2.zxy) + p2.yzx*p2.zxy/3.0;
+	vec3 ac = 1.0 - 0.5*(c2.yzx + c2.zxy) + c2.yzx*c2.zxy/3.0;
+	vec3 da = -0.5*(dd.yzx + dd.zxy) + (dd.yzx*p2.zxy + c2.yzx*dd.zxy)/3.0;
+
+	return d*sqrt(a) + c*da/(sqrt(a) + sqrt(ac));
+}
+#endif
+
 uniform mat4 model_matrix;
 
 uniform vec3 viewer;
@@ -208,7 +289,29 @@ void main( void )
 {
 	gl_TexCoord[0] = gl_MultiTexCoord0;
 
-	vec3 pos = (model_matrix * gl_Vertex).xyz;
+#ifdef VERTEX_HEIGHTS
+	// the tex coords run down the tile's sides, t along u and s along w
+	vec3 offset = tileCorner + tileU*gl_MultiTexCoord0.t + tileW*gl_MultiTexCoord0.s;
+	float dr = heightOffset + height*terrainScale;
+
+	vec4 vertex = vec4(cube_to_sphere_offset(tileCenter, offset)*(tileRadius + dr) + cube_to_sphere(tileCenter)*dr, 1.0);
+#else
+	vec4 vertex = gl_Vertex;
+#endif
+
+	vec3 pos = (model_matrix * vertex).xyz;
+
+#ifdef VERTEX_NORMALS
+#ifdef SPHERE_NORMALS
+	vertex_normal = normalize(pos);
+#else
+	vertex_normal = gl_Normal;
+#endif
+#endif
+
+#if defined(VERTEX_NORMALS) || defined(NORMAL_MAP_NO_HEIGHT)
+	vertex_height = clamp((length(pos) - waterRadius) / terrainScale * 0.5 + 0.5, 0.0, 1.0);
+#endif
 
 		// ray from camera to vertex, and its length (distance through atmosphere)
 	vec3 ray = pos - viewer;
@@ -265,7 +368,7 @@ void main( void )
 
 	direction = pos - viewer;
 
-	gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
+	gl_Position = gl_ModelViewProjectionMatrix * vertex;
 }
 '''
 planet_fs = '''
@@ -277,11 +380,33 @@ uniform sampler2D lut, normalMap, detail;
 varying vec3 direction;
 varying vec4 primary, secondary;
 
+#ifdef VERTEX_NORMALS
+varying vec3 vertex_normal;
+#endif
+
+#if defined(VERTEX_NORMALS) || defined(NORMAL_MAP_NO_HEIGHT)
+varying float vertex_height;
+#endif
+
 void main() {
+#ifdef VERTEX_NORMALS
+	vec3 normal = normalize(vertex_normal);
+	float height = vertex_height;
+#else
 	vec4 map = texture2D(normalMap, gl_TexCoord[0].xy);
 
+#ifdef NORMAL_MAP_OCTAHEDRAL
+	vec3 normal = oct_decode(map.xy*2.0 - 1.0);
+	float height = map.z;
+#else
 	vec3 normal = normalize(map.xyz*2.0 - 1.0);
 	float height = map.w;
+#endif
+
+#ifdef NORMAL_MAP_NO_HEIGHT
+	height = vertex_height;
+#endif
+#endif
 
 	float bump = max(dot(normal, sun), 0.0);
 	float specular = 0.0;
@@ -317,11 +442,29 @@ void main() {
 	//gl_FragColor = vec4(bump);
 }
 '''
-terrain_shader_space = Shader(['#define SPACE\n', planet_vs], [planet_fs])
-terrain_shader_atmos = Shader([planet_vs], [planet_fs])
+_planet_shaders = {}
+
+def planet_shader(space=False, water=False, defines=()):
+	key = (space, water, tuple(defines))
+
+	if key not in _planet_shaders:
+		vs = ['#define %s\n' % d for d in defines]
+		fs = list(vs)
 
-water_shader_space = Shader(['#define SPACE\n', planet_vs], ['#define WATER\n', planet_fs])
-water_shader_atmos = Shader([planet_vs], ['#define WATER\n', planet_fs])
+		if space:
+			vs.insert(0, '#define SPACE\n')
+		if water:
+			fs.insert(0, '#define WATER\n')
+
+		_planet_shaders[key] = Shader(vs + [planet_vs], fs + [octahedral_inc, planet_fs], attributes={'height': 0})
+
+	return _planet_shaders[key]
+
+terrain_shader_space = planet_shader(space=True)
+terrain_shader_atmos = planet_shader()
+
+water_shader_space = planet_shader(space=True, water=True)
+water_shader_atmos = planet_shader(water=True)
 
 atmos_vs = '''
 varying vec3 direction;
@@ -443,14 +586,23 @@ uniform mat4 model_matrix;
 
 uniform vec3 viewer;
 
+// a corner of the billboard quad, and the tree it is instanced for
+attribute vec2 corner;
+attribute vec3 position;
+attribute vec3 normal;
+
 void main() {
-	vec3 pos = (model_matrix * gl_Vertex).xyz;
+	vec3 up = normalize(normal);
+
+	vec3 pos = (model_matrix * vec4(position, 1.0)).xyz;
 	vec3 eye = normalize(viewer - pos);
 
-	vec3 dir = cross(eye, normalize(gl_Normal))*5.0;
+	vec3 across = cross(eye, up)*5.0;
 
-	gl_TexCoord[0] = gl_MultiTexCoord0;
-	gl_Position = gl_ModelViewProjectionMatrix * vec4(gl_Vertex.xyz + dir, 1.0);
+	vec3 vertex = position + up*10.0*corner.y + across*(corner.x*2.0 - 1.0);
+
+	gl_TexCoord[0] = vec4(corner, 0.0, 1.0);
+	gl_Position = gl_ModelViewProjectionMatrix * vec4(vertex, 1.0);
 }
 '''
 tree_fs = '''
@@ -463,4 +615,4 @@ void main() {
 	//gl_FragColor = vec4(1.0, 0.0, 0.0, 1.0);
 }
 '''
-tree_shader = Shader([tree_vs], [tree_fs])
+tree_shader = Shader([tree_vs], [tree_fs], attributes={'corner': 0, 'position': 1, 'normal': 2})
@@ -9,7 +9,7 @@ import pyglet
 from . import euclid
 
 class Shader:
-	def __init__(self, vert = [], frag = [], geom = []):
+	def __init__(self, vert = [], frag = [], geom = [], attributes = {}):
 		self.Handle = glCreateProgram()
 	#	print 'program: ', self.Handle
 		self.Linked = False
@@ -24,6 +24,9 @@ class Shader:
 			glProgramParameteri(self.Handle, GL_GEOMETRY_OUTPUT_TYPE, GL_TRIANGLE_STRIP)
 			glProgramParameteri(self.Handle, GL_GEOMETRY_VERTICES_OUT, 4)
 
+		for name, location in attributes.items():
+			glBindAttribLocation(self.Handle, location, name.encode())
+
 		self.link()
 		self.query_uniforms()
 
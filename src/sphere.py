@@ -1,48 +1,135 @@
+from pyglet.gl import *
+from ctypes import *
 
-import pyglet
+import os
+import math
+import numpy
 
-from math import pi, sin, cos, sqrt
-from .euclid import Vector3
+from .vertex_buffer import VertexBuffer
+
+# bump when the layout written to the cache changes
+mesh_version = 1
+
+def sphere_vertices(radius, steps):
+	# a (steps+1)*(steps+1) latitude/longitude grid, pole to pole down the y
+	# axis, with the first column repeated at the end to close the seam
+	theta = numpy.arange(steps + 1)*(2.0*math.pi/steps)
+	phi = numpy.arange(steps + 1)*(math.pi/steps)
+
+	r = numpy.sin(phi)[:, None]
+
+	vertices = numpy.empty((steps + 1, steps + 1, 3))
+	vertices[..., 0] = r*numpy.cos(theta)[None, :]
+	vertices[..., 1] = numpy.cos(phi)[:, None]
+	vertices[..., 2] = r*numpy.sin(theta)[None, :]
+
+	return (vertices*radius).astype(numpy.float32).reshape(-1, 3)
+
+def sphere_indices(steps, stride):
+	# two triangles per quad of a grid that takes every stride'th vertex of
+	# the full one, wound as the atmosphere is drawn from inside and out
+	row = steps + 1
+
+	j, i = numpy.meshgrid(numpy.arange(0, steps, stride), numpy.arange(0, steps, stride), indexing='ij')
+
+	a = j*row + i
+	b = j*row + i + stride
+	c = (j + stride)*row + i + stride
+	d = (j + stride)*row + i
+
+	return numpy.stack([a, b, c, a, c, d], axis=-1).astype(numpy.uint32).ravel()
+
+def sphere_levels(steps, min_steps):
+	# the grid's own resolution, then each halving of it down to min_steps
+	levels = []
+	stride = 1
+
+	while steps % stride == 0 and (steps // stride >= min_steps or not levels):
+		levels.append(stride)
+		stride *= 2
+
+	return levels
+
+_sphere_meshes = {}
+
+def sphere_mesh(radius, steps, min_steps=16, cache_dir=None):
+	# The vertices, and the index runs for each level as (steps, start, count)
+	# into one array of all of them, built once per process and, given a
+	# cache_dir, kept there across runs
+	key = (radius, steps, min_steps)
+
+	mesh = _sphere_meshes.get(key)
+	if mesh:
+		return mesh
+
+	path = os.path.join(cache_dir, 'sphere-%r-%d-%d-v%d.npz' % (radius, steps, min_steps, mesh_version)) if cache_dir else None
+
+	if path and os.path.exists(path):
+		try:
+			with numpy.load(path) as f:
+				mesh = f['vertices'], f['indices'], f['levels']
+		except (OSError, ValueError, KeyError):
+			mesh = None
+
+	if not mesh:
+		parts = []
+		levels = []
+		start = 0
+
+		for stride in sphere_levels(steps, min_steps):
+			parts.append(sphere_indices(steps, stride))
+			levels.append((steps // stride, start, len(parts[-1])))
+			start += len(parts[-1])
+
+		mesh = sphere_vertices(radius, steps), numpy.concatenate(parts), numpy.array(levels, numpy.int64)
+
+		if path:
+			os.makedirs(cache_dir, exist_ok=True)
+			with open(path + '.tmp', 'wb') as f:
+				numpy.savez(f, vertices=mesh[0], indices=mesh[1], levels=mesh[2])
+			os.replace(path + '.tmp', path)
+
+	_sphere_meshes[key] = mesh
+
+	return mesh
 
 class Sphere:
-	def __init__(self, radius, steps):
-		hStep = 2.0*pi/steps
-		vStep = pi/steps
-		
-		verts = []
-		#normals = []
-		#tangents = []
-		#texcoords = []
-		
-		for j in range(steps+1):
-			for i in range(steps+1):
-				r = sin(j*vStep)
-				v = Vector3(r*cos(i*hStep), cos(j*vStep), r*sin(i*hStep))
-				
-				#v.normalize();
-				#normals += v[:]
-				
-				#t = v.cross(Vector3(0.0,1.0,0.0))
-				#tangents += t[:]
-				
-				v *= radius;
-				verts += v[:]
-				
-				#texcoords += [i/float(steps), cos(j*vStep)*0.5 + 0.5]
-		
-		indices = []
-		for j in range(steps):
-			for i in range(steps+1):
-				ip = (0 if i == steps else i+1)
-				indices.append(j*steps + i)
-				indices.append(j*steps + ip)
-				indices.append((j+1)*steps + ip)
-				
-				indices.append(j*steps + i);
-				indices.append((j+1)*steps + ip)
-				indices.append((j+1)*steps + i)
-		
-		self.vlist = pyglet.graphics.vertex_list_indexed( len(verts)//3, indices, ('v3f', verts)) #, ('n3f', normals), ('t2f', texcoords), ('0g3f', tangents) )
-	
-	def draw(self):
-		self.vlist.draw(pyglet.gl.GL_TRIANGLES)
+	def __init__(self, radius, steps, min_steps=16, cache_dir=None):
+		self.radius = radius
+
+		vertices, indices, self.levels = sphere_mesh(radius, steps, min_steps, cache_dir)
+
+		self.vertex_buffer = VertexBuffer(GL_ARRAY_BUFFER, GL_STATIC_DRAW, vertices.nbytes, vertices.ctypes.data_as(POINTER(GLfloat)))
+		self.index_buffer = VertexBuffer(GL_ELEMENT_ARRAY_BUFFER, GL_STATIC_DRAW, indices.nbytes, indices.ctypes.data_as(POINTER(GLuint)))
+
+	def level(self, distance, tolerance):
+		# the coarsest level whose silhouette stays within tolerance radians
+		# of the true sphere's, seen from distance away from its center
+		if distance is None or distance <= self.radius:
+			return self.levels[0]
+
+		for level in reversed(self.levels):
+			sag = self.radius*(1.0 - math.cos(math.pi/level[0]))
+
+			if sag < (distance - self.radius)*tolerance:
+				return level
+
+		return self.levels[0]
+
+	def draw(self, distance=None, tolerance=0.0005):
+		steps, start, count = self.level(distance, tolerance)
+
+		self.vertex_buffer.bind()
+		glEnableClientState(GL_VERTEX_ARRAY)
+		glVertexPointer(3, GL_FLOAT, 0, None)
+
+		self.index_buffer.bind()
+		glDrawElements(GL_TRIANGLES, int(count), GL_UNSIGNED_INT, int(start)*4)
+		self.index_buffer.unbind()
+
+		glDisableClientState(GL_VERTEX_ARRAY)
+		self.vertex_buffer.unbind()
+
+	def delete(self):
+		self.index_buffer.delete()
+		self.vertex_buffer.delete()
@@ -1,15 +1,20 @@
 
 from typing import Optional
-from .patch_factory import PatchFactory
+from .patch_factory import AsyncPatchFactory, RetiredPatches
 
 from pyglet.gl import *
 from ctypes import *
 import math
+import numpy
 
 from .vertex_buffer import VertexBuffer
+from .vertex_arena import VertexArena, VertexSlot
 from .texture import Texture
+from .texture_pool import TexturePool
 from .frame_buffer import FrameBuffer
 from .shader import Shader
+from .tile_cache import open_cache
+from .tile_mesh import tile_mesh, tile_ring, seed_mask
 
 from .planet_shaders import *
 from .native_library import native_library
@@ -20,9 +25,18 @@ planet_c = CDLL(os.getcwd() + native_library('/build/planet', 'planet_c'))
 
 generate_vertices = planet_c.generate_vertices
 generate_vertices.argtypes = [c_double*3, c_double*3, c_double*3, c_double *
-                              3, c_double*3, c_uint, POINTER(c_float), c_double, c_double, c_void_p]
+                              3, c_double*3, c_uint, POINTER(c_float), c_double, c_double, c_void_p, c_int, c_int, c_int, POINTER(c_double)]
 generate_vertices.restype = None
 
+generate_vertices_with_normals = planet_c.generate_vertices_with_normals
+generate_vertices_with_normals.argtypes = generate_vertices.argtypes + [POINTER(c_double)]
+generate_vertices_with_normals.restype = None
+
+generate_vertex_heights = planet_c.generate_vertex_heights
+generate_vertex_heights.argtypes = [c_double*3, c_double*3, c_double*3, c_double*3, c_uint, c_void_p, c_int, c_void_p, c_int, c_int,
+                                    c_int, POINTER(c_double)]
+generate_vertex_heights.restype = None
+
 query_height = planet_c.query_height
 query_height.argtypes = [c_double*3, c_double, c_double, c_void_p]
 query_height.restype = c_double
@@ -34,36 +48,151 @@ def lerp(a, b, f):
 
 
 class TerrainPatch(object):
-    def __init__(self):
-        self.vertex_buffer: Optional[VertexBuffer] = None
+    def __init__(self, arena, textures):
+        self.arena: Optional[VertexArena] = arena
+        self.textures: TexturePool = textures
+        self.slot: Optional[VertexSlot] = None
         self.normal_map: Optional[Texture] = None
-        self.va: GLuint = 0
+
+        # uniforms placing a height-only patch's vertices, see tile_placement
+        self.placement: Optional[dict] = None
+
+        # the raw noise grid the vertices came from, indexed [j, i], kept to
+        # seed this tile's children, and the octaves summed at each vertex
+        self.counts: Optional[numpy.ndarray] = None
+        self.heights: Optional[numpy.ndarray] = None
+        self.gradients: Optional[numpy.ndarray] = None
 
     def delete(self):
-        if self.va:
-            glDeleteVertexArrays(1, byref(self.va))
-        if self.vertex_buffer:
-            self.vertex_buffer.delete()
+        if self.slot and self.arena:
+            self.arena.release(self.slot)
+            self.slot = None
         if self.normal_map:
-            self.normal_map.delete()
+            self.textures.release(self.normal_map)
+            self.normal_map = None
+
+
+# bumped whenever the records written to the tile cache change
+record_version = 3
 
+# a tile's outer ring of vertices always sums every octave: its neighbours may
+# be of other levels, and so sum other numbers of octaves inside, but they all
+# agree exactly on the vertices they share
+edge_octaves = -1
+
+# bytes per vertex of each vertex format, without cpu normals
+vertex_formats = {'positions': 12, 'heights': 4, 'heights16': 2}
+
+# internal format and shader defines of each normal map encoding; the plain
+# ones hold the normal in rgb and the height in alpha, the octahedral ones the
+# normal in rg and the height, if they have room for it, in b
+normal_encodings = {
+    'rgba32f': (GL_RGBA32F_ARB, []),
+    'rgba16f': (GL_RGBA16F_ARB, []),
+    'rgba8': (GL_RGBA8, []),
+    'oct10': (GL_RGB10_A2, ['NORMAL_MAP_OCTAHEDRAL']),
+    'oct16f': (GL_RG16F, ['NORMAL_MAP_OCTAHEDRAL', 'NORMAL_MAP_NO_HEIGHT']),
+}
+
+
+class TerrainFactory(AsyncPatchFactory):
+    def __init__(self, tile_size, tex_size, height_gen, radius, scale, cpu_normals=False, octave_tolerance=0.05, threads=0,
+                 cache_dir=None, cache_bytes=256*1024*1024, retired_bytes=64*1024*1024, vertex_format='positions',
+                 normal_encoding='rgba32f', tex_full_level=4, tex_min_size=32):
+        AsyncPatchFactory.__init__(self)
 
-class TerrainFactory(PatchFactory):
-    def __init__(self, tile_size, tex_size, height_gen, radius, scale):
         self.tile_size = tile_size
         self.tex_size = int(tex_size)
 
+        if normal_encoding not in normal_encodings:
+            raise ValueError('unknown normal map encoding %r' % normal_encoding)
+
+        self.normal_encoding = normal_encoding
+        self.normal_format, self.normal_defines = normal_encodings[normal_encoding]
+
+        # tiles coarser than tex_full_level get normal maps halved in size for
+        # each level they're short of it, down to tex_min_size. At the default
+        # of 4, levels 1 to 3 of a 256 map get 32, 64 and 128 texels, and
+        # normal_report puts their normals a mean of 7 to 9 degrees (99th
+        # percentile under 60) from the full size map's, against 0.005 for the
+        # levels kept at full size; 0 keeps every level at tex_size
+        self.tex_full_level = tex_full_level
+        self.tex_min_size = tex_min_size
+
+        # a generator that's the same everywhere makes every tile a piece of a
+        # plain sphere: every tile's heights are the same, so one slot of
+        # them is shared by all, and the normals come from the position
+        self.constant = height_gen.constant_value() is not None
+        if self.constant:
+            vertex_format = 'heights'
+            cpu_normals = False
+
+        # 'positions' stores each vertex relative to its tile's center, while
+        # 'heights' and 'heights16' store only its height, as a float or a
+        # normalised short, and the vertex shader works out the rest
+        if vertex_format not in vertex_formats:
+            raise ValueError('unknown vertex format %r' % vertex_format)
+        if cpu_normals and vertex_format != 'positions':
+            raise ValueError('cpu normals need the positions vertex format')
+
+        self.vertex_format = vertex_format
+        self.compact = vertex_format != 'positions'
+
+        # normals computed alongside the vertices, in place of a rendered normal map
+        self.cpu_normals = cpu_normals
+        self.vertex_stride = 24 if cpu_normals else vertex_formats[vertex_format]
+
         self.gen = height_gen
 
         self.radius = radius
         self.scale = scale
 
+        # octaves are dropped inside each tile while the height error stays
+        # under this fraction of its vertex spacing, though never along its
+        # edges; None always generates every octave
+        self.octave_tolerance = octave_tolerance
+
+        # native threads the heights of a patch built on the spot are split
+        # across, 0 for one per core; patches built in the background get one
+        # each, as the executor already runs one build per core
+        self.threads = threads
+
+        # generated tiles persist across runs here, addressed by the generator
+        # and the tile; rendered normal maps are cheap to remake and aren't kept
+        self.cache_dir = cache_dir
+        self.cache = None
+        if cache_dir and not self.constant:
+            layout = 'normals' if cpu_normals else vertex_format
+            path = os.path.join(cache_dir, 'tiles-%d-%s-v%d.cache' % (tile_size, layout, record_version))
+
+            self.cache = open_cache(path, self.record_size(), cache_bytes)
+
+        # destroyed patches, GL objects and all, wait here to be revived
+        self.retired = RetiredPatches(retired_bytes, self.patch_bytes) if retired_bytes and not self.constant else None
+
+        # every patch's vertices live in a slot of a few shared buffers, and
+        # are drawn with the slot's base vertex added to the shared indices
+        self.slots_per_slab = 64
+
         self.build_index_buffer()
         self.build_tex_coord_buffer()
 
-        if self.tex_size > 0:
-            self.map_size = int(tex_size + 2)
+        self.arena = VertexArena(tile_size**2, self.vertex_stride, self.setup_slab, self.slots_per_slab)
+
+        self.constant_slot = None
+        if self.constant:
+            self.constant_slot = self.arena.allocate()
+            self.upload_constant()
+
+        # normal maps, and the scratch height maps they're rendered from, are
+        # recycled through here rather than created for each patch
+        self.textures = TexturePool()
+
+        self.normal_maps = self.tex_size > 0 and not self.cpu_normals and not self.constant
+
+        if self.normal_maps:
             self.build_buffer_fb = FrameBuffer()
+            self.build_normal_map_shader = normal_map_shader(self.normal_defines)
 
             code = self.gen.glsl_code()
             self.build_vertices_shader = Shader([build_vertices_vs],
@@ -73,227 +202,198 @@ class TerrainFactory(PatchFactory):
 
         self.patches = {}
 
+        # tiles whose patches were built before the last invalidate; they're
+        # drawn until rebuilt, but never revived or seeded from
+        self.stale = set()
+
     def build_index_buffer(self):
-        self.indices = [[[[[], []], [[], []]], [[[], []], [[], []]]], [
-            [[[], []], [[], []]], [[[], []], [[], []]]]]
-
-        indices = []
-        start = 0
-
-        for e0 in [False, True]:
-            for e1 in [False, True]:
-                for e2 in [False, True]:
-                    for e3 in [False, True]:
-
-                        for i in range(1, self.tile_size-2):
-                            for j in range(1, self.tile_size-2):
-                                indices.append(j*self.tile_size + i)
-                                indices.append((j+1)*self.tile_size + i+1)
-                                indices.append(j*self.tile_size + i+1)
-
-                                indices.append(j*self.tile_size + i)
-                                indices.append((j+1)*self.tile_size + i)
-                                indices.append((j+1)*self.tile_size + i+1)
-
-                        if e0:
-                            for j in range(1, self.tile_size-2):
-                                indices.append(j*self.tile_size)
-                                indices.append((j+1)*self.tile_size + 1)
-                                indices.append(j*self.tile_size + 1)
-
-                                indices.append(j*self.tile_size)
-                                indices.append((j+1)*self.tile_size)
-                                indices.append((j+1)*self.tile_size + 1)
-
-                            indices.append(0*self.tile_size + 0)
-                            indices.append(1*self.tile_size + 0)
-                            indices.append(1*self.tile_size + 1)
-
-                            indices.append((self.tile_size-2)
-                                           * self.tile_size + 0)
-                            indices.append((self.tile_size-1)
-                                           * self.tile_size + 0)
-                            indices.append((self.tile_size-2)
-                                           * self.tile_size + 1)
-                        else:
-                            for j in range(1, self.tile_size-1, 2):
-                                indices.append((j-1)*self.tile_size)
-                                indices.append((j+1)*self.tile_size)
-                                indices.append(j*self.tile_size + 1)
-
-                            for j in range(1, self.tile_size-2, 2):
-                                indices.append(j*self.tile_size + 1)
-                                indices.append((j+1)*self.tile_size)
-                                indices.append((j+1)*self.tile_size + 1)
-
-                                indices.append((j+1)*self.tile_size + 1)
-                                indices.append((j+1)*self.tile_size)
-                                indices.append((j+2)*self.tile_size + 1)
-
-                        if e1:
-                            for i in range(1, self.tile_size-2):
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i)
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i+1)
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i+1)
-
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i)
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i)
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i+1)
-
-                            indices.append((self.tile_size-1)
-                                           * self.tile_size + 0)
-                            indices.append((self.tile_size-1)
-                                           * self.tile_size + 1)
-                            indices.append((self.tile_size-2)
-                                           * self.tile_size + 1)
-
-                            indices.append((self.tile_size-2) *
-                                           self.tile_size + self.tile_size-2)
-                            indices.append((self.tile_size-1) *
-                                           self.tile_size + self.tile_size-2)
-                            indices.append((self.tile_size-1) *
-                                           self.tile_size + self.tile_size-1)
-                        else:
-                            for i in range(1, self.tile_size-1, 2):
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i-1)
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i+1)
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i)
-
-                            for i in range(1, self.tile_size-2, 2):
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i)
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i+1)
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i+1)
-
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i+1)
-                                indices.append((self.tile_size-1)
-                                               * self.tile_size + i+1)
-                                indices.append((self.tile_size-2)
-                                               * self.tile_size + i+2)
-
-                        if e2:
-                            for j in range(1, self.tile_size-2):
-                                indices.append(
-                                    j*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-1)
-                                indices.append(
-                                    j*self.tile_size + self.tile_size-1)
-
-                                indices.append(
-                                    j*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-1)
-
-                            indices.append(0*self.tile_size + self.tile_size-1)
-                            indices.append(1*self.tile_size + self.tile_size-2)
-                            indices.append(1*self.tile_size + self.tile_size-1)
-
-                            indices.append((self.tile_size-2) *
-                                           self.tile_size + self.tile_size-2)
-                            indices.append((self.tile_size-1) *
-                                           self.tile_size + self.tile_size-1)
-                            indices.append((self.tile_size-2) *
-                                           self.tile_size + self.tile_size-1)
-                        else:
-                            for j in range(1, self.tile_size-1, 2):
-                                indices.append(
-                                    (j-1)*self.tile_size + self.tile_size-1)
-                                indices.append(
-                                    j*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-1)
-
-                            for j in range(1, self.tile_size-2, 2):
-                                indices.append(
-                                    j*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-1)
-
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-1)
-                                indices.append(
-                                    (j+1)*self.tile_size + self.tile_size-2)
-                                indices.append(
-                                    (j+2)*self.tile_size + self.tile_size-2)
-
-                        if e3:
-                            for i in range(1, self.tile_size-2):
-                                indices.append(0*self.tile_size + i)
-                                indices.append(1*self.tile_size + i+1)
-                                indices.append(0*self.tile_size + i+1)
-
-                                indices.append(0*self.tile_size + i)
-                                indices.append(1*self.tile_size + i)
-                                indices.append(1*self.tile_size + i+1)
-
-                            indices.append(0*self.tile_size + 0)
-                            indices.append(1*self.tile_size + 1)
-                            indices.append(0*self.tile_size + 1)
-
-                            indices.append(0*self.tile_size + self.tile_size-2)
-                            indices.append(1*self.tile_size + self.tile_size-2)
-                            indices.append(0*self.tile_size + self.tile_size-1)
-                        else:
-                            for i in range(1, self.tile_size-1, 2):
-                                indices.append(0*self.tile_size + i-1)
-                                indices.append(1*self.tile_size + i)
-                                indices.append(0*self.tile_size + i+1)
-
-                            for i in range(1, self.tile_size-2, 2):
-                                indices.append(1*self.tile_size + i)
-                                indices.append(1*self.tile_size + i+1)
-                                indices.append(0*self.tile_size + i+1)
-
-                                indices.append(0*self.tile_size + i+1)
-                                indices.append(1*self.tile_size + i+1)
-                                indices.append(1*self.tile_size + i+2)
-
-                        self.indices[e0][e1][e2][e3] = [
-                            start, len(indices) - start]
-                        start = len(indices)
-
-        self.index_buffer = VertexBuffer(GL_ELEMENT_ARRAY_BUFFER, GL_STATIC_DRAW, len(
-            indices)*2, (GLushort * len(indices))(*indices))
+        indices, ranges, tex_coords = tile_mesh(self.tile_size, self.cache_dir)
+
+        self.indices = ranges.tolist()
+
+        self.index_buffer = VertexBuffer(GL_ELEMENT_ARRAY_BUFFER, GL_STATIC_DRAW, indices.nbytes,
+                                         indices.ctypes.data_as(POINTER(GLushort)))
 
     def build_tex_coord_buffer(self):
-        tex_coords = []
+        indices, ranges, tex_coords = tile_mesh(self.tile_size, self.cache_dir)
+
+        # the base vertex offsets tex coords too, so each slot needs its own copy
+        tex_coords = numpy.tile(tex_coords, (self.slots_per_slab, 1))
+
+        self.tex_coord_buffer = VertexBuffer(GL_ARRAY_BUFFER, GL_STATIC_DRAW, tex_coords.nbytes,
+                                             tex_coords.ctypes.data_as(POINTER(GLfloat)))
+
+    def setup_slab(self, buffer):
+        self.index_buffer.bind()
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+
+        self.tex_coord_buffer.bind()
+        glTexCoordPointer(2, GL_FLOAT, 0, None)
+        self.tex_coord_buffer.unbind()
+
+        buffer.bind()
+        if self.compact:
+            packed = self.vertex_format == 'heights16'
+
+            glEnableVertexAttribArray(0)
+            glVertexAttribPointer(0, 1, GL_SHORT if packed else GL_FLOAT, packed, self.vertex_stride, None)
+        else:
+            glVertexPointer(3, GL_FLOAT, self.vertex_stride, None)
+        if self.cpu_normals:
+            glEnableClientState(GL_NORMAL_ARRAY)
+            glNormalPointer(GL_FLOAT, self.vertex_stride, 12)
+        buffer.unbind()
+
+    def level_octaves(self, level):
+        # the fewest octaves that keep a tile at level within the tolerance
+        if self.octave_tolerance is None:
+            return -1
+
+        spacing = math.pi*self.radius / math.pow(2.0, level) / (self.tile_size - 1)
+
+        octaves = self.gen.octaves_for_error(spacing*self.octave_tolerance / self.scale)
+
+        return -1 if octaves is None else octaves
+
+    def tile_octaves(self, tile):
+        # A tile's inner vertices sum as many octaves as its children need,
+        # rather than only as many as it does, so that the children can be
+        # seeded from it
+        return self.level_octaves(tile.level + 1)
+
+    def seed_heights(self, tile, octaves):
+        # Every other row and column of a child lies on a quarter of its
+        # parent's vertices, so those noise values are copied from the parent
+        # and left out of the evaluation, which only looks at NaN entries.
+        # Gradients are carried across along with the heights. A value summing
+        # more octaves than the child would is only closer to the full sum,
+        # so any the parent summed enough octaves for will do; see seed_mask.
+        size = self.tile_size
+
+        heights = numpy.full((size, size), numpy.nan)
+        gradients = numpy.zeros((size, size, 3)) if self.cpu_normals else None
+
+        counts = numpy.full((size, size), octaves, numpy.int8)
+        counts[tile_ring(size)] = edge_octaves
+
+        parent = self.patches.get(tile.parent) if tile.parent and tile.parent not in self.stale else None
+
+        if parent and parent.heights is not None and tile.quadrant is not None and (size - 1) % 2 == 0:
+            block, mask = seed_mask(size, tile.quadrant, parent.counts, self.level_octaves(tile.level))
+
+            heights[::2, ::2][mask] = parent.heights[block][mask]
+            counts[::2, ::2][mask] = parent.counts[block][mask]
+            if self.cpu_normals:
+                gradients[::2, ::2][mask] = parent.gradients[block][mask]
+
+        return heights, gradients, counts
+
+    def record_size(self):
+        # vertices, then the noise grid, then its gradients with cpu_normals,
+        # then the octaves summed at each vertex
+        return (self.tile_size**2) * (self.vertex_stride + 8 + 1 + (24 if self.cpu_normals else 0))
+
+    def cache_key(self, tile, octaves):
+        graph = self.gen.cache_key()
+        if graph is None or tile.face is None:
+            return None
 
-        for i in range(self.tile_size):
-            for j in range(self.tile_size):
-                tex_coords.append(i/float(self.tile_size-1))
-                tex_coords.append(j/float(self.tile_size-1))
+        # vertices are stored relative to the tile's center, so that's part of the key too
+        return '%s %r %r %d %d/%d/%d/%d %r %r %r' % (graph, self.radius, self.scale, octaves, tile.face, tile.level, tile.x, tile.y,
+                                                   tile.center.x, tile.center.y, tile.center.z)
 
-        self.tex_coord_buffer = VertexBuffer(GL_ARRAY_BUFFER, GL_STATIC_DRAW, len(
-            tex_coords)*4, (GLfloat * len(tex_coords))(*tex_coords))
+    def pack_record(self, vertices, heights, gradients, counts):
+        record = vertices.raw + heights.tobytes()
+        if self.cpu_normals:
+            record += gradients.tobytes()
 
-    def build_vertex_buffer(self, patch, tile):
+        return record + counts.tobytes()
+
+    def unpack_record(self, record):
         size = self.tile_size
+        count = size**2*self.vertex_stride
+
+        vertices = create_string_buffer(record[:count], count)
+        heights = numpy.frombuffer(record, numpy.float64, size**2, count).reshape(size, size)
+
+        gradients = None
+        if self.cpu_normals:
+            gradients = numpy.frombuffer(record, numpy.float64, size**2*3, count + size**2*8).reshape(size, size, 3)
+
+        counts = numpy.frombuffer(record, numpy.int8, size**2, len(record) - size**2).reshape(size, size)
+
+        return vertices, heights, gradients, counts
+
+    def upload_constant(self):
+        height = min(max(self.gen.constant_value(), -1.0), 1.0)
+        heights = numpy.full(self.tile_size**2, height, numpy.float32)
+
+        self.arena.upload(self.constant_slot, heights.ctypes.data_as(POINTER(c_float)))
+
+    def request_patch(self, tile):
+        # constant tiles have nothing to generate, and are ready at once
+        if self.constant:
+            self.build_patch(tile)
+        else:
+            AsyncPatchFactory.request_patch(self, tile)
+
+    def rebuild_patch(self, tile):
+        if self.constant:
+            self.upload_patch(tile, None)
+        else:
+            AsyncPatchFactory.rebuild_patch(self, tile)
+
+    def build_patch(self, tile):
+        if not self.revive_patch(tile):
+            self.upload_patch(tile, self.generate_patch(tile, self.threads))
+
+    def generate_patch(self, tile, threads=1):
+        # Returns the cache key the patch should be kept under as well, or
+        # None if it came from the cache. It's only written once the patch is
+        # uploaded, so a cancelled build never is.
+        if self.constant:
+            return None
 
-        buffer = create_string_buffer((size**2)*3*4)
+        size = self.tile_size
+
+        octaves = self.tile_octaves(tile)
+
+        key = self.cache_key(tile, octaves) if self.cache else None
+        if key:
+            record = self.cache.get(key)
+            if record is not None:
+                vertices, heights, gradients, counts = self.unpack_record(record)
+                return vertices, octaves, heights, gradients, counts, None
+
+        buffer = create_string_buffer((size**2)*self.vertex_stride)
         vertices = cast(buffer, POINTER(c_float))
 
-        generate_vertices((c_double*3)(*tile.center), (c_double*3)(*tile.corners[0]), (c_double*3)(*tile.corners[1]), (c_double*3)(
-            *tile.corners[2]), (c_double*3)(*tile.corners[3]), size, vertices, self.radius, self.scale, self.gen.c_generator())
+        heights, gradients, counts = self.seed_heights(tile, octaves)
+
+        if self.compact:
+            generate_vertex_heights((c_double*3)(*tile.corners[0]), (c_double*3)(*tile.corners[1]), (c_double*3)(*tile.corners[2]),
+                                    (c_double*3)(*tile.corners[3]), size, buffer, self.vertex_format == 'heights16', self.gen.c_generator(),
+                                    octaves, edge_octaves, threads, heights.ctypes.data_as(POINTER(c_double)))
+
+            return buffer, octaves, heights, gradients, counts, key
 
-        patch.vertex_buffer = VertexBuffer(
-            GL_ARRAY_BUFFER, GL_STATIC_DRAW, (size**2)*3*4, vertices)
+        args = [(c_double*3)(*tile.center), (c_double*3)(*tile.corners[0]), (c_double*3)(*tile.corners[1]), (c_double*3)(
+            *tile.corners[2]), (c_double*3)(*tile.corners[3]), size, vertices, self.radius, self.scale, self.gen.c_generator(), octaves, edge_octaves, threads,
+            heights.ctypes.data_as(POINTER(c_double))]
+
+        if self.cpu_normals:
+            generate_vertices_with_normals(*(args + [gradients.ctypes.data_as(POINTER(c_double))]))
+        else:
+            generate_vertices(*args)
+
+        return buffer, octaves, heights, gradients, counts, key
+
+    def tile_tex_size(self, tile):
+        size = self.tex_size >> max(0, self.tex_full_level - tile.level)
+
+        return min(self.tex_size, max(size, self.tex_min_size))
 
     def build_normal_map(self, patch, tile):
         def drawQuad(tile):
@@ -372,13 +472,16 @@ class TerrainFactory(PatchFactory):
 
 		self.build_buffer_fb.detach()'''
 
+        tex_size = self.tile_tex_size(tile)
+        map_size = tex_size + 2
+
         # build height map
-        height_map = Texture.create2D(
-            self.map_size, self.map_size, GL_LUMINANCE, GL_LUMINANCE32F_ARB)
+        height_map = self.textures.acquire(
+            map_size, map_size, GL_LUMINANCE, GL_LUMINANCE32F_ARB)
         self.build_buffer_fb.attach_texture(
             GL_COLOR_ATTACHMENT0_EXT, height_map.id)
 
-        glViewport(0, 0, self.map_size, self.map_size)
+        glViewport(0, 0, map_size, map_size)
 
         glClear(GL_COLOR_BUFFER_BIT)
 
@@ -396,7 +499,7 @@ class TerrainFactory(PatchFactory):
             i += 1
 
         # offset = math.sqrt(2 * (1.0/(self.map_size+4))**2)
-        offset = 1.0/(self.map_size-2)
+        offset = 1.0/(map_size-2)
 
         glBegin(GL_QUADS)
         glTexCoord3f(*lerp(tile.corners[0], tile.corners[2], -offset))
@@ -417,22 +520,25 @@ class TerrainFactory(PatchFactory):
         self.build_height_map_shader.unbind()
 
         # build normal map
-        patch.normal_map = Texture.create2D(
-            self.tex_size, self.tex_size, GL_RGBA, GL_RGBA32F_ARB)
+        patch.normal_map = self.textures.acquire(
+            tex_size, tex_size, GL_RGBA, self.normal_format)
         self.build_buffer_fb.attach_texture(
             GL_COLOR_ATTACHMENT0_EXT, patch.normal_map.id)
 
-        glViewport(0, 0, self.tex_size, self.tex_size)
+        glViewport(0, 0, tex_size, tex_size)
 
         glClear(GL_COLOR_BUFFER_BIT)
 
+        build_normal_map_shader = self.build_normal_map_shader
+
         build_normal_map_shader.bind()
+        # the height samples are further apart on a smaller map
         build_normal_map_shader.uniform(
-            'scale', [2.0 / math.pow(2, tile.level)])
-        build_normal_map_shader.uniform('pixel', [1.0/float(self.tex_size)])
-        build_normal_map_shader.uniform('offset', [1.0/float(self.map_size)]*2)
+            'scale', [2.0 / math.pow(2, tile.level) * self.tex_size / float(tex_size)])
+        build_normal_map_shader.uniform('pixel', [1.0/float(tex_size)])
+        build_normal_map_shader.uniform('offset', [1.0/float(map_size)]*2)
         build_normal_map_shader.uniform(
-            'bias', [self.tex_size/float(self.map_size)]*2)
+            'bias', [tex_size/float(map_size)]*2)
         build_normal_map_shader.uniformi('heightMap', 0)
 
         height_map.bind()
@@ -444,6 +550,8 @@ class TerrainFactory(PatchFactory):
         self.build_buffer_fb.attach_texture(GL_COLOR_ATTACHMENT0_EXT, 0)
         build_normal_map_shader.unbind()
 
+        self.textures.release(height_map)
+
         self.build_buffer_fb.unbind()
 
         glEnable(GL_DEPTH_TEST)
@@ -453,49 +561,133 @@ class TerrainFactory(PatchFactory):
 
         glPopAttrib()
 
-    def build_patch(self, tile):
-        patch = TerrainPatch()
+    def upload_patch(self, tile, data):
+        # a rebuilt patch replaces the stale one it was drawn in place of
+        old = self.patches.get(tile)
+        if old:
+            old.delete()
+            self.stale.discard(tile)
 
-        self.build_vertex_buffer(patch, tile)
+        if self.constant:
+            # the shared slot isn't the patch's to release
+            patch = TerrainPatch(None, self.textures)
+            patch.slot = self.constant_slot
+            patch.placement = self.tile_placement(tile)
 
-        patch.va = GLuint()
-        glGenVertexArrays(1, byref(patch.va))
-        glBindVertexArray(patch.va)
+            self.patches[tile] = patch
+            return
 
-        self.index_buffer.bind()
+        vertices, octaves, heights, gradients, counts, key = data
 
-        glEnableClientState(GL_VERTEX_ARRAY)
-        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        # the key is worked out again, in case the generator's values changed
+        # while the patch was being built, so it can't be cached under the
+        # values it wasn't built from
+        if key and key == self.cache_key(tile, octaves):
+            self.cache.put(key, self.pack_record(vertices, heights, gradients, counts))
 
-        self.tex_coord_buffer.bind()
-        glTexCoordPointer(2, GL_FLOAT, 0, None)
-        self.tex_coord_buffer.unbind()
+        patch = TerrainPatch(self.arena, self.textures)
 
-        patch.vertex_buffer.bind()
-        glVertexPointer(3, GL_FLOAT, 0, None)
-        patch.vertex_buffer.unbind()
+        patch.counts = counts
+        patch.heights = heights
+        patch.gradients = gradients
 
-        if self.tex_size > 0:
-            self.build_normal_map(patch, tile)
+        patch.slot = self.arena.allocate()
+        self.arena.upload(patch.slot, vertices)
 
-        glBindVertexArray(0)
+        if self.compact:
+            patch.placement = self.tile_placement(tile)
+
+        if self.normal_maps:
+            self.build_normal_map(patch, tile)
 
         self.patches[tile] = patch
 
     def destroy_patch(self, tile):
-        patch = self.patches[tile]
+        patch = self.patches.pop(tile)
+
+        if tile in self.stale:
+            self.stale.discard(tile)
+            patch.delete()
+        elif self.retired is not None and tile.face is not None:
+            self.retired.retire(tile.address(), patch)
+        else:
+            patch.delete()
+
+    def revive_patch(self, tile):
+        patch = None
+        if self.retired is not None and tile.face is not None:
+            patch = self.retired.revive(tile.address())
+
+        if patch:
+            self.patches[tile] = patch
+
+        return patch is not None
 
-        patch.delete()
+    def patch_bytes(self, patch):
+        size = (self.tile_size**2)*self.vertex_stride
 
-        del self.patches[tile]
+        if patch.normal_map:
+            size += self.textures.texture_bytes(patch.normal_map)
+        if patch.heights is not None:
+            size += patch.heights.nbytes
+        if patch.gradients is not None:
+            size += patch.gradients.nbytes
+        if patch.counts is not None:
+            size += patch.counts.nbytes
+
+        return size
+
+    def invalidate(self):
+        AsyncPatchFactory.invalidate(self)
+
+        self.stale = set(self.patches)
+
+        if self.retired is not None:
+            self.retired.clear()
+        if self.constant:
+            self.upload_constant()
 
     def divide_patch(self, tile):
         self.destroy_patch(tile)
 
     def combine_patch(self, tile):
-        self.build_patch(tile)
+        self.request_patch(tile)
+
+    def tile_placement(self, tile):
+        # Everything the vertex shader needs to turn a height back into a
+        # position relative to the tile's center. The corner and sides are
+        # given relative to the center on the cube, and the base radius
+        # relative to the center's height, so that they stay small enough for
+        # single precision however far the tile is from the planet's center.
+        c0, c1, c2, c3 = tile.corners
+        center = lerp(c0, c2, 0.5)
+        height = abs(tile.center)
+
+        return {
+            'tileCenter': list(center),
+            'tileCorner': list(c0 - center),
+            'tileU': list(c3 - c0),
+            'tileW': list(c1 - c0),
+            'tileRadius': [height],
+            'heightOffset': [self.radius - height],
+        }
+
+    def shader_defines(self):
+        if self.cpu_normals:
+            return ['VERTEX_NORMALS']
+        if self.constant:
+            return ['VERTEX_NORMALS', 'SPHERE_NORMALS', 'VERTEX_HEIGHTS']
+
+        defines = list(self.normal_defines) if self.normal_maps else []
+        if self.compact:
+            defines.append('VERTEX_HEIGHTS')
+
+        return defines
 
     def render_patches(self, walk, shader, transform, camera):
+        # neighbouring tiles mostly share a slab, so its vertex array is only
+        # rebound when that changes
+        bound = [None]
 
         def render_patch(tile):
             patch = self.patches.get(tile)
@@ -507,24 +699,31 @@ class TerrainFactory(PatchFactory):
             glLoadMatrixf(
                 (GLfloat * 16)(*camera.view * transform * tile.model))
 
-            glBindVertexArray(patch.va)
+            if bound[0] is not patch.slot.slab:
+                bound[0] = patch.slot.slab
+                glBindVertexArray(bound[0].va)
+
+            if patch.placement:
+                for name, value in patch.placement.items():
+                    shader.uniform(name, value)
 
-            if self.tex_size > 0:
+            if patch.normal_map:
                 patch.normal_map.bind(0)
 
             indices = self.indices[tile.edges[0] != None][tile.edges[1]
                                                           != None][tile.edges[2] != None][tile.edges[3] != None]
 
-            glDrawElements(
-                GL_TRIANGLES, indices[1], GL_UNSIGNED_SHORT, indices[0]*2)
+            glDrawElementsBaseVertex(
+                GL_TRIANGLES, indices[1], GL_UNSIGNED_SHORT, indices[0]*2, patch.slot.base_vertex)
 
-            if self.tex_size > 0:
+            if patch.normal_map:
                 patch.normal_map.unbind(0)
 
         walk(render_patch)
 
         glBindVertexArray(0)
 
+        glDisableClientState(GL_NORMAL_ARRAY)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
         glDisableClientState(GL_VERTEX_ARRAY)
 
@@ -15,6 +15,9 @@ class Texture:
 
 		self.tex : Optional[Any] = None
 
+		# the size and format a TexturePool keeps it under
+		self.pool_key : Optional[tuple] = None
+
 	def delete(self):
 		if self.tex:
 			self.tex.delete()
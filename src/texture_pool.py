@@ -0,0 +1,99 @@
+from pyglet.gl import *
+from collections import OrderedDict, deque
+import time
+
+from .texture import Texture
+
+# bytes per texel of the internal formats render targets are made with
+_texel_bytes = {
+	GL_LUMINANCE32F_ARB: 4,
+	GL_RGBA32F_ARB: 16,
+	GL_RGBA16F_ARB: 8,
+	GL_RGBA8: 4,
+	GL_RGB10_A2: 4,
+	GL_RG16F: 4,
+	GL_RGBA: 4,
+}
+
+class TexturePool:
+	# Render target textures, kept by size and format once released so that
+	# the next request for the same kind reuses one instead of asking the
+	# driver for another. Released textures past max_bytes are deleted, least
+	# recently released first.
+	def __init__(self, max_bytes=64*1024*1024):
+		self.max_bytes = max_bytes
+
+		self.free = OrderedDict()
+		self.pooled_bytes = 0
+		self.live_bytes = 0
+
+		self.allocations = 0
+		self.reuses = 0
+
+		# times of the allocations in the last second, for the rate
+		self.recent = deque()
+
+	def texture_bytes(self, texture):
+		return texture.width*texture.height*_texel_bytes.get(texture.pool_key[3], 4)
+
+	def acquire(self, width, height, format=GL_RGBA, internal_format=GL_RGBA):
+		key = (width, height, format, internal_format)
+
+		bucket = self.free.get(key)
+
+		if bucket:
+			texture = bucket.pop()
+			if not bucket:
+				del self.free[key]
+
+			self.pooled_bytes -= self.texture_bytes(texture)
+			self.reuses += 1
+		else:
+			texture = Texture.create2D(width, height, format, internal_format)
+			texture.pool_key = key
+
+			self.allocations += 1
+			self.recent.append(time.time())
+			self.forget_allocations()
+
+		self.live_bytes += self.texture_bytes(texture)
+
+		return texture
+
+	def release(self, texture):
+		size = self.texture_bytes(texture)
+
+		self.live_bytes -= size
+
+		self.free.setdefault(texture.pool_key, []).append(texture)
+		self.free.move_to_end(texture.pool_key)
+		self.pooled_bytes += size
+
+		while self.pooled_bytes > self.max_bytes:
+			key, bucket = next(iter(self.free.items()))
+
+			texture = bucket.pop(0)
+			if not bucket:
+				del self.free[key]
+
+			self.pooled_bytes -= self.texture_bytes(texture)
+			texture.delete()
+
+	def forget_allocations(self):
+		now = time.time()
+
+		while self.recent and self.recent[0] < now - 1.0:
+			self.recent.popleft()
+
+	def allocations_per_second(self):
+		self.forget_allocations()
+
+		return len(self.recent)
+
+	def delete(self):
+		for bucket in self.free.values():
+			for texture in bucket:
+				texture.delete()
+
+		self.free.clear()
+		self.pooled_bytes = 0
@@ -0,0 +1,185 @@
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class TileCache(object):
+    # Fixed-size records in a single memory-mapped file, evicted least
+    # recently used first once max_bytes is reached.
+    #
+    # Each slot starts with a header holding the digest of the record's key,
+    # a checksum of its payload and the tick it was last used at. The index and
+    # the LRU order are rebuilt from those headers when the file is opened, so
+    # there is nothing else to keep in step, and a record torn by a crash fails
+    # its checksum and reads as a miss.
+    #
+    # Safe to use from several threads at once.
+
+    header = struct.Struct('<4sIQ20s')
+    magic = b'TILE'
+
+    def __init__(self, path, record_size, max_bytes=256*1024*1024, grow=64):
+        self.path = path
+        self.record_size = record_size
+
+        self.slot_size = (self.header.size + record_size + 63) & ~63
+        self.max_slots = max(1, max_bytes // self.slot_size)
+        self.grow = grow
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self.file = os.fdopen(fd, 'r+b')
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+
+        # a file written with another record layout, or a larger limit, is cut
+        # back to whole slots that fit
+        self.slots = min(size // self.slot_size, self.max_slots)
+        if size != self.slots*self.slot_size:
+            self.file.truncate(self.slots*self.slot_size)
+
+        self.map = None
+        if self.slots:
+            self.map = mmap.mmap(self.file.fileno(), self.slots*self.slot_size)
+
+        self.index = OrderedDict()
+        self.free = []
+        self.tick = 0
+
+        used = []
+        for slot in range(self.slots):
+            magic, crc, tick, digest = self.header.unpack_from(self.map, slot*self.slot_size)
+
+            if magic == self.magic and digest not in self.index:
+                used.append((tick, digest, slot))
+                self.tick = max(self.tick, tick)
+            else:
+                self.free.append(slot)
+
+        for tick, digest, slot in sorted(used):
+            self.index[digest] = slot
+
+    def __len__(self):
+        return len(self.index)
+
+    def _digest(self, key):
+        return hashlib.sha1(key.encode('utf-8')).digest()
+
+    def _remap(self, slots):
+        if self.map:
+            self.map.close()
+
+        self.file.truncate(slots*self.slot_size)
+        self.map = mmap.mmap(self.file.fileno(), slots*self.slot_size)
+
+        self.free.extend(range(self.slots, slots))
+        self.slots = slots
+
+    def _allocate(self):
+        if not self.free and self.slots < self.max_slots:
+            self._remap(min(self.max_slots, self.slots + self.grow))
+
+        if self.free:
+            return self.free.pop()
+
+        digest, slot = self.index.popitem(last=False)
+        self.evictions += 1
+
+        return slot
+
+    def get(self, key):
+        digest = self._digest(key)
+
+        with self.lock:
+            slot = self.index.get(digest)
+
+            if slot is None:
+                self.misses += 1
+                return None
+
+            offset = slot*self.slot_size
+            start = offset + self.header.size
+
+            magic, crc, tick, stored = self.header.unpack_from(self.map, offset)
+            data = self.map[start:start + self.record_size]
+
+            if magic != self.magic or stored != digest or zlib.crc32(data) != crc:
+                del self.index[digest]
+                self.free.append(slot)
+                self.misses += 1
+                return None
+
+            self.tick += 1
+            self.header.pack_into(self.map, offset, magic, crc, self.tick, digest)
+            self.index.move_to_end(digest)
+
+            self.hits += 1
+
+            return data
+
+    def put(self, key, data):
+        if len(data) != self.record_size:
+            raise ValueError('expected a %d byte record, got %d bytes' % (self.record_size, len(data)))
+
+        digest = self._digest(key)
+
+        with self.lock:
+            slot = self.index.pop(digest, None)
+            if slot is None:
+                slot = self._allocate()
+
+            offset = slot*self.slot_size
+            start = offset + self.header.size
+
+            # the slot reads as empty until the new header is in place
+            self.map[offset:offset + len(self.magic)] = bytes(len(self.magic))
+            self.map[start:start + self.record_size] = data
+
+            self.tick += 1
+            self.header.pack_into(self.map, offset, self.magic, zlib.crc32(data), self.tick, digest)
+
+            self.index[digest] = slot
+
+    def flush(self):
+        with self.lock:
+            if self.map:
+                self.map.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map:
+                self.map.close()
+                self.map = None
+            self.file.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(path, record_size, max_bytes=256*1024*1024):
+    # Factories sharing a path share one cache, and with it one size limit
+    path = os.path.abspath(path)
+
+    with _caches_lock:
+        cache = _caches.get(path)
+
+        if cache is None:
+            cache = _caches[path] = TileCache(path, record_size, max_bytes)
+        elif cache.record_size != record_size:
+            raise ValueError('%s holds %d byte records, not %d' % (path, cache.record_size, record_size))
+
+        return cache
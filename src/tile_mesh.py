@@ -0,0 +1,311 @@
+import os
+import sys
+import argparse
+import itertools
+from collections import deque
+
+import numpy
+
+
+def vertex_score(position, remaining, cache_size):
+    # Forsyth's "Linear-Speed Vertex Cache Optimisation" scoring: vertices
+    # used by the last triangle score a flat amount, the rest of the cache
+    # less the further back they are, and vertices with few triangles left get
+    # a boost so that they are finished off rather than left stranded
+    if remaining == 0:
+        return -1.0
+
+    score = 0.0
+    if position >= 0:
+        if position < 3:
+            score = 0.75
+        else:
+            score = (1.0 - (position - 3) / float(cache_size - 3)) ** 1.5
+
+    return score + 2.0 * remaining ** -0.5
+
+
+def optimise_order(indices, cache_size=32):
+    # Reorders a triangle list so that each triangle reuses as many of the
+    # vertices left in an LRU cache of cache_size by the ones before it as it
+    # can. Each step only looks at the triangles of vertices in the cache,
+    # falling back to the first triangle not yet emitted when there are none.
+    triangles = numpy.asarray(indices).reshape(-1, 3).tolist()
+    if not triangles:
+        return numpy.asarray(indices)
+
+    vertex_triangles = {}
+    for t, triangle in enumerate(triangles):
+        for v in triangle:
+            vertex_triangles.setdefault(v, []).append(t)
+
+    valence = max(len(ts) for ts in vertex_triangles.values())
+    scores = [[vertex_score(position, remaining, cache_size) for remaining in range(valence + 1)]
+              for position in range(-1, cache_size)]
+
+    remaining = {v: len(ts) for v, ts in vertex_triangles.items()}
+    score = {v: scores[0][r] for v, r in remaining.items()}
+    triangle_score = [score[a] + score[b] + score[c] for a, b, c in triangles]
+
+    emitted = [False]*len(triangles)
+    order = []
+    cache = []
+    next_triangle = 0
+
+    best = max(range(len(triangles)), key=triangle_score.__getitem__)
+
+    while best is not None:
+        emitted[best] = True
+        order.append(best)
+
+        triangle = triangles[best]
+        for v in triangle:
+            vertex_triangles[v].remove(best)
+            remaining[v] -= 1
+
+        cache = triangle + [v for v in cache if v not in triangle]
+        evicted = cache[cache_size:]
+        cache = cache[:cache_size]
+
+        for v in evicted:
+            score[v] = scores[0][remaining[v]]
+        for position, v in enumerate(cache):
+            score[v] = scores[position + 1][remaining[v]]
+
+        best = None
+        best_score = -1.0
+
+        for v in cache + evicted:
+            for t in vertex_triangles[v]:
+                a, b, c = triangles[t]
+                triangle_score[t] = score[a] + score[b] + score[c]
+
+                if v in cache and triangle_score[t] > best_score:
+                    best, best_score = t, triangle_score[t]
+
+        if best is None:
+            while next_triangle < len(triangles) and emitted[next_triangle]:
+                next_triangle += 1
+            if next_triangle < len(triangles):
+                best = next_triangle
+
+    return numpy.asarray(triangles, dtype=numpy.asarray(indices).dtype)[order].ravel()
+
+
+def transformed_vertices(indices, cache_size=32):
+    # How many vertices a FIFO post-transform cache of cache_size misses on
+    # drawing indices, the model most hardware follows
+    cache = deque()
+    cached = set()
+    misses = 0
+
+    for v in numpy.asarray(indices).tolist():
+        if v in cached:
+            continue
+
+        misses += 1
+        cache.append(v)
+        cached.add(v)
+
+        if len(cache) > cache_size:
+            cached.discard(cache.popleft())
+
+    return misses
+
+
+def acmr(indices, cache_size=32):
+    # average cache miss ratio, vertices transformed per triangle
+    return transformed_vertices(indices, cache_size) / (len(indices) / 3.0)
+
+
+def atvr(indices, cache_size=32):
+    # average transformed vertex ratio, vertices transformed per vertex used
+    return transformed_vertices(indices, cache_size) / float(len(set(numpy.asarray(indices).tolist())))
+
+
+def tile_indices(n, optimise=True):
+    # Triangles for the interior of an n*n tile, followed by those for each
+    # edge in two forms: at full resolution, and stitched to a neighbour with
+    # half as many vertices along it. Unless optimise is False each part is
+    # reordered for the post-transform vertex cache; otherwise it comes out in
+    # rows, as the loops this replaced emitted it.
+    def v(i, j):
+        return j*n + i
+
+    def triangles(*corners):
+        return numpy.stack(numpy.broadcast_arrays(*corners), axis=-1).ravel()
+
+    inner = numpy.arange(1, n-2)
+    odd = numpy.arange(1, n-1, 2)
+    odd_inner = numpy.arange(1, n-2, 2)
+
+    a, b = n-2, n-1
+
+    i, j = inner[:, None], inner[None, :]
+    interior = triangles(v(i, j), v(i+1, j+1), v(i+1, j), v(i, j), v(i, j+1), v(i+1, j+1))
+
+    i = j = inner
+    full = [
+        [triangles(v(0, j), v(1, j+1), v(1, j), v(0, j), v(0, j+1), v(1, j+1)),
+         [v(0, 0), v(0, 1), v(1, 1), v(0, a), v(0, b), v(1, a)]],
+        [triangles(v(i, a), v(i+1, b), v(i+1, a), v(i, a), v(i, b), v(i+1, b)),
+         [v(0, b), v(1, b), v(1, a), v(a, a), v(a, b), v(b, b)]],
+        [triangles(v(a, j), v(b, j+1), v(b, j), v(a, j), v(a, j+1), v(b, j+1)),
+         [v(b, 0), v(a, 1), v(b, 1), v(a, a), v(b, b), v(b, a)]],
+        [triangles(v(i, 0), v(i+1, 1), v(i+1, 0), v(i, 0), v(i, 1), v(i+1, 1)),
+         [v(0, 0), v(1, 1), v(1, 0), v(a, 0), v(a, 1), v(b, 0)]],
+    ]
+
+    i = j = odd
+    k = l = odd_inner
+    stitched = [
+        [triangles(v(0, j-1), v(0, j+1), v(1, j)),
+         triangles(v(1, l), v(0, l+1), v(1, l+1), v(1, l+1), v(0, l+1), v(1, l+2))],
+        [triangles(v(i-1, b), v(i+1, b), v(i, a)),
+         triangles(v(k, a), v(k+1, b), v(k+1, a), v(k+1, a), v(k+1, b), v(k+2, a))],
+        [triangles(v(b, j-1), v(a, j), v(b, j+1)),
+         triangles(v(a, l), v(a, l+1), v(b, l+1), v(b, l+1), v(a, l+1), v(a, l+2))],
+        [triangles(v(i-1, 0), v(i, 1), v(i+1, 0)),
+         triangles(v(k, 1), v(k+1, 1), v(k+1, 0), v(k+1, 0), v(k+1, 1), v(k+2, 1))],
+    ]
+
+    edges = [[numpy.concatenate(stitched[e]), numpy.concatenate(full[e])] for e in range(4)]
+
+    # the parts are ordered on their own rather than per variant, which costs
+    # a cache refill where they join but means the interior is done only once
+    if optimise:
+        interior = optimise_order(interior)
+        edges = [[optimise_order(part) for part in parts] for parts in edges]
+
+    # ranges[e0][e1][e2][e3] holds the start and count of the variant whose
+    # edges are at full resolution where e is set
+    parts = []
+    ranges = numpy.zeros((2, 2, 2, 2, 2), numpy.int64)
+    start = 0
+
+    for e in itertools.product([0, 1], repeat=4):
+        variant = [interior] + [edges[edge][e[edge]] for edge in range(4)]
+        count = sum(len(part) for part in variant)
+
+        parts.extend(variant)
+        ranges[e] = [start, count]
+        start += count
+
+    return numpy.concatenate(parts).astype(numpy.uint16), ranges
+
+
+def tile_tex_coords(n):
+    t = numpy.arange(n) / float(n-1)
+
+    return numpy.stack(numpy.meshgrid(t, t, indexing='ij'), axis=-1).reshape(-1, 2).astype(numpy.float32)
+
+
+def tile_ring(n):
+    # the outer ring of an n*n grid, the vertices a tile shares with its
+    # neighbours
+    ring = numpy.zeros((n, n), bool)
+    ring[0, :] = ring[-1, :] = ring[:, 0] = ring[:, -1] = True
+
+    return ring
+
+
+def enough_octaves(have, need):
+    # whether values summing have octaves are as close as need octaves get
+    # them, with -1 standing for every octave in either
+    if need < 0:
+        return have < 0
+
+    return (have < 0) | (have >= need)
+
+
+def seed_mask(n, quadrant, counts, need):
+    # Every other row and column of a child of an n*n tile lies on its
+    # parent's vertices in that quadrant. Returns the parent's block of them,
+    # and which of them the child can take as they are: those summing at
+    # least need octaves, the child's own count, and along the child's outer
+    # ring only those summing every octave, as the ring must.
+    half = (n - 1) // 2
+    i0, j0 = [(0, 0), (0, half), (half, half), (half, 0)][quadrant]
+
+    block = (slice(j0, j0 + half + 1), slice(i0, i0 + half + 1))
+    have = counts[block]
+
+    return block, numpy.where(tile_ring(half + 1), have < 0, enough_octaves(have, need))
+
+
+# bumped whenever the arrays tile_mesh builds change, so older files are ignored
+mesh_version = 2
+
+_tile_meshes = {}
+
+
+def tile_mesh(n, cache_dir=None):
+    # The index and tex-coord arrays shared by every factory with n*n tiles,
+    # built once per process and, given a cache_dir, kept there across runs
+    mesh = _tile_meshes.get(n)
+    if mesh:
+        return mesh
+
+    path = os.path.join(cache_dir, 'tile-mesh-%d-v%d.npz' % (n, mesh_version)) if cache_dir else None
+
+    if path and os.path.exists(path):
+        try:
+            with numpy.load(path) as f:
+                mesh = f['indices'], f['ranges'], f['tex_coords']
+        except (OSError, ValueError, KeyError):
+            mesh = None
+
+    if not mesh:
+        mesh = tile_indices(n) + (tile_tex_coords(n),)
+
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                numpy.savez(f, indices=mesh[0], ranges=mesh[1], tex_coords=mesh[2])
+            os.replace(path + '.tmp', path)
+
+    _tile_meshes[n] = mesh
+
+    return mesh
+
+
+def variants(indices, ranges):
+    for e in itertools.product([0, 1], repeat=4):
+        start, count = ranges[e]
+        yield e, indices[start:start + count]
+
+
+def main(args=None):
+    # Reports how well each tile size's index buffers use the post-transform
+    # cache, without needing a GL context. With --max-acmr, exits non-zero if
+    # any variant misses more than that, so that it can gate regressions.
+    parser = argparse.ArgumentParser(description='Post-transform vertex cache efficiency of the tile index buffers')
+    parser.add_argument('sizes', nargs='*', type=int, default=[17, 33, 65])
+    parser.add_argument('--cache', type=int, action='append', help='FIFO cache sizes to simulate (default 16 and 32)')
+    parser.add_argument('--max-acmr', type=float, help='fail if any optimised variant has a higher ACMR')
+    options = parser.parse_args(args)
+
+    caches = options.cache or [16, 32]
+    failed = False
+
+    print('%5s %5s %9s %6s %6s %6s %6s' % ('size', 'cache', 'order', 'ACMR', 'worst', 'ATVR', 'worst'))
+
+    for n in options.sizes:
+        for cache_size in caches:
+            for optimise in [False, True]:
+                indices, ranges = tile_indices(n, optimise)
+
+                stats = [(acmr(part, cache_size), atvr(part, cache_size)) for e, part in variants(indices, ranges)]
+                acmrs, atvrs = zip(*stats)
+
+                print('%5d %5d %9s %6.3f %6.3f %6.3f %6.3f' % (n, cache_size, 'optimised' if optimise else 'rows',
+                                                            numpy.mean(acmrs), max(acmrs), numpy.mean(atvrs), max(atvrs)))
+
+                if optimise and options.max_acmr is not None and max(acmrs) > options.max_acmr:
+                    failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,13 @@
-from .patch_factory import PatchFactory
+from .patch_factory import AsyncPatchFactory
 
 import pyglet
 from pyglet.gl import *
 from ctypes import *
 import math
 
-from .vertex_buffer import VertexBuffer
-from .texture import Texture
+import numpy
 
-from .utility import lerp, cube_to_sphere
+from .vertex_buffer import VertexBuffer
 from .native_library import native_library
 
 import os
@@ -19,20 +18,97 @@ planet_c = CDLL(os.getcwd() + native_library('/build/planet', 'planet_c'))
 query_height = planet_c.query_height
 query_height.argtypes = [c_double * 3, c_double, c_double, c_void_p]
 query_height.restype = c_double
+
+query_heights = planet_c.query_heights
+query_heights.argtypes = [POINTER(c_double), c_size_t, c_double, c_double, c_void_p, POINTER(c_double)]
+query_heights.restype = None
 #
 
 
 class TreePatch(object):
-    def __init__(self):
-        self.vertices = None
+    def __init__(self, buffer, count):
+        self.buffer = buffer
+        self.count = count
+
+        self.va = GLuint()
+        glGenVertexArrays(1, byref(self.va))
 
     def delete(self):
-        if self.vertices:
-            self.vertices.delete()
+        glDeleteVertexArrays(1, byref(self.va))
+        self.buffer.delete()
+
+
+# each tree is one instance of this quad, as (across, up) pairs drawn as a
+# triangle strip, which doubles as its texture coordinates
+billboard = [0.0, 0.0, 1.0, 0.0, 0.0, 1.0, 1.0, 1.0]
+
+# position relative to the tile center, then the up vector
+instance_stride = 6*4
+
+
+def best_candidate_points(count, candidates=16, seed=0):
+    # Mitchell's best candidate: each point is whichever of a handful of
+    # random candidates lies furthest from those already placed, wrapping
+    # around the edges so neighbouring tiles don't crowd. Any prefix of the
+    # result is spread about as evenly as a blue noise set of that size.
+    random = numpy.random.RandomState(seed)
+
+    points = numpy.empty((count, 2))
+    points[0] = random.random_sample(2)
+
+    for n in range(1, count):
+        trial = random.random_sample((candidates, 2))
+
+        d = numpy.abs(trial[:, None] - points[None, :n])
+        d = numpy.minimum(d, 1.0 - d)
+        d = (d*d).sum(axis=-1).min(axis=1)
+
+        points[n] = trial[d.argmax()]
+
+    return points
+
+
+# best_candidate_points(4096), saved as it takes seconds to build; as any
+# prefix of it is the same as a shorter run, it serves every grid up to 64*64
+placement_points = numpy.load('data/placement.npy')
+
+_placement_tables = {}
+
+
+def placement_table(grid_size):
+    # enough points for a tree at every grid_size*grid_size grid point at the
+    # finest level, shared by every tile
+    count = grid_size*grid_size
+
+    if count <= len(placement_points):
+        return placement_points[:count]
+
+    table = _placement_tables.get(grid_size)
+
+    if table is None:
+        table = best_candidate_points(count)
+        _placement_tables[grid_size] = table
+
+    return table
+
+
+def cube_to_sphere_array(v):
+    x, y, z = v[..., 0:1], v[..., 1:2], v[..., 2:3]
+
+    return numpy.concatenate([
+        x * numpy.sqrt(1.0 - y*y*0.5 - z*z*0.5 + y*y*z*z/3.0),
+        y * numpy.sqrt(1.0 - z*z*0.5 - x*x*0.5 + z*z*x*x/3.0),
+        z * numpy.sqrt(1.0 - x*x*0.5 - y*y*0.5 + x*x*y*y/3.0),
+    ], axis=-1)
 
 
-class TreeFactory(PatchFactory):
+class TreeFactory(AsyncPatchFactory):
+    # coarser tiles' trees are drawn along with their children's
+    parent_patches = True
+
     def __init__(self, radius, scale, grid_size, generator):
+        AsyncPatchFactory.__init__(self)
+
         self.radius = radius
         self.scale = scale
         self.grid_size = grid_size
@@ -43,42 +119,74 @@ class TreeFactory(PatchFactory):
 
         self.patches = {}
 
-    def build_patch(self, tile):
+        self.placement = placement_table(grid_size)
+
+        data = (GLfloat * len(billboard))(*billboard)
+        self.billboard_buffer = VertexBuffer(GL_ARRAY_BUFFER, GL_STATIC_DRAW, sizeof(data), data)
+
+    def candidates(self, tile):
+        # the start of the placement table, with each level taking four times
+        # as many points as the one above, up to the whole table
         diff = self.tree_lod - tile.lod + 8
-        if diff >= 0:
-            verts = []
-            normals = []
-            texcoords = []
-
-            for i in range(0, self.grid_size, 1 << diff):
-                hi = lerp(tile.corners[0], tile.corners[3], i / float(self.grid_size))
-                lo = lerp(tile.corners[1], tile.corners[2], i / float(self.grid_size))
-                for j in range(0, self.grid_size, 1 << diff):
-                    v = cube_to_sphere(lerp(lo, hi, i / float(self.grid_size)))
-
-                    h = self.get_height(v)
-
-                    if h - self.radius > 1.0 and h - self.radius < self.scale * 0.8:
-                        b = v * h - tile.center
-                        t = v * (h + 10.0) - tile.center
-
-                        # print b, t
-
-                        verts.extend([b.x, b.y, b.z])
-                        verts.extend([t.x, t.y, t.z])
-                        verts.extend([t.x, t.y, t.z])
-                        verts.extend([b.x, b.y, b.z])
-                        normals.extend(v)
-                        normals.extend(v)
-                        normals.extend(-v)
-                        normals.extend(-v)
-                        texcoords.extend([1, 0, 1, 1, 0, 1, 0, 0])
-
-            patch = TreePatch()
-            patch.vertices = pyglet.graphics.vertex_list(
-                len(verts) // 3, ("v3f", verts), ("n3f", normals), ("t2f", texcoords)
-            )
-            self.patches[tile] = patch
+        if diff < 0:
+            return None
+
+        across = -(-self.grid_size >> diff)
+        f = self.placement[:across*across]
+
+        c0, c1, c2, c3 = [numpy.array(tuple(c)) for c in tile.corners]
+
+        hi = c0 + (c3 - c0)*f[:, 0:1]
+        lo = c1 + (c2 - c1)*f[:, 0:1]
+
+        return cube_to_sphere_array(lo + (hi - lo)*f[:, 1:2])
+
+    def generate_patch(self, tile):
+        candidates = self.candidates(tile)
+        if candidates is None:
+            return None
+
+        heights = self.get_heights(candidates)
+
+        # above the water line and below the snow line
+        keep = (heights - self.radius > 1.0) & (heights - self.radius < self.scale * 0.8)
+
+        up = candidates[keep]
+        base = up*heights[keep, None] - numpy.array(tuple(tile.center))
+
+        return numpy.concatenate([base, up], axis=1).astype(numpy.float32)
+
+    def setup_patch(self, patch):
+        glBindVertexArray(patch.va)
+
+        self.billboard_buffer.bind()
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 0, None)
+
+        patch.buffer.bind()
+        glEnableVertexAttribArray(1)
+        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, instance_stride, None)
+        glVertexAttribDivisor(1, 1)
+        glEnableVertexAttribArray(2)
+        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, instance_stride, 12)
+        glVertexAttribDivisor(2, 1)
+        patch.buffer.unbind()
+
+        glBindVertexArray(0)
+
+    def upload_patch(self, tile, data):
+        # a rebuilt patch replaces the old one, even with no trees of its own
+        self.destroy_patch(tile)
+
+        if data is None or not len(data):
+            return
+
+        buffer = VertexBuffer(GL_ARRAY_BUFFER, GL_STATIC_DRAW, data.nbytes, data.ctypes.data_as(POINTER(GLfloat)))
+
+        patch = TreePatch(buffer, len(data))
+        self.setup_patch(patch)
+
+        self.patches[tile] = patch
 
     def destroy_patch(self, tile):
         patch = self.patches.get(tile)
@@ -95,25 +203,33 @@ class TreeFactory(PatchFactory):
 
     def render_patches(self, walk, shader, transform, camera):
         glDisable(GL_CULL_FACE)
-        glFrontFace(GL_CW)
 
         def render_patch(tile):
             patch = self.patches.get(tile)
 
-            if patch and patch.vertices:
-                # print 'drawing'
+            if patch:
                 shader.uniform_matrix_4x4("model_matrix", tile.model)
                 glLoadMatrixf((GLfloat * 16)(*camera.view * transform * tile.model))
 
-                patch.vertices.draw(GL_QUADS)
-                # print 'drawn'
+                glBindVertexArray(patch.va)
+                glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, 4, patch.count)
 
         walk(render_patch)
 
-        glFrontFace(GL_CCW)
+        glBindVertexArray(0)
+
         glEnable(GL_CULL_FACE)
 
     def get_height(self, v):
         return query_height(
             (c_double * 3)(*v), self.radius, self.scale, self.gen.c_generator()
         )
+
+    def get_heights(self, points):
+        points = numpy.ascontiguousarray(points, numpy.float64)
+        heights = numpy.empty(len(points))
+
+        query_heights(points.ctypes.data_as(POINTER(c_double)), len(points), self.radius, self.scale, self.gen.c_generator(),
+                      heights.ctypes.data_as(POINTER(c_double)))
+
+        return heights
@@ -82,3 +82,20 @@ def cube_to_sphere(v):
 		v.y * math.sqrt(1.0 - v.z*v.z*0.5 - v.x*v.x*0.5 + v.z*v.z*v.x*v.x/3.0),
 		v.z * math.sqrt(1.0 - v.x*v.x*0.5 - v.y*v.y*0.5 + v.x*v.x*v.y*v.y/3.0)
 	)
+
+cube_corners = [
+	Vector3(-1, 1, 1), Vector3(-1,-1, 1), Vector3( 1,-1, 1), Vector3( 1, 1, 1),
+	Vector3( 1, 1,-1), Vector3( 1,-1,-1), Vector3(-1,-1,-1), Vector3(-1, 1,-1)
+]
+
+# corners of each face, indexing cube_corners
+cube_faces = [
+	(3, 2, 5, 4), # right
+	(7, 6, 1, 0), # left
+
+	(7, 0, 3, 4), # top
+	(1, 6, 5, 2), # bottom
+
+	(0, 1, 2, 3), # front
+	(4, 5, 6, 7)  # back
+]
@@ -0,0 +1,78 @@
+from pyglet.gl import *
+from ctypes import *
+
+from .vertex_buffer import VertexBuffer
+
+class VertexSlot:
+	def __init__(self, slab, index, vertices, stride):
+		self.slab = slab
+		self.index = index
+
+		# added to every index drawn from this slot
+		self.base_vertex = index*vertices
+		self.offset = self.base_vertex*stride
+
+class VertexSlab:
+	# One large buffer carved into equal slots, with a vertex array object that
+	# every slot in it draws through
+	def __init__(self, slots, vertices, stride, setup):
+		self.buffer = VertexBuffer(GL_ARRAY_BUFFER, GL_STATIC_DRAW, slots*vertices*stride)
+
+		self.va = GLuint()
+		glGenVertexArrays(1, byref(self.va))
+		glBindVertexArray(self.va)
+
+		setup(self.buffer)
+
+		glBindVertexArray(0)
+
+	def delete(self):
+		glDeleteVertexArrays(1, byref(self.va))
+		self.buffer.delete()
+
+class VertexArena:
+	# Hands out fixed-size runs of vertices from a few large buffers, so that
+	# creating and destroying a patch costs a free list push or pop rather than
+	# a buffer and a vertex array of its own. A new slab is only allocated once
+	# every slot in the existing ones is taken.
+	#
+	# setup(buffer) is called with a slab's vertex array bound, to attach the
+	# buffer and whatever is shared with it.
+	def __init__(self, vertices, stride, setup, slots_per_slab=64):
+		self.vertices = vertices
+		self.stride = stride
+		self.setup = setup
+		self.slots_per_slab = slots_per_slab
+
+		self.slabs = []
+		self.free = []
+
+	def __len__(self):
+		return len(self.slabs)*self.slots_per_slab - len(self.free)
+
+	def capacity(self):
+		return len(self.slabs)*self.slots_per_slab
+
+	def allocate(self):
+		if not self.free:
+			slab = VertexSlab(self.slots_per_slab, self.vertices, self.stride, self.setup)
+			self.slabs.append(slab)
+
+			# lowest slots end up on top, and are handed out first
+			for index in reversed(range(self.slots_per_slab)):
+				self.free.append(VertexSlot(slab, index, self.vertices, self.stride))
+
+		return self.free.pop()
+
+	def release(self, slot):
+		self.free.append(slot)
+
+	def upload(self, slot, data):
+		slot.slab.buffer.update(slot.offset, self.vertices*self.stride, data)
+
+	def delete(self):
+		for slab in self.slabs:
+			slab.delete()
+
+		self.slabs = []
+		self.free = []
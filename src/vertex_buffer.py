@@ -25,3 +25,8 @@ class VertexBuffer:
 		if not binding:
 			binding = self.binding
 		glBindBuffer(binding, 0)
+
+	def update(self, offset, size, data):
+		glBindBuffer(self.binding, self.id)
+		glBufferSubData(self.binding, offset, size, data)
+		glBindBuffer(self.binding, 0)
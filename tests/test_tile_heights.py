@@ -0,0 +1,133 @@
+import os
+from ctypes import *
+
+import numpy
+import pytest
+
+from src.native_library import native_library
+from src.tile_mesh import tile_ring, seed_mask
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if not os.path.exists(root + native_library('/build/planet', 'planet_c')):
+    pytest.skip('the native libraries are not built', allow_module_level=True)
+
+noise_c = CDLL(root + native_library('/build/noise', 'noise_c'))
+planet_c = CDLL(root + native_library('/build/planet', 'planet_c'))
+
+constant_create = noise_c.noise_generator_constant_create
+constant_create.argtypes = [c_double]
+constant_create.restype = c_void_p
+
+simplex_create = noise_c.noise_generator_simplex_create
+simplex_create.argtypes = []
+simplex_create.restype = c_void_p
+
+ridged_multifractal_create = noise_c.noise_generator_ridged_multifractal_create
+ridged_multifractal_create.argtypes = [c_void_p]*8
+ridged_multifractal_create.restype = c_void_p
+
+compile_generator = noise_c.noise_generator_compile
+compile_generator.argtypes = [c_void_p]
+compile_generator.restype = None
+
+generate_vertex_heights = planet_c.generate_vertex_heights
+generate_vertex_heights.argtypes = [c_double*3, c_double*3, c_double*3, c_double*3, c_uint, c_void_p, c_int, c_void_p, c_int, c_int,
+                                    c_int, POINTER(c_double)]
+generate_vertex_heights.restype = None
+
+size = 33
+
+
+@pytest.fixture(scope='module')
+def gen():
+    # the terrain main.py builds
+    gen = ridged_multifractal_create(simplex_create(), *[constant_create(v) for v in [16, 2.0, 2.0, 1.0, 0.5, 1.0, 1.0]])
+    compile_generator(gen)
+    return gen
+
+
+def tile_heights(gen, level, x, y, octaves, edge_octaves=-1, heights=None):
+    # the raw noise grid, indexed [j, i], of tile x, y of the +z face at level
+    cells = 1 << (level - 1)
+
+    def corner(i, j):
+        return (c_double*3)(-1.0 + 2.0*i/cells, -1.0 + 2.0*j/cells, 1.0)
+
+    if heights is None:
+        heights = numpy.full((size, size), numpy.nan)
+
+    vertices = (c_float*(size*size))()
+
+    generate_vertex_heights(corner(x, y), corner(x, y + 1), corner(x + 1, y + 1), corner(x + 1, y), size, vertices, 0, gen,
+                            octaves, edge_octaves, 0, heights.ctypes.data_as(POINTER(c_double)))
+
+    return heights
+
+
+# interior octave counts of a parent and its child: what the default tolerance
+# gives main.py's terrain at the coarsest levels, and no truncation at all
+@pytest.mark.parametrize('parent_octaves, child_octaves', [(2, 4), (4, 6), (6, 8), (-1, -1)])
+def test_parent_and_child_agree_along_shared_edges(gen, parent_octaves, child_octaves):
+    half = (size - 1) // 2
+
+    parent = tile_heights(gen, 3, 1, 2, parent_octaves)
+    child = tile_heights(gen, 4, 2, 4, child_octaves)
+
+    # the child's first column and row lie along the parent's, on every other vertex
+    numpy.testing.assert_allclose(child[::2, 0], parent[:half + 1, 0], rtol=0, atol=1e-12)
+    numpy.testing.assert_allclose(child[0, ::2], parent[0, :half + 1], rtol=0, atol=1e-12)
+
+
+def test_truncated_edges_would_crack(gen):
+    # without the ring summing every octave, the same edge disagrees
+    half = (size - 1) // 2
+
+    parent = tile_heights(gen, 3, 1, 2, 2, edge_octaves=2)
+    child = tile_heights(gen, 4, 2, 4, 4, edge_octaves=4)
+
+    assert numpy.abs(child[::2, 0] - parent[:half + 1, 0]).max() > 1e-4
+
+
+def tile_counts(octaves):
+    # the octaves each vertex of a freshly built tile sums
+    counts = numpy.full((size, size), octaves, numpy.int8)
+    counts[tile_ring(size)] = -1
+    return counts
+
+
+# the octaves a child needs, and the parent's and child's inner counts, as
+# TerrainFactory picks them: each tile sums what its children need. The
+# default tolerance gives main.py's terrain twice the level in octaves at the
+# coarse levels, here a level 3 parent and its level 4 child.
+@pytest.mark.parametrize('need, parent_octaves, child_octaves', [(8, 8, 10), (-1, -1, -1)])
+def test_child_is_seeded_from_parent(gen, need, parent_octaves, child_octaves):
+    half = (size - 1) // 2
+
+    parent = tile_heights(gen, 3, 1, 2, parent_octaves)
+    parent_counts = tile_counts(parent_octaves)
+
+    block, mask = seed_mask(size, 0, parent_counts, need)
+
+    # all of the child's even vertices but those of its ring inside the
+    # parent, along the parent's midlines short of its edges, or every one of
+    # them without truncation
+    expected = (half + 1)**2 - (0 if need < 0 else 2*half - 1)
+    assert mask.sum() == expected
+
+    heights = numpy.full((size, size), numpy.nan)
+    heights[::2, ::2][mask] = parent[block][mask]
+
+    seeded = tile_heights(gen, 4, 2, 4, child_octaves, heights=heights)
+    fresh = tile_heights(gen, 4, 2, 4, child_octaves)
+
+    # the ring is the same however the child was built
+    ring = tile_ring(size)
+    numpy.testing.assert_allclose(seeded[ring], fresh[ring], rtol=0, atol=1e-12)
+
+    # copied values sum fewer octaves than the child's own at most, and
+    # truncation only ever lowers a value
+    assert (seeded - fresh).max() <= 1e-12
+
+    if need < 0:
+        numpy.testing.assert_allclose(seeded, fresh, rtol=0, atol=1e-12)